@@ -0,0 +1,128 @@
+'''
+Comparacion del campo de distancias (DistanceField) con los calculos
+exactos: error de los sensores respecto a Car.getDistanceOnAngle, acierto
+de las colisiones y velocidad de ambas consultas, y de la simulacion de
+una poblacion (que solo usa el campo para las colisiones, los sensores
+siguen en la rejilla porque los rayos del campo son mas lentos).
+Las posiciones son puntos aleatorios del circuito que no tocan los limites
+con direcciones aleatorias.
+
+Uso: python -m benchmarks.distancefield [circuito] [resoluciones...]
+'''
+from random import seed
+from sys import argv
+from time import perf_counter
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos.distancefield import DistanceField
+from modulos.geometry import sensorDistances
+from modulos.simulator import PopulationSimulator
+
+SAMPLES = 2000
+REPEATS = 5
+POPULATION = 250
+MAX_ITERS = 400
+
+
+def samplePositions(circuit: Circuit, n: int):
+    '''(x, y, dx, dy) de n coches aleatorios que no tocan los limites'''
+    rng = np.random.default_rng(0)
+    minx, miny = circuit.getLimitsArray().reshape((-1, 2)).min(axis=0)
+    maxx, maxy = circuit.getLimitsArray().reshape((-1, 2)).max(axis=0)
+    grid = circuit.getGrid()
+
+    x, y = np.zeros(0), np.zeros(0)
+    while len(x) < n:
+        px = rng.uniform(minx, maxx, n)
+        py = rng.uniform(miny, maxy, n)
+        ok = ~grid.touchingCircle(px, py, Car.RADIUS)
+        x, y = np.concatenate((x, px[ok])), np.concatenate((y, py[ok]))
+    angle = rng.uniform(0, 2 * np.pi, n)
+    return x[:n], y[:n], np.cos(angle), np.sin(angle)
+
+
+def timeit(f) -> float:
+    '''Mejor tiempo de REPEATS ejecuciones'''
+    best = float('inf')
+    for _ in range(REPEATS):
+        t = perf_counter()
+        f()
+        best = min(best, perf_counter() - t)
+    return best
+
+
+def simulate(circuit: Circuit) -> float:
+    '''Segundos de la simulacion de una poblacion aleatoria'''
+    seed(0)
+    np.random.seed(0)
+    sim = PopulationSimulator([
+        Car(circuit.startPoint.asTuple(), 1, 10)
+        for _ in range(POPULATION)], circuit)
+    t = perf_counter()
+    sim.run(MAX_ITERS, endIfAllStopped=False)
+    return perf_counter() - t
+
+
+def compare(circuit: Circuit, field: DistanceField) -> dict:
+    limits = circuit.getLimitsArray()
+    grid = circuit.getGrid()
+    x, y, dx, dy = samplePositions(circuit, SAMPLES)
+
+    exact = sensorDistances(x, y, dx, dy, Car.SENSORES, limits, grid)
+    approx = sensorDistances(x, y, dx, dy, Car.SENSORES, limits, field)
+    hit = exact < 999999
+    err = np.abs(approx - exact)[hit]
+
+    # Colisiones en puntos cerca de los limites
+    rng = np.random.default_rng(1)
+    cx = x + rng.uniform(-2, 2, SAMPLES) * Car.RADIUS
+    cy = y + rng.uniform(-2, 2, SAMPLES) * Car.RADIUS
+    crashExact = grid.touchingCircle(cx, cy, Car.RADIUS)
+    crashField = field.touchingCircle(cx, cy, Car.RADIUS)
+
+    return {
+        'mean': float(err.mean()) if err.size else 0,
+        'p99': float(np.percentile(err, 99)) if err.size else 0,
+        'max': float(err.max()) if err.size else 0,
+        'within': float((err <= field.tolerance).mean()) if err.size else 1,
+        'misses': int(((approx < 999999) != hit).sum()),
+        'collisions': float((crashExact == crashField).mean()),
+        'rays': timeit(lambda: sensorDistances(
+            x, y, dx, dy, Car.SENSORES, limits, grid)) / timeit(
+                lambda: sensorDistances(
+                    x, y, dx, dy, Car.SENSORES, limits, field)),
+        'collide': timeit(lambda: grid.touchingCircle(
+            cx, cy, Car.RADIUS)) / timeit(lambda: field.touchingCircle(
+                cx, cy, Car.RADIUS)),
+    }
+
+
+if __name__ == '__main__':
+    ct = argv[1] if len(argv) > 1 else './circuito/train1.ct'
+    resolutions = [float(r) for r in argv[2:]] or [0.5, 1, 2, 4]
+
+    c = Circuit(ct)
+    c.getGrid()
+    base = simulate(c)
+    print(
+        f'{SAMPLES} posiciones x {len(Car.SENSORES[0])} sensores, '
+        'error en pixeles, speedup frente a SegmentGrid')
+    print(
+        f'{"res":>5} {"tol":>5} {"build s":>8} {"media":>7} {"p99":>7} '
+        f'{"max":>7} {"<=tol":>7} {"fallos":>6} {"colis.":>7} '
+        f'{"x rayos":>8} {"x colis.":>8} {"x sim.":>7}')
+    for res in resolutions:
+        t = perf_counter()
+        field = DistanceField(c.limits, res)
+        build = perf_counter() - t
+        r = compare(c, field)
+        c.setDistanceField(field)
+        sim = base / simulate(c)
+        c.field_resolution = c.field = None
+        print(
+            f'{res:>5g} {field.tolerance:>5g} {build:>8.2f} '
+            f'{r["mean"]:>7.3f} {r["p99"]:>7.3f} {r["max"]:>7.2f} '
+            f'{r["within"]:>7.1%} {r["misses"]:>6} {r["collisions"]:>7.1%} '
+            f'{r["rays"]:>8.2f} {r["collide"]:>8.2f} {sim:>7.2f}')
@@ -0,0 +1,89 @@
+'''
+Coste por frame de la simulacion segun el numero de segmentos del circuito,
+con y sin rejilla (SegmentGrid).
+Los circuitos grandes se generan repitiendo train1.ct en una cuadricula de
+k x k copias, y los coches empiezan en la primera copia.
+
+Uso: python -m benchmarks.grid [max_k]
+'''
+from random import seed
+from sys import argv
+from time import perf_counter
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.geometry import Line
+from modulos.car import Car
+from modulos.simulator import PopulationSimulator
+
+BASE = './circuito/train1.ct'
+POPULATION = 100
+FRAMES = 60
+
+
+def tiledCircuit(k: int, use_grid: bool) -> Circuit:
+    '''Circuito con k x k copias de BASE'''
+    base = Circuit(BASE)
+    c = Circuit(use_grid=use_grid)
+    c.startPoint = base.startPoint.copy()
+    w, h = base.width + 50, base.height + 50
+    for i in range(k):
+        for j in range(k):
+            for lines, reward in (
+                    (base.limits, False), (base.reward_lines, True)):
+                for lin in lines:
+                    c.addLine(Line(
+                        lin.a.x + i * w, lin.a.y + j * h,
+                        lin.b.x + i * w, lin.b.y + j * h), reward)
+    return c
+
+
+def population(circuit: Circuit):
+    seed(0)
+    np.random.seed(0)
+    return [
+        Car(circuit.startPoint.asTuple(), 1, 10)
+        for _ in range(POPULATION)]
+
+
+def simulatorFrame(circuit: Circuit) -> float:
+    '''Segundos por frame de PopulationSimulator'''
+    sim = PopulationSimulator(population(circuit), circuit)
+    t = perf_counter()
+    for _ in range(FRAMES):
+        sim.step()
+    return (perf_counter() - t) / FRAMES
+
+
+def carFrame(circuit: Circuit) -> float:
+    '''
+    Segundos por frame de la colision y los sensores de Car.update para un
+    solo coche en el punto de salida
+    '''
+    car = population(circuit)[0]
+    car.setPosition(*circuit.startPoint.asTuple())
+    t = perf_counter()
+    for _ in range(FRAMES):
+        car.checkLimits(circuit)
+        car.getEnvironment(circuit)
+    return (perf_counter() - t) / FRAMES
+
+
+if __name__ == '__main__':
+    maxk = int(argv[1]) if len(argv) > 1 else 8
+
+    print(
+        f'{"segmentos":>10} {"sim":>10} {"sim grid":>10} '
+        f'{"car":>10} {"car grid":>10}  (ms por frame)')
+    k = 1
+    while k <= maxk:
+        times = []
+        for use_grid in (False, True):
+            c = tiledCircuit(k, use_grid)
+            c.getGrid()  # Construccion fuera de la medida
+            times.append((simulatorFrame(c), carFrame(c)))
+        (sim, car), (simg, carg) = times
+        print(
+            f'{len(c.limits):>10} {sim * 1e3:>10.3f} {simg * 1e3:>10.3f} '
+            f'{car * 1e3:>10.3f} {carg * 1e3:>10.3f}')
+        k *= 2
@@ -0,0 +1,74 @@
+'''
+Coches x frames y tiempo de una generacion evaluada con successive halving
+(Entrenador(halving=...)) frente a simular todos los individuos hasta el
+final, y calidad de la seleccion: cuantos de los mejores (10%) de la
+evaluacion completa siguen entre los mejores con halving y si se encuentra
+el mismo mejor fitness. La poblacion son mutaciones de los individuos de
+un fichero de mejores, como una generacion avanzada del entrenamiento.
+
+Uso: python -m benchmarks.halving [mejores.npz] [circuito]
+'''
+from contextlib import redirect_stdout
+from io import StringIO
+from random import seed
+from sys import argv
+from time import perf_counter
+from typing import List
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos.entrenador import VectorCarConstructor
+from modulos import checkpoint
+
+POPULATION = 250
+MAX_ITERS = 400
+MUTATION_RATE = 0.09
+TOP = 0.1
+HALVING = ((2, 0.5), (4, 0.5), (3, 1 / 3), (3, 0.25))
+
+
+def population(mejores: List[Car], circuit: Circuit) -> List[Car]:
+    seed(0)
+    np.random.seed(0)
+    cc = VectorCarConstructor(circuit.startPoint.asTuple(), 1, 2, 10)
+    poblacion = [
+        mejores[i % len(mejores)].copy(shareBrain=True)
+        for i in range(POPULATION)]
+    return cc.mutacionPoblacion(poblacion, MUTATION_RATE)
+
+
+def evaluate(mejores: List[Car], circuit: Circuit, halving=None):
+    poblacion = population(mejores, circuit)
+    start = perf_counter()
+    with redirect_stdout(StringIO()):
+        fits = np.array(VectorCarConstructor.fitness(
+            poblacion, circuit, MAX_ITERS, halving=halving))
+    elapsed = perf_counter() - start
+    carsFrames = sum(ind.aliveFrames for ind in poblacion)
+    return fits, carsFrames, elapsed
+
+
+if __name__ == '__main__':
+    filename = argv[1] if len(argv) > 1 else (
+        './best/mejores-1681326062-1layers-13.58.npz')
+    circuit = Circuit(argv[2] if len(argv) > 2 else './circuito/train1.ct')
+    mejores = checkpoint.loadCars(filename)
+
+    top = int(POPULATION * TOP)
+    full, fullFrames, fullTime = evaluate(mejores, circuit)
+    best = set(np.argsort(-full, kind='stable')[:top].tolist())
+
+    print(
+        f'{"halving":>14} {"coches x frames":>16} {"reduccion":>10} '
+        f'{"s":>6} {"mejores " + str(top):>11} {"mejor":>7}')
+    print(
+        f'{"no":>14} {fullFrames:>16} {1:>9.1f}x {fullTime:>6.2f} '
+        f'{top:>11} {full.max():>7.2f}')
+    for halving in HALVING:
+        fits, frames, t = evaluate(mejores, circuit, halving)
+        kept = len(best & set(np.argsort(-fits, kind='stable')[:top].tolist()))
+        print(
+            f'{"(%d, %.2f)" % halving:>14} {frames:>16} '
+            f'{fullFrames / frames:>9.1f}x {t:>6.2f} {kept:>11} '
+            f'{fits.max():>7.2f}')
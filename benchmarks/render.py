@@ -0,0 +1,95 @@
+'''
+Tiempo de dibujo de un frame del modo show (CarConstructor.fitness con
+show) redibujando todo el circuito y actualizando la ventana entera, como
+antes, frente a copiar el circuito de Circuit.staticLayer solo donde
+estaban los coches y actualizar solo esos rectangulos. Se compara con el
+tiempo de simulacion de un frame de los mismos coches sin visualizacion.
+Sin pantalla se usa el driver dummy de SDL (SDL_VIDEODRIVER), que no mide
+el coste real de actualizar la ventana.
+
+Uso: python -m benchmarks.render [coches...]
+'''
+from os import environ
+from sys import argv
+from time import perf_counter
+
+from modulos.constants import C_WHITE
+from modulos.circuit import Circuit
+from modulos.simulator import PopulationSimulator
+from benchmarks.suite import population, positions
+
+POPULATIONS = (50, 250)
+FRAMES = 100
+
+
+def frames(circuit: Circuit, n: int):
+    '''Poblacion en los puntos medios de las recompensas, girando'''
+    cars = population(circuit, n)
+    for car, pos in zip(cars, positions(circuit, n)):
+        car.setPosition(*pos)
+    for _ in range(FRAMES):
+        for car in cars:
+            car.body.rotateDegree(5)
+        yield cars
+
+
+def completo(window, circuit: Circuit, n: int) -> float:
+    import pygame as pg
+
+    start = perf_counter()
+    for cars in frames(circuit, n):
+        window.fill(C_WHITE)
+        circuit.draw(window, True, True, True)
+        for car in cars:
+            car.draw(window)
+        pg.display.update()
+    return (perf_counter() - start) / FRAMES
+
+
+def incremental(window, circuit: Circuit, n: int) -> float:
+    import pygame as pg
+
+    fondo = circuit.staticLayer(True, True, True)
+    window.blit(fondo, (0, 0))
+    pg.display.update()
+    dirty = []
+
+    start = perf_counter()
+    for cars in frames(circuit, n):
+        for rect in dirty:
+            window.blit(fondo, rect, rect)
+        drawn = [car.draw(window) for car in cars]
+        pg.display.update(dirty + drawn)
+        dirty = drawn
+    return (perf_counter() - start) / FRAMES
+
+
+def simulacion(circuit: Circuit, n: int) -> float:
+    '''Un step de PopulationSimulator, con todos los coches siempre vivos'''
+    cars = population(circuit, n)
+    sim = PopulationSimulator(cars, circuit)
+    start = perf_counter()
+    for _ in range(FRAMES):
+        sim.step()
+        sim.alive[:] = True
+    return (perf_counter() - start) / FRAMES
+
+
+if __name__ == '__main__':
+    if 'DISPLAY' not in environ and 'WAYLAND_DISPLAY' not in environ:
+        environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame as pg
+
+    circuit = Circuit('./circuito/train1.ct')
+    window = pg.display.set_mode((circuit.width, circuit.height))
+    print(f'driver {pg.display.get_driver()}, {FRAMES} frames')
+
+    print(
+        f'{"coches":>7} {"completo ms":>12} {"incremental ms":>15} '
+        f'{"simulacion ms":>14}')
+    for n in [int(a) for a in argv[1:]] or POPULATIONS:
+        print(
+            f'{n:>7} {completo(window, circuit, n) * 1e3:>12.3f} '
+            f'{incremental(window, circuit, n) * 1e3:>15.3f} '
+            f'{simulacion(circuit, n) * 1e3:>14.3f}')
+    pg.display.quit()
@@ -0,0 +1,61 @@
+'''
+Coste de la simulacion manteniendo cada decision de la red durante k frames
+(repeat de PopulationSimulator): tiempo por frame de coche y numero de
+veces que se calculan los sensores y la red.
+
+Uso: python -m benchmarks.repeat [circuito]
+'''
+from random import seed
+from sys import argv
+from time import perf_counter
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos.simulator import PopulationSimulator
+
+POPULATION = 250
+MAX_ITERS = 400
+REPEATS = (1, 2, 4, 8)
+
+
+def population(circuit: Circuit):
+    seed(0)
+    np.random.seed(0)
+    return [
+        Car(circuit.startPoint.asTuple(), 1, 10)
+        for _ in range(POPULATION)]
+
+
+def measure(circuit: Circuit, repeat: int):
+    '''(segundos, frames de coche, calculos de sensores y red)'''
+    sim = PopulationSimulator(population(circuit), circuit, repeat=repeat)
+
+    sensed = [0]
+    getEnvironment = sim.getEnvironment
+
+    def counted(idx: np.ndarray) -> np.ndarray:
+        sensed[0] += len(idx)
+        return getEnvironment(idx)
+    sim.getEnvironment = counted
+
+    t = perf_counter()
+    sim.run(MAX_ITERS, endIfAllStopped=False)
+    t = perf_counter() - t
+
+    return t, int(sim.aliveFrames.sum()), sensed[0]
+
+
+if __name__ == '__main__':
+    ct = argv[1] if len(argv) > 1 else './circuito/train1.ct'
+    c = Circuit(ct)
+    c.getGrid()  # Construccion fuera de la medida
+
+    print(
+        f'{"repeat":>6} {"frames":>8} {"sensores":>9} '
+        f'{"us/frame":>9} {"frames/s":>10}')
+    for k in REPEATS:
+        t, frames, sensed = measure(c, k)
+        print(
+            f'{k:>6} {frames:>8} {sensed:>9} '
+            f'{t / max(frames, 1) * 1e6:>9.2f} {frames / t:>10.0f}')
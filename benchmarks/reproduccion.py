@@ -0,0 +1,83 @@
+'''
+Memoria reservada en cada generacion (Entrenador.siguienteGeneracion) con
+los hijos y la elite compartiendo los pesos de sus progenitores hasta que
+cambian, frente a copiar los pesos de todos (como antes). Se mide el pico
+de memoria de la generacion con tracemalloc y los bytes de pesos nuevos
+de la poblacion resultante (arrays que no estaban en la anterior).
+
+Uso: python -m benchmarks.reproduccion [poblaciones...]
+'''
+from random import seed
+from sys import argv
+from time import perf_counter
+import tracemalloc
+import numpy as np
+
+from modulos.car import Car
+from modulos.entrenador import CarConstructor, Entrenador
+
+POPULATIONS = (250, 2000)
+MUTATION_RATES = (0.01, 0.09)
+GENERATIONS = 5
+
+
+def buffers(poblacion):
+    '''Arrays de memoria de los pesos de la poblacion (id -> bytes)'''
+    out = {}
+    for car in poblacion:
+        for lay in car.brain.pesos:
+            base = lay if lay.base is None else lay.base
+            out[id(base)] = base.nbytes
+    return out
+
+
+def measure(size: int, mrate: float, share: bool):
+    seed(0)
+    np.random.seed(0)
+    e = Entrenador(
+        CarConstructor((0, 0), 1, 2, 10), size, probabCruce=0.2,
+        mutationRate=mrate, renovacion=0.2)
+
+    copy = Car.copy
+    if not share:
+        Car.copy = lambda self, shareBrain=False: copy(self)
+    try:
+        poblacion = e.createGeneration(size)
+        fits = sorted(np.random.random(size) * 100, reverse=True)
+        # Primera generacion fuera de la medida, para partir de una
+        # poblacion que ya comparte pesos
+        poblacion = e.siguienteGeneracion(poblacion, fits)
+
+        peak = new = elapsed = 0
+        for _ in range(GENERATIONS):
+            before = buffers(poblacion)
+            tracemalloc.start()
+            t = perf_counter()
+            nueva = e.siguienteGeneracion(poblacion, fits)
+            elapsed += perf_counter() - t
+            peak += tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            new += sum(
+                b for i, b in buffers(nueva).items() if i not in before)
+            poblacion = nueva
+    finally:
+        Car.copy = copy
+
+    return peak / GENERATIONS, new / GENERATIONS, elapsed / GENERATIONS
+
+
+if __name__ == '__main__':
+    populations = [int(p) for p in argv[1:]] or POPULATIONS
+
+    print(
+        f'{"poblacion":>10} {"mrate":>6} {"pesos":>11} {"pico KB":>10} '
+        f'{"nuevos KB":>10} {"ms":>8}')
+    for size in populations:
+        for mrate in MUTATION_RATES:
+            for share in (False, True):
+                peak, new, t = measure(size, mrate, share)
+                print(
+                    f'{size:>10} {mrate:>6} '
+                    f'{"compartidos" if share else "copiados":>11} '
+                    f'{peak / 1024:>10.1f} {new / 1024:>10.1f} '
+                    f'{t * 1e3:>8.2f}')
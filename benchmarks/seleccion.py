@@ -0,0 +1,73 @@
+'''
+Tiempo de la seleccion de progenitores (modulos.seleccion) frente al
+recorrido de la poblacion por cada progenitor que hacia
+Entrenador.seleccionRuleta, para varios tamanos de poblacion. Se escogen
+tantos progenitores como en Entrenador con elitismo y renovacion por
+defecto (90% de la poblacion).
+
+Uso: python -m benchmarks.seleccion [poblaciones...]
+'''
+from random import random
+from sys import argv
+from time import perf_counter
+from typing import List
+import numpy as np
+
+from modulos.seleccion import METODOS
+
+POPULATIONS = (250, 10000, 100000)
+PARENTS = 0.9
+MAX_LEGACY = 10000
+'''Poblacion maxima para el recorrido en Python, que es O(n^2)'''
+
+
+def legacyRuleta(poblacion: List[int], fits: List[float], n: int):
+    '''Version anterior de Entrenador.seleccionRuleta'''
+    fits = [fits[i] + fits[i - 1] for i in range(1, len(fits))]
+    if fits[-1] == 0:
+        return poblacion[:n]
+    for i in range(len(fits)):
+        fits[i] /= fits[-1]
+
+    progenitores = []
+    while len(progenitores) < n:
+        r = random()
+        new = poblacion[0]
+        for ind, f in zip(poblacion, fits):
+            if r > f:
+                break
+            new = ind
+        progenitores.append(new)
+
+    return progenitores
+
+
+def timeit(f, repeats: int) -> float:
+    best = float('inf')
+    for _ in range(repeats):
+        t = perf_counter()
+        f()
+        best = min(best, perf_counter() - t)
+    return best
+
+
+if __name__ == '__main__':
+    populations = [int(p) for p in argv[1:]] or POPULATIONS
+
+    np.random.seed(0)
+    print(f'{"poblacion":>10} {"metodo":>13} {"ms":>10} {"x anterior":>11}')
+    for size in populations:
+        fits = np.sort(np.random.random(size))[::-1] * 100
+        n = int(size * PARENTS)
+        repeats = 1 if size > 1000 else 5
+
+        legacy = None
+        if size <= MAX_LEGACY:
+            poblacion, lfits = list(range(size)), fits.tolist()
+            legacy = timeit(lambda: legacyRuleta(poblacion, lfits, n), 1)
+            print(f'{size:>10} {"anterior":>13} {legacy * 1e3:>10.2f}')
+
+        for name, metodo in METODOS.items():
+            t = timeit(lambda: metodo(fits, n), repeats * 5)
+            speedup = f'{legacy / t:>11.0f}' if legacy else f'{"-":>11}'
+            print(f'{size:>10} {name:>13} {t * 1e3:>10.3f} {speedup}')
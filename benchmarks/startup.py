@@ -0,0 +1,49 @@
+'''
+Tiempo de arranque de "import modulos.entrenador" en un proceso nuevo,
+y modulos graficos (pygame, matplotlib) que se cargan con el.
+
+Uso: python -m benchmarks.startup [repeticiones]
+'''
+from statistics import median
+from subprocess import run
+from sys import argv, executable
+
+CODE = '''
+import sys
+from time import perf_counter
+t = perf_counter()
+import modulos.entrenador
+t = perf_counter() - t
+graficos = sorted({
+    m.split('.')[0] for m in sys.modules
+    if m.split('.')[0] in ('pygame', 'matplotlib')})
+try:
+    import resource
+    memoria = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+except ImportError:  # Windows
+    memoria = 0
+print(t, memoria, ','.join(graficos) or '-')
+'''
+
+
+def measure(repeticiones: int):
+    '''Lista de (segundos, memoria maxima en KB, modulos graficos)'''
+    results = []
+    for _ in range(repeticiones):
+        out = run(
+            [executable, '-c', CODE], capture_output=True,
+            text=True, check=True).stdout.splitlines()[-1].split()
+        results.append((float(out[0]), int(out[1]), out[2]))
+    return results
+
+
+if __name__ == '__main__':
+    repeticiones = int(argv[1]) if len(argv) > 1 else 10
+
+    results = measure(repeticiones)
+    tiempos = [r[0] for r in results]
+    print('import modulos.entrenador')
+    print(f'  mediana: {median(tiempos) * 1e3:.1f} ms')
+    print(f'  minimo:  {min(tiempos) * 1e3:.1f} ms')
+    print(f'  memoria maxima: {results[-1][1] / 1024:.1f} MB')
+    print(f'  modulos graficos importados: {results[-1][2]}')
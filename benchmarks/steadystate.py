@@ -0,0 +1,74 @@
+'''
+Evaluaciones por segundo y utilizacion de los procesos del entrenamiento
+por generaciones (ParallelFitness, cada generacion espera al coche que mas
+dura) frente al estacionario asincrono (SteadyState), con el mismo numero
+de evaluaciones, los mismos procesos y los mismos frames maximos por
+episodio.
+
+Uso: python -m benchmarks.steadystate [workers] [circuito]
+'''
+from contextlib import redirect_stdout
+from io import StringIO
+from os import cpu_count
+from random import seed
+from sys import argv
+from time import perf_counter
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.entrenador import Entrenador, VectorCarConstructor
+from modulos.parallel import ParallelFitness
+from modulos.steadystate import SteadyState
+
+POPULATION = 100
+GENERATIONS = 5
+MAX_ITERS = 400
+
+
+def entrenador(circuit: Circuit) -> Entrenador:
+    seed(0)
+    np.random.seed(0)
+    return Entrenador(
+        VectorCarConstructor(circuit.startPoint.asTuple(), 1, 2, 10),
+        POPULATION, probabCruce=0.2, mutationRate=0.09, renovacion=0.2)
+
+
+def generacional(circuit: Circuit, workers: int):
+    e = entrenador(circuit)
+    pool = ParallelFitness(circuit, workers)
+    busy = 0.0
+    try:
+        poblacion = e.createGeneration()
+        start = perf_counter()
+        for _ in range(GENERATIONS):
+            t = perf_counter()
+            with redirect_stdout(StringIO()):
+                fits = e.constructor.__class__.fitness(
+                    poblacion, circuit, MAX_ITERS, pool=pool)
+            busy += pool.lastUtilizacion * workers * (perf_counter() - t)
+            order = np.argsort(fits)[::-1]
+            poblacion = e.siguienteGeneracion(
+                [poblacion[i] for i in order], [fits[i] for i in order])
+        wall = perf_counter() - start
+    finally:
+        pool.close()
+
+    return POPULATION * GENERATIONS / wall, busy / (workers * wall)
+
+
+def estacionario(circuit: Circuit, workers: int):
+    with redirect_stdout(StringIO()):
+        s = SteadyState(entrenador(circuit), workers, MAX_ITERS).train(
+            circuit, POPULATION * GENERATIONS)
+    return s.evaluacionesPorSegundo, s.utilizacion
+
+
+if __name__ == '__main__':
+    workers = int(argv[1]) if len(argv) > 1 else cpu_count() or 1
+    circuit = Circuit(argv[2] if len(argv) > 2 else './circuito/train1.ct')
+
+    print(f'{"modo":>14} {"evaluaciones/s":>15} {"utilizacion":>12}')
+    for nombre, f in (
+            ('generaciones', generacional), ('estacionario', estacionario)):
+        evals, util = f(circuit, workers)
+        print(f'{nombre:>14} {evals:>15.1f} {util:>12.0%}')
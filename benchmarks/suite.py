@@ -0,0 +1,268 @@
+'''
+Microbenchmarks de las partes de la simulacion que mas tiempo ocupan, con
+semillas fijas: operaciones por segundo de Line.intersection,
+Circle.touchingLine, Car.getEnvironment, NeuralNetwork.process y
+Car.update, y frames por segundo y coches x frames por segundo de una
+generacion completa (CarConstructor.fitness y VectorCarConstructor.fitness)
+en cada circuito. Cada medida es la mejor de varias repeticiones.
+
+Los resultados se pueden guardar en JSON (--json) y comparar con los de
+un fichero de referencia (--baseline, por defecto benchmarks/baseline.json):
+las medidas mas lentas que la referencia en mas de --tolerance se marcan
+como regresion y el programa termina con codigo 1. --save-baseline guarda
+los resultados como nueva referencia (son de la maquina en la que se
+miden, no se pueden comparar entre maquinas distintas).
+
+Uso: python -m benchmarks.suite [--quick] [--json resultados.json]
+    [--baseline fichero] [--save-baseline] [circuitos...]
+'''
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from os.path import dirname, isfile, join
+from platform import platform, python_version
+from random import seed
+from time import perf_counter
+from typing import Callable, Dict, List
+import json
+import sys
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos.entrenador import CarConstructor, VectorCarConstructor
+from modulos.geometry import Circle, Line
+from modulos.neuralnetwork import NeuralNetwork
+
+CIRCUITS = (
+    './circuito/train1.ct', './circuito/test1.ct', './circuito/test2.ct')
+BASELINE = join(dirname(__file__), 'baseline.json')
+FORMAT = 1
+
+SEED = 0
+OPS = 2000
+'''Operaciones de cada medida de los microbenchmarks'''
+POPULATION = 100
+MAX_ITERS = 300
+REPEATS = 5
+TOLERANCE = 0.2
+'''Proporcion de perdida de rendimiento que se marca como regresion'''
+
+METRICS = ('ops_s', 'frames_s', 'cars_frames_s')
+
+
+def reseed() -> None:
+    seed(SEED)
+    np.random.seed(SEED)
+
+
+def best(f: Callable[[], None], repeats: int) -> float:
+    '''Mejor tiempo de repeats llamadas a f'''
+    t = float('inf')
+    for _ in range(repeats):
+        start = perf_counter()
+        f()
+        t = min(t, perf_counter() - start)
+    return t
+
+
+def randomLines(n: int, size: float = 100, length: float = 20) -> List[Line]:
+    a = np.random.random((n, 2)) * size
+    b = a + (np.random.random((n, 2)) - 0.5) * 2 * length
+    return [Line(*p, *q) for p, q in zip(a.tolist(), b.tolist())]
+
+
+def population(circuit: Circuit, n: int) -> List[Car]:
+    reseed()
+    return [
+        Car(circuit.startPoint.asTuple(), 1 + i % 2, 10) for i in range(n)]
+
+
+def benchIntersection(ops: int, repeats: int) -> Dict[str, float]:
+    reseed()
+    pares = list(zip(randomLines(ops), randomLines(ops)))
+
+    def run():
+        for a, b in pares:
+            a.intersection(b)
+    return {'ops_s': ops / best(run, repeats)}
+
+
+def benchTouchingLine(ops: int, repeats: int) -> Dict[str, float]:
+    reseed()
+    centers = (np.random.random((ops, 2)) * 100).tolist()
+    pares = list(zip(
+        [Circle(x, y, Car.RADIUS) for x, y in centers], randomLines(ops)))
+
+    def run():
+        for c, line in pares:
+            c.touchingLine(line)
+    return {'ops_s': ops / best(run, repeats)}
+
+
+def benchProcess(ops: int, repeats: int) -> Dict[str, float]:
+    reseed()
+    nn = NeuralNetwork(Car.NINPUTS, 3, 2, 10)
+    inputs = list(np.random.random((ops, Car.NINPUTS)) * 100)
+
+    def run():
+        for data in inputs:
+            nn.process(data)
+    return {'ops_s': ops / best(run, repeats)}
+
+
+def positions(circuit: Circuit, n: int) -> List[tuple]:
+    '''Puntos medios de las recompensas del circuito, n en total'''
+    rewards = circuit.getRewardsArray()
+    mid = (rewards[:, :2] + rewards[:, 2:]) / 2
+    return [tuple(mid[i % len(mid)]) for i in range(n)]
+
+
+def benchEnvironment(
+        circuit: Circuit, ops: int, repeats: int) -> Dict[str, float]:
+    cars = population(circuit, ops)
+    for car, pos in zip(cars, positions(circuit, ops)):
+        car.setPosition(*pos)
+        car.body.rotateDegree(np.random.random() * 360)
+
+    def run():
+        for car in cars:
+            car.getEnvironment(circuit)
+    return {'ops_s': ops / best(run, repeats)}
+
+
+def benchUpdate(
+        circuit: Circuit, ops: int, repeats: int) -> Dict[str, float]:
+    '''Un frame de ops coches vivos en los puntos medios de las recompensas'''
+    cars = population(circuit, ops)
+    pos = positions(circuit, ops)
+
+    t = float('inf')
+    for _ in range(repeats):
+        for car, p in zip(cars, pos):
+            car.resetAll()
+            car.setPosition(*p)
+        start = perf_counter()
+        for car in cars:
+            car.update(circuit)
+        t = min(t, perf_counter() - start)
+    return {'ops_s': ops / t}
+
+
+def benchFitness(
+        constructor: CarConstructor, circuit: Circuit, n: int,
+        maxIters: int, repeats: int) -> Dict[str, float]:
+    '''
+    Una generacion completa. frames son los del coche que mas dura y
+    coches x frames los que se han simulado de todos los coches vivos
+    '''
+    t, frames, carsFrames = float('inf'), 0, 0
+    for _ in range(repeats):
+        poblacion = population(circuit, n)
+        start = perf_counter()
+        with redirect_stdout(StringIO()):
+            constructor.fitness(poblacion, circuit, maxIters)
+        t = min(t, perf_counter() - start)
+        frames = max(ind.aliveFrames for ind in poblacion)
+        carsFrames = sum(ind.aliveFrames for ind in poblacion)
+
+    return {
+        'frames': frames, 'cars_frames': carsFrames, 'seconds': t,
+        'frames_s': frames / t, 'cars_frames_s': carsFrames / t}
+
+
+def run(circuits: List[str], quick: bool = False) -> dict:
+    ops = OPS // 10 if quick else OPS
+    repeats = 1 if quick else REPEATS
+    results = {}
+
+    def add(name: str, value: Dict[str, float]) -> None:
+        results[name] = value
+        print(name, ' '.join(
+            f'{k}={value[k]:.0f}' for k in METRICS if k in value),
+            file=sys.stderr)
+
+    add('Line.intersection', benchIntersection(ops, repeats))
+    add('Circle.touchingLine', benchTouchingLine(ops, repeats))
+    add('NeuralNetwork.process', benchProcess(ops, repeats))
+
+    for ct in circuits:
+        c = Circuit(ct)
+        c.getGrid()  # Construccion fuera de la medida
+        name = ct.replace('\\', '/').split('/')[-1].rsplit('.', 1)[0]
+
+        add(f'Car.getEnvironment[{name}]', benchEnvironment(
+            c, ops // 4, repeats))
+        add(f'Car.update[{name}]', benchUpdate(c, ops // 4, repeats))
+        for constructor in (CarConstructor, VectorCarConstructor):
+            add(f'{constructor.__name__}.fitness[{name}]', benchFitness(
+                constructor, c, POPULATION, MAX_ITERS,
+                1 if quick else 3))
+
+    return {
+        'format': FORMAT,
+        'quick': quick,
+        'python': python_version(),
+        'numpy': np.__version__,
+        'platform': platform(),
+        'results': results,
+    }
+
+
+def compare(
+        data: dict, baseline: dict,
+        tolerance: float = TOLERANCE) -> List[str]:
+    '''
+    Muestra cada medida frente a la de referencia y devuelve los nombres
+    de las medidas con regresion
+    '''
+    if baseline.get('quick') != data.get('quick'):
+        print('Aviso: la referencia es de otro modo (--quick)')
+
+    regresiones = []
+    print(f'{"medida":<50} {"referencia":>12} {"actual":>12} {"ratio":>6}')
+    for name, value in data['results'].items():
+        ref = baseline['results'].get(name)
+        if ref is None:
+            continue
+        for metric in METRICS:
+            if metric not in value or metric not in ref:
+                continue
+            ratio = value[metric] / ref[metric]
+            marca = ''
+            if ratio < 1 - tolerance:
+                marca = ' REGRESION'
+                regresiones.append(f'{name} {metric}')
+            print(
+                f'{name + " " + metric:<50} {ref[metric]:>12.0f} '
+                f'{value[metric]:>12.0f} {ratio:>6.2f}{marca}')
+
+    return regresiones
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('circuitos', nargs='*', default=CIRCUITS)
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--json')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    data = run(args.circuitos, args.quick)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(data, f, indent=2)
+    elif isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(data, baseline, args.tolerance):
+            sys.exit(1)
+    else:
+        print(f'No hay referencia ({args.baseline}), usa --save-baseline')
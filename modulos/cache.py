@@ -0,0 +1,280 @@
+from typing import Dict, Iterator, List, Tuple, Union
+from collections import OrderedDict
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos.simulator import (
+    RECORD_FIELDS, PopulationSimulator, applyRecords, recordSteps, stopFrame)
+from modulos.parallel import ParallelFitness
+from modulos.timing import PhaseTimes
+
+
+Entry = Tuple[np.ndarray, bool, np.ndarray]
+'''
+Registro (frames, RECORD_FIELDS) de un coche, si esta completo (el coche
+muere o pasa de 3 vueltas en el ultimo frame) y su estado tras el ultimo
+frame (PopulationSimulator.getState) para continuar la simulacion
+'''
+
+
+class FitnessCache():
+    '''
+    Cache de simulaciones por individuo.
+    La simulacion de un coche es determinista, asi que su resultado solo
+    depende de sus pesos, del circuito y del numero de frames. Pero el fin
+    de la simulacion depende de toda la poblacion, por lo que no se guarda
+    el fitness sino el registro de cada frame del coche
+    (PopulationSimulator.record) hasta que muere o pasa de 3 vueltas. Con
+    esos registros se reproduce exactamente la simulacion de la poblacion.
+    Si la simulacion de la poblacion se paro antes (maxIters, todos
+    quietos...) se guarda tambien el estado final del coche, y un registro
+    incompleto sirve para cualquier maxIters hasta su longitud o se continua
+    desde ese estado.
+    En cada generacion los individuos repetidos se simulan una sola vez
+    '''
+
+    maxSize: int
+    entries: 'OrderedDict[Tuple[bytes, bytes], Entry]'
+
+    lookups: int
+    hits: int
+    duplicates: int
+    totalLookups: int
+    totalHits: int
+
+    def __init__(self, maxSize: int = 1000) -> None:
+        '''
+        maxSize: numero maximo de individuos guardados, al superarlo se
+        descartan los usados hace mas tiempo
+        '''
+
+        if maxSize < 1:
+            raise ValueError('maxSize debe ser al menos 1')
+
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lookups = self.hits = self.duplicates = 0
+        self.totalLookups = self.totalHits = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def get(self, key: Tuple[bytes, bytes]) -> Union[None, Entry]:
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: Tuple[bytes, bytes], entry: Entry) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def run(
+            self, poblacion: List[Car], circuito: Circuit, maxIters: int,
+            endIfAllStopped: bool = True,
+            pool: ParallelFitness = None,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            times: PhaseTimes = None) -> int:
+        '''
+        Equivalente a PopulationSimulator.run, pero solo copia a cada Car
+        los contadores de recompensas y frames y si esta vivo.
+        Solo se simulan los individuos distintos que no estan en la cache,
+        en pool si se da.
+        times: si se da, se le suma el tiempo de cada fase de la simulacion
+        en este proceso (no la de pool)
+        Devuelve el numero de frames
+        '''
+        return next(self.runCircuitos(
+            poblacion, [circuito], maxIters, endIfAllStopped, pool,
+            stagnation, repeat, times))
+
+    def runCircuitos(
+            self, poblacion: List[Car], circuitos: List[Circuit],
+            maxIters: int, endIfAllStopped: bool = True,
+            pool: ParallelFitness = None,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            times: PhaseTimes = None) -> Iterator[int]:
+        '''
+        run en varios circuitos: con pool, los individuos que no estan en la
+        cache de todos los circuitos se reparten a la vez entre los procesos
+        (ParallelFitness.recordCircuitos). Devuelve el numero de frames de
+        cada circuito y, antes de devolverlo, copia a cada Car los
+        contadores de ese circuito. Las estadisticas de la cache (hitRate)
+        son las de todos los circuitos
+        '''
+
+        nframes = recordSteps(maxIters, repeat)
+        lookups = [
+            self.lookup(poblacion, c, nframes, stagnation, repeat)
+            for c in circuitos]
+
+        self.lookups = self.hits = self.duplicates = 0
+        for lk in lookups:
+            self.lookups += len(poblacion)
+            self.hits += len(poblacion) - len(lk['need'])
+            self.duplicates += len(poblacion) - len(lk['cars'])
+        self.totalLookups += self.lookups
+        self.totalHits += self.hits
+
+        newEntries = [[] for _ in lookups]
+        if pool is not None:
+            # Los procesos simulan desde el principio hasta que la
+            # poblacion entera (con los registros completos de la cache) se
+            # habria parado
+            jobs = [k for k, lk in enumerate(lookups) if len(lk['need'])]
+            results = pool.recordCircuitos(
+                [[lookups[k]['cars'][u] for u in lookups[k]['need']]
+                 for k in jobs],
+                maxIters, stagnation, repeat, [circuitos[k] for k in jobs],
+                endIfAllStopped, [
+                    lookups[k]['records'][
+                        :, :, lookups[k]['starts'] >= nframes]
+                    for k in jobs])
+            for k, cars in zip(jobs, results):
+                records = lookups[k]['records']
+                for u, (record, state) in zip(
+                        lookups[k]['need'].tolist(), cars):
+                    if len(record):
+                        records[:len(record), :, u] = record
+                        records[len(record):, :, u] = record[-1]
+                newEntries[k] = cars
+
+        for lk, entries in zip(lookups, newEntries):
+            records = lk['records']
+            need = lk['need']
+            starts = lk['starts']
+            if len(need) and pool is None:
+                sim = PopulationSimulator(
+                    [lk['cars'][u] for u in need], lk['circuito'],
+                    stagnation, repeat, times)
+                for j, u in enumerate(need.tolist()):
+                    if starts[u]:
+                        sim.restore(
+                            j, records[starts[u] - 1, :, u],
+                            lk['entries'][u][2])
+                iters = self.simulate(
+                    sim, records, need, starts[need], lk['maxRewards'],
+                    maxIters, endIfAllStopped)
+                states = sim.getState().T
+                for j, u in enumerate(need.tolist()):
+                    end = max((iters - 1) // repeat, starts[u])
+                    entries.append((records[:end, :, u], states[j]))
+            else:
+                iters = stopFrame(
+                    records, lk['maxRewards'], maxIters, endIfAllStopped,
+                    repeat)
+
+            for u, (record, state) in zip(need.tolist(), entries):
+                if len(record) <= starts[u]:
+                    continue  # Nada nuevo
+                done = (
+                    (record[:, 3] == 0) | (record[:, 0] > lk['maxRewards']))
+                if done.any():
+                    record = record[:done.argmax() + 1]
+                self.put(
+                    lk['ukeys'][u],
+                    (record.astype(np.int32), bool(done.any()), state))
+
+            applyRecords(
+                poblacion, records[:, :, lk['columns']], iters, repeat)
+
+            yield iters
+
+    def lookup(
+            self, poblacion: List[Car], circuito: Circuit, nframes: int,
+            stagnation: Tuple[int, float], repeat: int) -> dict:
+        '''
+        Individuos distintos de la poblacion en el circuito ('cars', y
+        'columns' el de cada individuo), sus entradas de la cache y sus
+        registros conocidos (nframes steps), alargados con su ultimo frame.
+        'starts' es el primer step que falta de cada uno (nframes si esta
+        completo) y 'need' los que hay que simular
+        '''
+
+        # La simulacion depende tambien de la regla de retirada y de los
+        # frames por step
+        ckey = circuito.digest() + repr((stagnation, repeat)).encode()
+
+        keys = [(ckey, car.brain.digest()) for car in poblacion]
+        unique: Dict[Tuple[bytes, bytes], int] = {}
+        cars: List[Car] = []
+        for key, car in zip(keys, poblacion):
+            if key not in unique:
+                unique[key] = len(cars)
+                cars.append(car)
+        ukeys = list(unique)
+        entries = [self.get(key) for key in ukeys]
+
+        records = np.zeros(
+            (nframes, len(RECORD_FIELDS), len(cars)), dtype=int)
+        starts = np.zeros((len(cars), ), dtype=int)
+        for u, entry in enumerate(entries):
+            if entry is not None and len(entry[0]):
+                n = min(len(entry[0]), nframes)
+                records[:n, :, u] = entry[0][:n]
+                records[n:, :, u] = entry[0][n - 1]
+                starts[u] = nframes if entry[1] else n
+
+        return {
+            'circuito': circuito,
+            'maxRewards': len(circuito.reward_lines) * 3,
+            'cars': cars,
+            'columns': [unique[key] for key in keys],
+            'ukeys': ukeys,
+            'entries': entries,
+            'records': records,
+            'starts': starts,
+            'need': np.flatnonzero(starts < nframes)}
+
+    def simulate(
+            self, sim: PopulationSimulator, records: np.ndarray,
+            need: np.ndarray, starts: np.ndarray, maxRewards: int,
+            maxIters: int, endIfAllStopped: bool) -> int:
+        '''
+        Mismo bucle que PopulationSimulator.run. Cada coche de sim (columna
+        need de records) se simula a partir del step starts, hasta
+        entonces se usa su registro. Completa records.
+        Devuelve el numero de frames
+        '''
+
+        speedStopped = 0
+        run = True
+        iters = 1
+        while run and speedStopped < 3 and iters < maxIters:
+            k = (iters - 1) // sim.repeat
+
+            active = starts <= k
+            if active.any():
+                sim.step(active)
+                records[k][:, need[active]] = sim.frame()[:, active]
+            frame = records[k]
+
+            if not frame[3].any():
+                run = False
+
+            if run and (frame[0] > maxRewards).any():
+                # Mas de 3 vueltas completas al circuito
+                run = False
+
+            if endIfAllStopped and run:
+                if frame[4].all():
+                    speedStopped += 1  # Todos quietos
+                else:
+                    speedStopped = 0
+
+            iters += sim.repeat
+
+        return iters
+
+    def hitRate(self) -> float:
+        '''Proporcion de individuos de la ultima generacion no simulados'''
+        return self.hits / self.lookups if self.lookups else 0
+
+    def totalHitRate(self) -> float:
+        return self.totalHits / self.totalLookups if self.totalLookups else 0
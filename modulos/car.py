@@ -1,12 +1,19 @@
 
-from typing import Iterable, List, Tuple, Union
-import pygame as pg
+from typing import TYPE_CHECKING, Callable, Iterable, Tuple, Union
 import numpy as np
 
-from modulos.geometry import Shape, Circle, Line
+from math import hypot
+
+from modulos.geometry import (
+    Shape, Circle, Line, capsuleTouchingSegments, rotationConstants,
+    sensorDistances, sensorRays)
 from modulos.neuralnetwork import NeuralNetwork
 from modulos.constants import C_BLACK, C_RED
 from modulos.circuit import Circuit
+from modulos.timing import PhaseTimes, noLap
+
+if TYPE_CHECKING:
+    import pygame as pg
 
 
 class Car():
@@ -14,9 +21,11 @@ class Car():
     brain: NeuralNetwork
     speed: float
     statusDead: bool
+    statusRetired: bool
     nextRewardIdx: int
     aliveFrames: int
     lastRewardFrames: int
+    anchor: Tuple[float, float]
 
     RADIUS = 7
 
@@ -28,6 +37,8 @@ class Car():
 
     ANGULOS = (-90, -60, -30, 0, 30, 60, 90)  # (-80, -40, 0, 40, 80)
     NINPUTS = len(ANGULOS) + 1
+    SENSORES = rotationConstants(ANGULOS)
+    '''(cos, sin) de cada angulo de ANGULOS'''
 
     def __init__(
             self, pos: Tuple[float, float],
@@ -38,14 +49,17 @@ class Car():
 
         self.speed = 0
         self.statusDead = False
+        self.statusRetired = False
         self.nextRewardIdx = 0
 
         self.aliveFrames = 0
         self.lastRewardFrames = 0
+        self.anchor = pos
 
-    def checkCollision(self, lines: Union[List[Line], Line]) -> bool:
+    def checkCollision(
+            self, lines: Union[Iterable[Line], Line]) -> bool:
 
-        if type(lines) is not list:
+        if isinstance(lines, Line):
             return self.body.touchingLine(lines)
 
         for line in lines:
@@ -54,6 +68,54 @@ class Car():
 
         return False
 
+    def checkLimits(self, circuit: Circuit) -> bool:
+        '''
+        Colision con los limites del circuito. Con rejilla solo se
+        comprueban los segmentos cercanos, y con campo de distancias es
+        una sola consulta aproximada
+        '''
+
+        field = circuit.getDistanceField()
+        if field is not None:
+            c = self.body.center
+            return bool(field.touchingCircle(c.x, c.y, self.body.radius))
+
+        grid = circuit.getGrid()
+        if grid is None:
+            return self.checkCollision(circuit.limits)
+
+        c = self.body.center
+        return self.checkCollision([
+            circuit.limits[i]
+            for i in grid.nearIndices(c.x, c.y, self.body.radius)])
+
+    def checkSweptLimits(
+            self, circuit: Circuit,
+            a: Tuple[float, float], b: Tuple[float, float]) -> bool:
+        '''
+        Colision con los limites del circuito en algun punto del
+        desplazamiento de a a b (capsuleTouchingSegments)
+        '''
+
+        field = circuit.getDistanceField()
+        if field is not None:
+            return bool(field.touchingCapsule(*a, *b, self.body.radius))
+
+        limits = circuit.getLimitsArray()
+        grid = circuit.getGrid()
+        if grid is not None:
+            half = hypot(b[0] - a[0], b[1] - a[1]) / 2
+            limits = limits[grid.nearIndices(
+                (a[0] + b[0]) / 2, (a[1] + b[1]) / 2,
+                self.body.radius + half)]
+
+        if not len(limits):
+            return False
+
+        ax, ay, bx, by = limits.T
+        return bool(capsuleTouchingSegments(
+            *a, *b, self.body.radius, ax, ay, bx, by).any())
+
     def think(self, data: np.ndarray) -> Iterable[bool]:
         '''
         Return:
@@ -82,50 +144,148 @@ class Car():
         self.body.addOffset(vx, vy)
         return
 
-    def update(self, circuit: Circuit) -> bool:
-        ''' Devuelve False solo si no se ha procesado nada (coche "muerto") '''
+    def update(
+            self, circuit: Circuit,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            times: PhaseTimes = None) -> bool:
+        '''
+        Devuelve False solo si no se ha procesado nada (coche "muerto")
+        stagnation: (frames, distancia), ver checkStagnation
+        repeat: frames que se mantiene cada decision, ver updateRepeat
+        times: si se da, se le suma el tiempo de cada fase
+        '''
 
         if self.statusDead:
             return False
 
-        if len(circuit.limits) and self.checkCollision(circuit.limits):
+        lap = noLap if times is None else times.lap
+        lap()
+
+        if repeat > 1:
+            return self.updateRepeat(circuit, stagnation, repeat, lap)
+
+        if len(circuit.limits) and self.checkLimits(circuit):
             self.statusDead = True
             self.speed = 0
+            lap('collision')
             return True
+        lap('collision')
 
         rll = len(circuit.reward_lines)
         if rll and self.checkCollision(
                 circuit.reward_lines[self.nextRewardIdx % rll]):
             self.nextRewardIdx += 1
             self.lastRewardFrames = self.aliveFrames
+            self.anchor = self.body.center.asTuple()
+        lap('reward')
 
         data = self.getEnvironment(circuit)
+        lap('sense')
         tl, acc, tr = self.think(data)
+        lap('think')
         self.move(tl, acc, tr)
 
         self.aliveFrames += 1
 
+        if stagnation is not None:
+            self.checkStagnation(*stagnation)
+        lap('move')
+
         return True
 
-    def draw(self, surface: pg.Surface):
+    def updateRepeat(
+            self, circuit: Circuit,
+            stagnation: Tuple[int, float], repeat: int,
+            lap: Callable[[str], None] = noLap) -> bool:
+        '''
+        Sensores y red neuronal una sola vez y la misma accion durante
+        repeat frames. Como en repeat frames el coche puede avanzar mas que
+        su diametro, las colisiones con limites y recompensas se comprueban
+        sobre todo el desplazamiento de cada frame (checkSweptLimits)
+        lap: PhaseTimes.lap para medir el tiempo de cada fase
+        '''
 
-        self.body.draw(surface, C_RED)
+        data = self.getEnvironment(circuit)
+        lap('sense')
+        tl, acc, tr = self.think(data)
+        lap('think')
+
+        rewards = circuit.getRewardsArray()
+        for _ in range(repeat):
+            a = self.body.center.asTuple()
+            self.move(tl, acc, tr)
+            self.aliveFrames += 1
+            b = self.body.center.asTuple()
+            lap('move')
+
+            if len(circuit.limits) and self.checkSweptLimits(circuit, a, b):
+                self.statusDead = True
+                self.speed = 0
+                lap('collision')
+                return True
+            lap('collision')
+
+            if len(rewards) and capsuleTouchingSegments(
+                    *a, *b, self.body.radius,
+                    *rewards[self.nextRewardIdx % len(rewards)]):
+                self.nextRewardIdx += 1
+                self.lastRewardFrames = self.aliveFrames
+                self.anchor = b
+            lap('reward')
+
+            if stagnation is not None and self.checkStagnation(*stagnation):
+                return True
+
+        return True
+
+    def checkStagnation(self, frames: int, distance: float) -> bool:
+        '''
+        Retira (como si hubiera muerto) al coche si cada frames sin nuevas
+        recompensas no se ha alejado al menos distance de donde estaba al
+        principio de esos frames (ultima recompensa o comprobacion anterior).
+        Devuelve True si se retira
+        '''
+
+        waiting = self.aliveFrames - self.lastRewardFrames
+        if not waiting or waiting % frames:
+            return False
+
+        x, y = self.body.center.asTuple()
+        dx, dy = x - self.anchor[0], y - self.anchor[1]
+        if dx * dx + dy * dy < distance * distance:
+            self.statusDead = self.statusRetired = True
+            self.speed = 0
+            return True
+
+        self.anchor = (x, y)
+        return False
+
+    def draw(self, surface: 'pg.Surface') -> 'pg.Rect':
+        '''Dibuja el coche y devuelve el rectangulo que ocupa'''
+        import pygame as pg
+
+        rect = self.body.draw(surface, C_RED)
         long = 20
         x, y = long * self.body.direction.x, long * self.body.direction.y
         a = (self.body.center.x, self.body.center.y)
         b = (a[0] + x, a[1] + y)
-        pg.draw.line(surface, C_BLACK, a, b, 2)
-        return
+        return rect.union(pg.draw.line(surface, C_BLACK, a, b, 2))
 
-    def copy(self) -> 'Car':
-        c = Car((0, 0), 5, 5, True)
+    def copy(self, shareBrain: bool = False) -> 'Car':
+        '''
+        shareBrain: la copia comparte los pesos de la red con este coche
+        hasta que alguno los cambia (NeuralNetwork.share)
+        '''
+        c = Car((0, 0), None, None, True)
         c.speed = self.speed
         c.statusDead = self.statusDead
+        c.statusRetired = self.statusRetired
         c.nextRewardIdx = 0
         c.aliveFrames = self.aliveFrames
         c.lastRewardFrames = self.lastRewardFrames
+        c.anchor = self.anchor
 
-        c.brain = self.brain.copy()
+        c.brain = self.brain.share() if shareBrain else self.brain.copy()
         c.body = self.body.copy()
 
         return c
@@ -143,43 +303,48 @@ class Car():
 
         data = np.zeros((Car.NINPUTS, ), dtype=float)
 
-        for i, an in enumerate(Car.ANGULOS):
-            data[i] = self.getDistanceOnAngle(circuit, an)
+        data[:-1] = self.getDistances(circuit)
 
         data[-1] = self.speed
         return data
 
+    def getDistances(self, circuit: Circuit) -> np.ndarray:
+        '''Distancia a los limites en cada angulo de ANGULOS'''
+
+        return self.getDistancesOnRotations(circuit, Car.SENSORES)
+
     def getDistanceOnAngle(
             self, circuit: Circuit, angulo: float) -> float:
 
-        ray = self.body.direction.copy()
-        ray.rotateDegree(angulo)
-        ray.scale(10000)
-        ray.addOffset(ray.x, ray.y)
-        ray = Line(self.body.center, ray)
-
-        points = [
-            segment.intersection(ray)
-            for segment in circuit.limits]
-        points = [
-            p for p in points
-            if p is not None]
+        return float(self.getDistancesOnRotations(
+            circuit, rotationConstants((angulo, )))[0])
 
-        if not len(points):
-            return 999999
+    def getDistancesOnRotations(
+            self, circuit: Circuit,
+            rotations: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+        '''Distancia a los limites para cada rotacion (cos, sin)'''
 
-        dis = [
-            self.body.center.distance(poi)
-            for poi in points]
+        c, d = self.body.center, self.body.direction
+        grid = circuit.getGrid()
+        if grid is None or not len(circuit.limits):
+            return sensorDistances(
+                c.x, c.y, d.x, d.y, rotations, circuit.getLimitsArray())
 
-        return min(dis)
+        # Con rejilla cada rayo recorre solo las celdas que cruza
+        rx, ry = sensorRays(d.x, d.y, rotations)
+        dis = np.array([
+            grid.castRay(c.x, c.y, x, y)
+            for x, y in zip(rx.tolist(), ry.tolist())], dtype=float)
+        return np.where(np.isinf(dis), 999999, dis)
 
     def resetBody(self) -> None:
         self.body.direction.set(-1, 0)
         self.body.center.set(0, 0)
+        self.anchor = (0, 0)
 
     def resetStatusDead(self) -> None:
         self.statusDead = False
+        self.statusRetired = False
 
     def resetSpeed(self) -> None:
         self.speed = 0
@@ -205,6 +370,7 @@ class Car():
 
     def setPosition(self, x: float, y: float) -> None:
         self.body.center.set(x, y)
+        self.anchor = (x, y)
 
     def mutate(self, mrate: float) -> 'Car':
         '''Return: self'''
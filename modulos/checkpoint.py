@@ -0,0 +1,230 @@
+'''
+Ficheros de individuos (.npz) con solo los pesos de sus redes.
+Cada capa de pesos distinta se guarda una vez (los mejores de varias
+generaciones suelen ser el mismo individuo) y cada individuo es la lista
+de indices de sus capas, junto a su fitness y unos metadatos en JSON. Se
+leen con numpy sin pickle, asi que no dependen de las clases de modulos ni
+pueden ejecutar codigo al cargarlos.
+
+Uso (convierte ficheros .pkl de listas (Car, fitness) a .npz):
+python -m modulos.checkpoint best/mejores.pkl [best/otro.pkl ...]
+'''
+from typing import Dict, List, Tuple, Union
+from os import replace
+from os.path import splitext
+import json
+import numpy as np
+
+from modulos.neuralnetwork import NeuralNetwork
+from modulos.car import Car
+
+FORMAT = 1
+EXTENSION = '.npz'
+
+
+def pack(
+        individuos: List[Union[Car, NeuralNetwork]],
+        layers: List[np.ndarray],
+        ids: Dict[Tuple[Tuple[int, ...], bytes], int]
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    (genomes, offsets) de los individuos: indices de sus capas en layers,
+    donde se anaden las capas que no esten ya (ids: capa -> indice).
+    Las capas del individuo i son genomes[offsets[i]:offsets[i + 1]]
+    '''
+    genomes, offsets = [], [0]
+    for ind in individuos:
+        brain = ind.brain if isinstance(ind, Car) else ind
+        for lay in brain.pesos:
+            lay = np.ascontiguousarray(lay, dtype=float)
+            key = (lay.shape, lay.tobytes())
+            if key not in ids:
+                ids[key] = len(layers)
+                layers.append(lay)
+            genomes.append(ids[key])
+        offsets.append(len(genomes))
+
+    return (
+        np.array(genomes, dtype=np.int64), np.array(offsets, dtype=np.int64))
+
+
+def arrays(
+        individuos: List[Tuple[Car, float]], metadata: dict = None,
+        poblacion: List[Car] = None) -> Dict[str, np.ndarray]:
+    '''
+    Arrays del fichero de save. Copia las capas, asi que se pueden escribir
+    despues aunque los individuos cambien
+    '''
+
+    layers: List[np.ndarray] = []
+    ids: Dict[Tuple[Tuple[int, ...], bytes], int] = {}
+    genomes, offsets = pack([ind for ind, _ in individuos], layers, ids)
+
+    meta = dict(metadata or {})
+    meta.setdefault('activacionBipolar', NeuralNetwork.activacionBipolar)
+    meta.setdefault('normalizarInputs', NeuralNetwork.normalizarInputs)
+
+    data = {
+        'format': np.array([FORMAT]),
+        'fitness': np.array([fit for _, fit in individuos], dtype=float),
+        'genomes': genomes,
+        'offsets': offsets,
+        'metadata': np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+    }
+    if poblacion is not None:
+        data['poblacion_genomes'], data['poblacion_offsets'] = pack(
+            poblacion, layers, ids)
+    data.update({f'layer{i}': lay.copy() for i, lay in enumerate(layers)})
+
+    return data
+
+
+def write(filename: str, data: Dict[str, np.ndarray]) -> None:
+    '''
+    Escribe los arrays en filename de forma atomica: en un fichero
+    temporal que despues reemplaza a filename, de modo que nunca queda un
+    fichero a medias
+    '''
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **data)
+    replace(tmp, filename)
+
+
+def save(
+        filename: str, individuos: List[Tuple[Car, float]],
+        metadata: dict = None, poblacion: List[Car] = None) -> None:
+    '''
+    Guarda una lista de (Car o NeuralNetwork, fitness), como
+    Entrenador.mejores.
+    metadata: diccionario serializable en JSON. Por defecto se anaden
+    activacionBipolar y normalizarInputs de NeuralNetwork
+    poblacion: individuos sin fitness que se guardan aparte, con las
+    mismas capas (Checkpoint.poblacion)
+    '''
+    write(filename, arrays(individuos, metadata, poblacion))
+
+
+class Checkpoint():
+    '''
+    Fichero de save abierto. Solo se leen del fichero los arrays que se
+    piden, y cada capa una sola vez aunque la compartan varios individuos
+    '''
+
+    filename: str
+    data: np.lib.npyio.NpzFile
+    fitness: np.ndarray
+    metadata: dict
+    genomes: np.ndarray
+    offsets: np.ndarray
+    layers: Dict[int, np.ndarray]
+
+    def __init__(self, filename: str) -> None:
+
+        self.filename = filename
+        self.data = np.load(filename, allow_pickle=False)
+        try:
+            version = int(self.data['format'][0])
+            self.fitness = self.data['fitness']
+            self.genomes = self.data['genomes']
+            self.offsets = self.data['offsets']
+            self.metadata = json.loads(self.data['metadata'].tobytes())
+        except KeyError:
+            self.data.close()
+            raise ValueError(f'{filename} no es un fichero de individuos')
+        if version != FORMAT:
+            self.data.close()
+            raise ValueError(
+                f'{filename} tiene el formato {version}, debe ser {FORMAT}')
+        self.layers = {}
+
+    def __len__(self) -> int:
+        return len(self.fitness)
+
+    def __enter__(self) -> 'Checkpoint':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.data.close()
+
+    def layer(self, i: int) -> np.ndarray:
+        if i not in self.layers:
+            self.layers[i] = self.data[f'layer{i}']
+        return self.layers[i]
+
+    def array(self, name: str) -> Union[None, np.ndarray]:
+        '''Otro array del fichero, None si no esta'''
+        return self.data[name] if name in self.data.files else None
+
+    def pesos(
+            self, i: int, genomes: np.ndarray = None,
+            offsets: np.ndarray = None) -> List[np.ndarray]:
+        '''Copia de los pesos del individuo i'''
+        if genomes is None:
+            genomes, offsets = self.genomes, self.offsets
+        return [
+            self.layer(lay).copy()
+            for lay in genomes[offsets[i]:offsets[i + 1]]]
+
+    def brain(self, i: int, *args) -> NeuralNetwork:
+        nn = NeuralNetwork(None, None, None, None, True)
+        nn.pesos = self.pesos(i, *args)
+        return nn
+
+    def car(self, i: int, pos: Tuple[float, float] = (0, 0), *args) -> Car:
+        car = Car(pos, None, None, True)
+        car.brain = self.brain(i, *args)
+        return car
+
+    def cars(self, pos: Tuple[float, float] = (0, 0)) -> List[Car]:
+        return [self.car(i, pos) for i in range(len(self))]
+
+    def poblacion(
+            self, pos: Tuple[float, float] = (0, 0)
+            ) -> Union[None, List[Car]]:
+        '''Individuos guardados con poblacion en save, None si no hay'''
+        genomes = self.array('poblacion_genomes')
+        if genomes is None:
+            return None
+        offsets = self.array('poblacion_offsets')
+        return [
+            self.car(i, pos, genomes, offsets)
+            for i in range(len(offsets) - 1)]
+
+
+def loadCars(
+        filename: str, pos: Tuple[float, float] = (0, 0)) -> List[Car]:
+    '''Individuos de un fichero de save'''
+    with Checkpoint(filename) as c:
+        return c.cars(pos)
+
+
+def migrate(filename: str, output: Union[str, None] = None) -> str:
+    '''
+    Convierte un fichero .pkl con una lista (Car, fitness) al formato de
+    save. Devuelve el fichero creado
+    '''
+    import pickle as pkl
+
+    if output is None:
+        output = splitext(filename)[0] + EXTENSION
+    with open(filename, 'rb') as f:
+        individuos = pkl.load(f)
+
+    # La configuracion de la red con la que se entrenaron no se conoce
+    save(output, individuos, {
+        'origen': filename, 'activacionBipolar': None,
+        'normalizarInputs': None})
+    return output
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+    for pkl in argv[1:]:
+        print(f'{pkl} -> {migrate(pkl)}')
@@ -1,28 +1,65 @@
 
-from typing import List, Tuple, Union
-from os.path import isfile
-import pygame as pg
+from typing import TYPE_CHECKING, Dict, Tuple, Union
+from os.path import abspath, getmtime, isfile, splitext
+from hashlib import blake2b
+import numpy as np
 
 from modulos.constants import C_MAGENTA, C_BLACK, C_WHITE, error, warning
-from modulos.geometry import Line, Point
+from modulos.geometry import Line, Point, SegmentArray
+from modulos.grid import SegmentGrid
+from modulos.distancefield import DistanceField
+from modulos import compiled
+
+if TYPE_CHECKING:
+    import pygame as pg
 
 
 class Circuit():
 
-    limits: List[Line]
-    reward_lines: List[Line]
+    limits: SegmentArray
+    reward_lines: SegmentArray
     width: float
     height: float
     startPoint: Point
 
-    background: Union[None, pg.Surface]
+    grid: Union[None, SegmentGrid]
+    grid_version: int
+    use_grid: bool
+
+    filename: Union[None, str]
+    compiled_file: Union[None, str]
+    field: Union[None, DistanceField]
+    field_version: int
+    field_resolution: Union[None, float]
+    field_tolerance: Union[None, float]
+
+    background: Union[None, 'pg.Surface']
     background_path: Union[None, str]
     background_offset: Point
     background_size: Union[None, Tuple[int, int]]
 
+    layer: Union[None, 'pg.Surface']
+    layer_key: Union[None, tuple]
+
     def __init__(
             self, filename: Union[str, None] = None,
-            background_file: Union[str, None] = None) -> None:
+            background_file: Union[str, None] = None,
+            use_grid: bool = True,
+            field_resolution: Union[float, None] = None,
+            field_tolerance: Union[float, None] = None) -> None:
+        '''
+        filename: fichero .ct, o .ctc (compilado, modulos.compiled). Si
+        junto al .ct hay un .ctc mas reciente se lee ese
+        use_grid: usar una rejilla (SegmentGrid) sobre limits para las
+        consultas de colision y de rayos. Se construye al pedirla por
+        primera vez tras leer el fichero o modificar las lineas
+        field_resolution: si se da, las colisiones usan un campo de
+        distancias aproximado (DistanceField) con esa resolucion en vez de
+        los segmentos. Se guarda junto al fichero del circuito para no
+        recalcularlo
+        field_tolerance: tolerancia del campo de distancias, por defecto
+        2 * field_resolution
+        '''
 
         self.limits = None
         self.reward_lines = None
@@ -30,34 +67,69 @@ class Circuit():
         self.height = None
         self.startPoint = Point(0, 0)
 
+        self.grid = None
+        self.grid_version = -1
+        self.use_grid = use_grid
+
+        self.filename = filename
+        self.compiled_file = None
+        self.field = None
+        self.field_version = -1
+        self.field_resolution = field_resolution
+        self.field_tolerance = field_tolerance
+
         self.background = None
         self.background_path = None
         self.background_offset = Point(0, 0)
         self.background_size = None
 
+        self.layer = None
+        self.layer_key = None
+
         if filename is None:
-            self.limits = []
-            self.reward_lines = []
+            self.limits = SegmentArray()
+            self.reward_lines = SegmentArray()
+        elif compiled.isCompiled(filename):
+            self.readCompiled(filename)
+        elif compiled.upToDate(filename):
+            self.readCompiled(compiled.upToDate(filename))
         else:
             self.readFromFile(filename)
 
         if background_file is not None:
             # Sobreescribe el background que hubiera
-            if self.background:
-                del self.background
+            self.background = None
             self.background_path = background_file
-            self.background = pg.image.load(background_file)
-        if self.background:
-            self.background_size = (
-                self.background.get_width(), self.background.get_height())
+            self.background_size = None
+            self.loadBackground()
+
+    def loadBackground(self) -> Union[None, 'pg.Surface']:
+        '''
+        Carga la imagen de fondo si hay alguna y no se ha cargado todavia.
+        pygame solo se importa aqui y al dibujar, de modo que un circuito
+        sin fondo (o con su tamano en el fichero) no necesita pygame hasta
+        que se dibuja
+        '''
+        if self.background is None and self.background_path:
+            import pygame as pg
+
+            self.background = pg.image.load(self.background_path)
+            if self.background_size:
+                self.background = pg.transform.scale(
+                    self.background, self.background_size)
+            else:
+                self.background_size = (
+                    self.background.get_width(), self.background.get_height())
+
+        return self.background
 
     def readFromFile(self, filename: str):
 
         with open(filename, 'r') as f:
             lines = f.readlines()
 
-        self.reward_lines = []
-        self.limits = []
+        self.reward_lines = SegmentArray()
+        self.limits = SegmentArray()
 
         rew = False
         maxp = Point(-float('inf'), -float('inf'))
@@ -129,13 +201,10 @@ class Circuit():
         self.height = maxp.y - minp.y
         self.width = maxp.x - minp.x
         if self.background_path:
-            self.background = pg.image.load(self.background_path)
-            if self.background_size:
-                self.background = pg.transform.scale(
-                    self.background, self.background_size)
-            else:
-                self.background_size = (
-                    self.background.get_width(), self.background.get_height())
+            self.background = None
+            if not self.background_size:
+                # El tamano del fondo solo se conoce cargando la imagen
+                self.loadBackground()
 
             self.width = max(self.width, self.background_size[0])
             self.height = max(self.height, self.background_size[1])
@@ -144,15 +213,53 @@ class Circuit():
             self.startPoint.x = self.width / 2
             self.startPoint.y = self.height / 2
 
+    def readCompiled(self, filename: str):
+        '''
+        Lee un circuito compilado (modulos.compiled). Los segmentos quedan
+        proyectados en memoria y la rejilla se toma del fichero
+        '''
+
+        header, limits, rewards, cells = compiled.load(filename)
+        self.compiled_file = filename
+
+        self.limits = SegmentArray(limits)
+        self.reward_lines = SegmentArray(rewards)
+        self.startPoint.set(*(float(v) for v in header['start']))
+        self.width, self.height = (float(v) for v in header['size'])
+
+        path = header['background'].decode()
+        if path:
+            if isfile(path):
+                self.background = None
+                self.background_path = path
+                size = tuple(int(v) for v in header['background_size'])
+                self.background_size = size if any(size) else None
+            else:
+                warning(f'No existe la imagen background "{path}"')
+
+        if self.use_grid and cells is not None:
+            self.grid = SegmentGrid(
+                self.limits, float(header['grid_cell']), cells)
+            self.grid_version = self.limits.version
+
+    def writeCompiled(self, filename: str):
+        compiled.save(self, filename)
+
+    def compiledSource(self) -> Union[None, str]:
+        '''
+        Fichero compilado del que se ha leido el circuito, None si no se
+        ha leido de uno o se han modificado las lineas despues
+        '''
+        if self.limits.version or self.reward_lines.version:
+            return None
+        return self.compiled_file
+
     def addOffset(self, x: int = 0, y: int = 0):
 
         self.background_offset.addOffset(x, y)
 
-        for lin in self.limits:
-            lin.addOffset(x, y)
-
-        for lin in self.reward_lines:
-            lin.addOffset(x, y)
+        self.limits.addOffset(x, y)
+        self.reward_lines.addOffset(x, y)
 
     def scale(self, factor: Union[float, Tuple[float, float]]):
 
@@ -161,11 +268,8 @@ class Circuit():
         else:
             xf, yf = factor, factor
 
-        for lin in self.limits:
-            lin.scale(factor)
-
-        for lin in self.reward_lines:
-            lin.scale(factor)
+        self.limits.scale(factor)
+        self.reward_lines.scale(factor)
 
         if self.width and self.height:
             self.width = int(self.width * xf)
@@ -175,7 +279,7 @@ class Circuit():
 
     def scaleBackground(self, factor: Union[float, Tuple[float, float]]):
 
-        if not self.background:
+        if not self.loadBackground():
             warning(
                 'No se puede escalar el fondo porque no '
                 'hay ninguno cargado')
@@ -186,6 +290,8 @@ class Circuit():
         else:
             xf, yf = factor, factor
 
+        import pygame as pg
+
         news = (
             int(self.background.get_width() * xf),
             int(self.background.get_height() * yf))
@@ -195,12 +301,14 @@ class Circuit():
 
     def backgroundNewSize(
             self, width: Union[int, float], height: Union[int, float]):
-        if not self.background:
+        if not self.loadBackground():
             warning(
                 'No se puede cambiar el tamano del fondo porque no '
                 'hay ninguno cargado')
             return
 
+        import pygame as pg
+
         news = (int(width), int(height))
         self.background = pg.transform.scale(
             self.background, news)
@@ -214,24 +322,32 @@ class Circuit():
 
     def dumps(self) -> str:
 
+        def num(v: float):
+            # Las coordenadas enteras se escriben sin decimales
+            return int(v) if v == int(v) else v
+
         s = t = ''
         prev = None
         for line in self.limits:
             if prev and prev.b.inRadius(line.a, 4):
                 # Junta puntos de lineas que esten muy cerca
                 # Para reducir espacio del fichero
-                s += f'{line.b.x} {line.b.y}\n'
+                s += f'{num(line.b.x)} {num(line.b.y)}\n'
             else:
-                s += f'{line.a.x} {line.a.y} {line.b.x} {line.b.y}\n'
+                s += (
+                    f'{num(line.a.x)} {num(line.a.y)} '
+                    f'{num(line.b.x)} {num(line.b.y)}\n')
             prev = line
 
         s += f'Start {self.startPoint.x} {self.startPoint.y}\n'
         prev = None
         for line in self.reward_lines:
             if prev and prev.b.inRadius(line.a, 4):
-                t += f'{line.b.x} {line.b.y}\n'
+                t += f'{num(line.b.x)} {num(line.b.y)}\n'
             else:
-                t += f'{line.a.x} {line.a.y} {line.b.x} {line.b.y}\n'
+                t += (
+                    f'{num(line.a.x)} {num(line.a.y)} '
+                    f'{num(line.b.x)} {num(line.b.y)}\n')
             prev = line
 
         if self.background_path is not None:
@@ -244,10 +360,11 @@ class Circuit():
         return s + '\n\nReward\n\n' + t
 
     def draw(
-            self, surface: pg.Surface, showRewards: bool = False,
+            self, surface: 'pg.Surface', showRewards: bool = False,
             showLimits: bool = True, showBackground: bool = True):
+        import pygame as pg
 
-        if showBackground and self.background:
+        if showBackground and self.loadBackground():
             surface.blit(self.background, self.background_offset.asTuple())
 
         if showLimits:
@@ -266,28 +383,41 @@ class Circuit():
             pg.draw.line(surface, C_MAGENTA, (x+3, y), (x-3, y), width=2)
             pg.draw.line(surface, C_MAGENTA, (x, y+3), (x, y-3), width=2)
 
+    def staticLayer(
+            self, showRewards: bool = False, showLimits: bool = True,
+            showBackground: bool = True) -> 'pg.Surface':
+        '''
+        Superficie con el circuito dibujado (draw) sobre fondo blanco, para
+        no redibujar cada linea en cada frame. Se guarda y solo se vuelve a
+        dibujar si cambian las opciones, las lineas o el fondo. Se convierte
+        al formato de la ventana si ya hay una, para que copiarla sea rapido
+        '''
+        import pygame as pg
+
+        self.loadBackground()
+        key = (
+            showRewards, showLimits, showBackground,
+            self.limits.version, self.reward_lines.version,
+            self.width, self.height, self.startPoint.asTuple(),
+            id(self.background), self.background_offset.asTuple())
+        if self.layer is None or self.layer_key != key:
+            layer = pg.Surface((int(self.width), int(self.height)))
+            if pg.display.get_surface() is not None:
+                layer = layer.convert()
+            layer.fill(C_WHITE)
+            self.draw(layer, showRewards, showLimits, showBackground)
+            self.layer = layer
+            self.layer_key = key
+
+        return self.layer
+
     def removeInRadius(self, point: Point, radius: float):
         '''
         Elimina todas las lineas que tengan al menos un punto dentro del radio
         '''
-        rem = 0
-
-        i = 0
-        while i < len(self.limits):
-            lin = self.limits[i]
-            if lin.a.inRadius(point, radius) or lin.b.inRadius(point, radius):
-                self.limits.pop(i)
-                rem += 1
-            else:
-                i += 1
-        i = 0
-        while i < len(self.reward_lines):
-            lin = self.reward_lines[i]
-            if lin.a.inRadius(point, radius) or lin.b.inRadius(point, radius):
-                self.reward_lines.pop(i)
-                rem += 1
-            else:
-                i += 1
+        rem = self.limits.removeMask(self.limits.inRadius(point, radius))
+        rem += self.reward_lines.removeMask(
+            self.reward_lines.inRadius(point, radius))
 
         return rem
 
@@ -297,8 +427,107 @@ class Circuit():
         else:
             self.limits.append(line)
 
+    def getLimitsArray(self) -> np.ndarray:
+        '''Array (N, 4) con los segmentos de limits, sin copia'''
+        return self.limits.data
+
+    def getRewardsArray(self) -> np.ndarray:
+        '''Array (N, 4) con los segmentos de reward_lines, sin copia'''
+        return self.reward_lines.data
+
+    def getGrid(self) -> Union[None, SegmentGrid]:
+        '''Rejilla sobre limits, None si use_grid es False'''
+        if not self.use_grid:
+            return None
+        if self.grid is None or self.grid_version != self.limits.version:
+            self.grid = SegmentGrid(self.limits)
+            self.grid_version = self.limits.version
+        return self.grid
+
+    def getDistanceField(self) -> Union[None, DistanceField]:
+        '''
+        Campo de distancias sobre limits, None si no hay field_resolution.
+        Si el circuito se ha leido de un fichero el campo se guarda junto a
+        el (<nombre>.df<resolucion>.npz) y se reutiliza mientras los
+        limites no cambien
+        '''
+        if self.field_resolution is None:
+            return None
+        if self.field is None or self.field_version != self.limits.version:
+            if self.filename is None:
+                self.field = DistanceField(
+                    self.limits, self.field_resolution, self.field_tolerance)
+            else:
+                self.field = DistanceField.cached(
+                    self.limits, self.fieldFilename(),
+                    self.field_resolution, self.field_tolerance)
+            self.field_version = self.limits.version
+        return self.field
+
+    def setDistanceField(self, field: DistanceField) -> None:
+        '''Usa un campo de distancias ya calculado sobre limits'''
+        self.field = field
+        self.field_version = self.limits.version
+        self.field_resolution = field.resolution
+        self.field_tolerance = field.tolerance
+
+    def fieldFilename(self) -> str:
+        return f'{splitext(self.filename)[0]}.df{self.field_resolution:g}.npz'
+
+    def getSpatialIndex(self) -> Union[None, DistanceField, SegmentGrid]:
+        '''
+        Estructura para las consultas de colision: el campo de distancias
+        si lo hay, si no la rejilla (o None)
+        '''
+        field = self.getDistanceField()
+        return field if field is not None else self.getGrid()
+
+    def digest(self) -> bytes:
+        '''
+        Hash de los limites, las recompensas y el punto de inicio (y del
+        campo de distancias, que cambia los resultados)
+        '''
+        h = blake2b(digest_size=16)
+        for arr in (self.getLimitsArray(), self.getRewardsArray()):
+            arr = np.ascontiguousarray(arr, dtype=float)
+            h.update(np.array(arr.shape, dtype=np.int64).tobytes())
+            h.update(arr.tobytes())
+        h.update(np.array(self.startPoint.asTuple(), dtype=float).tobytes())
+        if self.field_resolution is not None:
+            field = self.getDistanceField()
+            h.update(repr((field.resolution, field.tolerance)).encode())
+        return h.digest()
+
+
+loaded: Dict[tuple, Tuple[float, Circuit]] = {}
+'''Circuitos de loadCircuit por fichero y parametros, con su fecha'''
+
+
+def loadCircuit(
+        filename: str, use_grid: bool = True,
+        field_resolution: Union[float, None] = None,
+        field_tolerance: Union[float, None] = None) -> Circuit:
+    '''
+    Circuito de un fichero leido y preprocesado (rejilla y campo de
+    distancias) una sola vez: todas las llamadas con el mismo fichero y
+    parametros devuelven el mismo objeto, que no se debe modificar. Se
+    vuelve a leer si el fichero ha cambiado
+    '''
+    key = (abspath(filename), use_grid, field_resolution, field_tolerance)
+    mtime = getmtime(filename)
+    if key not in loaded or loaded[key][0] != mtime:
+        c = Circuit(
+            filename, use_grid=use_grid, field_resolution=field_resolution,
+            field_tolerance=field_tolerance)
+        c.getGrid()
+        c.getDistanceField()
+        loaded[key] = (mtime, c)
+    return loaded[key][1]
+
 
 if __name__ == '__main__':
+    import pygame
+
     c = Circuit('circuito/testimg1.ct')
 
     c.scale(1.3)
@@ -306,12 +535,12 @@ if __name__ == '__main__':
 
     window_size = (c.width, c.height)
 
-    clock = pg.time.Clock()
-    window = pg.display.set_mode(window_size)
+    clock = pygame.time.Clock()
+    window = pygame.display.set_mode(window_size)
 
     window.fill(C_WHITE)
     c.draw(window, True)
-    pg.display.update()
+    pygame.display.update()
 
     run = True
     TICK = 10
@@ -319,6 +548,6 @@ if __name__ == '__main__':
         clock.tick(TICK)
 
         pos = None
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
                 run = False
@@ -0,0 +1,154 @@
+'''
+Formato binario de los circuitos (.ctc).
+Cabecera (HEADER) seguida de los arrays de limites y recompensas (float64,
+(N, 4)) y de la tabla de celdas de la SegmentGrid (int64, (nx * ny, K)) si
+se ha guardado. Los arrays se leen con numpy.memmap, asi que no hay que
+interpretar el texto del .ct y los procesos que cargan el mismo fichero
+comparten sus paginas.
+
+Uso: python -m modulos.compiled circuito.ct [circuito.ct ...]
+'''
+from typing import TYPE_CHECKING, Tuple, Union
+from os.path import getmtime, isfile, splitext
+import numpy as np
+
+if TYPE_CHECKING:
+    from modulos.circuit import Circuit
+
+MAGIC = b'AUTOCARS'
+VERSION = 1
+EXTENSION = '.ctc'
+
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<i8'),
+    ('limits', '<i8'),  # Numero de segmentos
+    ('rewards', '<i8'),
+    ('start', '<f8', (2, )),
+    ('size', '<f8', (2, )),  # width, height
+    ('bounds', '<f8', (4, )),  # minx, miny, maxx, maxy de los limites
+    ('background_size', '<i8', (2, )),  # 0, 0 si no se conoce
+    ('background', 'S256'),
+    ('grid_cell', '<f8'),  # Lado de las celdas, 0 si no hay rejilla
+    ('grid_shape', '<i8', (2, )),  # Filas y columnas de la tabla
+])
+
+ALIGN = 64
+'''Alineamiento del inicio de cada array'''
+
+
+def aligned(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+def sidecar(filename: str) -> str:
+    '''Fichero compilado de un .ct'''
+    return splitext(filename)[0] + EXTENSION
+
+
+def isCompiled(filename: str) -> bool:
+    return splitext(filename)[1] == EXTENSION
+
+
+def upToDate(filename: str) -> Union[None, str]:
+    '''
+    Fichero compilado de filename si existe y es mas reciente que el, si no
+    None
+    '''
+    compiled = sidecar(filename)
+    if isfile(compiled) and getmtime(compiled) >= getmtime(filename):
+        return compiled
+    return None
+
+
+def save(circuit: 'Circuit', filename: str) -> None:
+    '''Guarda el circuito y su rejilla (si la usa) en formato compilado'''
+
+    limits = np.ascontiguousarray(circuit.getLimitsArray(), dtype='<f8')
+    rewards = np.ascontiguousarray(circuit.getRewardsArray(), dtype='<f8')
+    grid = circuit.getGrid()
+    path = (circuit.background_path or '').encode()
+    if len(path) > HEADER['background'].itemsize:
+        raise ValueError(
+            'la ruta del background debe ocupar menos de 256 bytes')
+
+    header = np.zeros((1, ), dtype=HEADER)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['limits'] = len(limits)
+    header['rewards'] = len(rewards)
+    header['start'] = circuit.startPoint.asTuple()
+    header['size'] = (circuit.width or 0, circuit.height or 0)
+    if len(limits):
+        points = limits.reshape((-1, 2))
+        header['bounds'] = (*points.min(axis=0), *points.max(axis=0))
+    header['background_size'] = circuit.background_size or (0, 0)
+    header['background'] = path
+    if grid is not None:
+        header['grid_cell'] = grid.cellSize
+        header['grid_shape'] = grid.cells.shape
+
+    with open(filename, 'wb') as f:
+        for arr in (header, limits, rewards) + (
+                (np.ascontiguousarray(grid.cells, dtype='<i8'), )
+                if grid is not None else ()):
+            f.write(b'\0' * (aligned(f.tell()) - f.tell()))
+            f.write(arr.tobytes())
+
+
+def load(filename: str) -> Tuple[np.void, np.ndarray, np.ndarray,
+                                 Union[None, np.ndarray]]:
+    '''
+    (cabecera, limites, recompensas, celdas de la rejilla o None) de un
+    fichero compilado. Los arrays se proyectan en memoria en modo copia al
+    escribir: se comparten mientras no se modifican
+    '''
+
+    header = np.fromfile(filename, dtype=HEADER, count=1)
+    if len(header) != 1 or header['magic'][0] != MAGIC:
+        raise ValueError(f'{filename} no es un circuito compilado')
+    header = header[0]
+    if header['version'] != VERSION:
+        raise ValueError(
+            f'{filename} tiene la version {header["version"]}, '
+            f'debe ser {VERSION}')
+
+    offset = aligned(HEADER.itemsize)
+
+    def array(dtype: str, shape: Tuple[int, int]) -> np.ndarray:
+        nonlocal offset
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        arr = np.memmap(
+            filename, dtype=dtype, mode='c', offset=offset, shape=shape)
+        offset = aligned(offset + arr.nbytes)
+        return arr
+
+    limits = array('<f8', (int(header['limits']), 4))
+    rewards = array('<f8', (int(header['rewards']), 4))
+    cells = None
+    if header['grid_cell']:
+        cells = array('<i8', tuple(int(v) for v in header['grid_shape']))
+
+    return header, limits, rewards, cells
+
+
+def compileCircuit(filename: str, output: str = None) -> str:
+    '''Convierte un .ct a formato compilado, devuelve el fichero creado'''
+    from modulos.circuit import Circuit
+
+    if output is None:
+        output = sidecar(filename)
+    c = Circuit()
+    c.readFromFile(filename)
+    save(c, output)
+    return output
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+    for ct in argv[1:]:
+        print(f'{ct} -> {compileCircuit(ct)}')
@@ -0,0 +1,283 @@
+from typing import Union
+from os.path import isfile
+from hashlib import blake2b
+from math import ceil, sqrt
+import numpy as np
+
+from modulos.geometry import (
+    SegmentArray, pointSegmentsDistance2, raySegmentsDistance)
+from modulos.grid import SegmentGrid
+
+
+class DistanceField():
+    '''
+    Distancia a los segmentos mas cercanos muestreada en una rejilla de
+    nodos separados resolution, e interpolada bilinealmente entre ellos.
+    La colision es una sola consulta aproximada y los rayos avanzan a
+    saltos (sphere tracing) en vez de cortarse con todos los segmentos.
+    La interpolacion se aleja de la distancia real como mucho slack
+    (resolution * raiz de 2), asi que los rayos avanzan la distancia menos
+    slack y nunca atraviesan un segmento. Cuando un rayo esta a menos de
+    tolerance de algun segmento solo se corta con los segmentos de ese
+    entorno (con una SegmentGrid): si corta alguno la distancia es la
+    exacta, y si no (pasa rozando) sigue avanzando
+    '''
+
+    resolution: float
+    tolerance: float
+    slack: float
+    minx: float
+    miny: float
+    nx: int
+    ny: int
+    values: np.ndarray
+    digest: bytes
+    grid: SegmentGrid
+
+    MAX_STEPS = 256
+    '''Saltos maximos de cada rayo'''
+
+    def __init__(
+            self, segments: Union[SegmentArray, np.ndarray],
+            resolution: float = 1, tolerance: float = None,
+            build: bool = True) -> None:
+        '''
+        - segments: SegmentArray o array (N, 4) con los segmentos
+            (ax, ay, bx, by)
+        - resolution: separacion entre nodos de la rejilla
+        - tolerance: distancia a la que los rayos se cortan con los
+            segmentos cercanos, por defecto 2 * resolution. Tiene que ser
+            mayor que slack
+        - build: si False no se calculan los valores (para cargarlos de
+            un fichero con load)
+        '''
+
+        if resolution <= 0:
+            raise ValueError('resolution debe ser positiva')
+
+        if isinstance(segments, SegmentArray):
+            segments = segments.data
+        segments = np.asarray(segments, dtype=float).reshape((-1, 4))
+
+        self.resolution = resolution = float(resolution)
+        self.slack = resolution * sqrt(2)
+        if tolerance is None:
+            tolerance = 2 * resolution
+        if tolerance <= self.slack:
+            raise ValueError(
+                'tolerance debe ser mayor que resolution * raiz de 2')
+        self.tolerance = float(tolerance)
+        self.digest = DistanceField.segmentsDigest(segments, resolution)
+
+        # Rejilla sobre el rectangulo de los segmentos con un margen para
+        # que los rayos solo salgan de ella si no van a cortar nada
+        if len(segments):
+            minx, miny = segments.reshape((-1, 2)).min(axis=0)
+            maxx, maxy = segments.reshape((-1, 2)).max(axis=0)
+        else:
+            minx = miny = maxx = maxy = 0
+        margin = (ceil(self.tolerance / resolution) + 2) * resolution
+        self.minx, self.miny = minx - margin, miny - margin
+        self.nx = int(ceil((maxx + margin - self.minx) / resolution))
+        self.ny = int(ceil((maxy + margin - self.miny) / resolution))
+
+        self.grid = SegmentGrid(segments)
+        self.values = None
+        if build:
+            self.rasterize(segments)
+
+    def segmentsDigest(segments: np.ndarray, resolution: float) -> bytes:
+        '''Hash de los segmentos y la resolucion, para validar ficheros'''
+        h = blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(segments, dtype=float).tobytes())
+        h.update(np.array([resolution], dtype=float).tobytes())
+        return h.digest()
+
+    def rasterize(self, segments: np.ndarray) -> None:
+        '''Distancia de cada nodo al segmento mas cercano'''
+
+        xs = self.minx + np.arange(self.nx + 1) * self.resolution
+        ys = self.miny + np.arange(self.ny + 1) * self.resolution
+        x, y = np.meshgrid(xs, ys, indexing='ij')
+        x, y = x.ravel(), y.ravel()
+
+        if not len(segments):
+            self.values = np.full(
+                (self.nx + 1, self.ny + 1), np.inf, dtype=np.float32)
+            return
+
+        ax, ay, bx, by = segments.T
+        values = np.empty(x.shape, dtype=np.float32)
+        chunk = max(1, 2 ** 22 // len(segments))
+        for i in range(0, len(x), chunk):
+            values[i:i + chunk] = np.sqrt(pointSegmentsDistance2(
+                x[i:i + chunk, None], y[i:i + chunk, None],
+                ax, ay, bx, by).min(axis=1))
+
+        self.values = values.reshape((self.nx + 1, self.ny + 1))
+
+    def save(self, filename: str) -> None:
+        np.savez(
+            filename, values=self.values,
+            digest=np.frombuffer(self.digest, dtype=np.uint8))
+
+    def load(self, filename: str) -> bool:
+        '''
+        Carga los valores de un fichero de save si es de los mismos
+        segmentos y resolucion. Devuelve si se han cargado
+        '''
+        if not isfile(filename):
+            return False
+
+        try:
+            with np.load(filename) as data:
+                if data['digest'].tobytes() != self.digest:
+                    return False
+                values = data['values']
+        except (OSError, KeyError, ValueError):
+            return False
+
+        if values.shape != (self.nx + 1, self.ny + 1):
+            return False
+        self.values = values
+        return True
+
+    def cached(
+            segments: Union[SegmentArray, np.ndarray], filename: str,
+            resolution: float = 1,
+            tolerance: float = None) -> 'DistanceField':
+        '''
+        DistanceField guardado en filename, o calculado y guardado si el
+        fichero no existe o es de otros segmentos
+        '''
+        field = DistanceField(segments, resolution, tolerance, build=False)
+        if not field.load(filename):
+            if isinstance(segments, SegmentArray):
+                segments = segments.data
+            field.rasterize(np.asarray(segments, dtype=float).reshape(-1, 4))
+            try:
+                field.save(filename)
+            except OSError:
+                pass  # Solo es una cache
+        return field
+
+    def inside(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        '''Puntos dentro de la rejilla'''
+        fx = (x - self.minx) / self.resolution
+        fy = (y - self.miny) / self.resolution
+        return (fx >= 0) & (fx <= self.nx) & (fy >= 0) & (fy <= self.ny)
+
+    def distance(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        '''
+        Distancia interpolada de cada punto a los segmentos. Fuera de la
+        rejilla es la del borde mas cercano
+        '''
+        fx = np.clip((x - self.minx) / self.resolution, 0, self.nx)
+        fy = np.clip((y - self.miny) / self.resolution, 0, self.ny)
+        ix = np.minimum(fx.astype(int), self.nx - 1)
+        iy = np.minimum(fy.astype(int), self.ny - 1)
+        tx, ty = fx - ix, fy - iy
+
+        v = self.values
+        return (
+            (v[ix, iy] * (1 - tx) + v[ix + 1, iy] * tx) * (1 - ty) +
+            (v[ix, iy + 1] * (1 - tx) + v[ix + 1, iy + 1] * tx) * ty)
+
+    def touchingCircle(
+            self, x: np.ndarray, y: np.ndarray, radius: float) -> np.ndarray:
+        '''Circulos de centro (x, y) que tocan algun segmento'''
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        return self.inside(x, y) & (self.distance(x, y) <= radius)
+
+    def touchingCapsule(
+            self, px: np.ndarray, py: np.ndarray,
+            qx: np.ndarray, qy: np.ndarray, radius: float) -> np.ndarray:
+        '''
+        Circulos de radio radius que tocan algun segmento en su
+        desplazamiento de (px, py) a (qx, qy)
+        '''
+        px, py = np.asarray(px, dtype=float), np.asarray(py, dtype=float)
+        qx, qy = np.asarray(qx, dtype=float), np.asarray(qy, dtype=float)
+
+        length = np.hypot(qx - px, qy - py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ux = np.where(length > 0, (qx - px) / length, 0)
+            uy = np.where(length > 0, (qy - py) / length, 0)
+
+        touching = np.zeros(px.shape, dtype=bool)
+        t = np.zeros(px.shape, dtype=float)
+        active = np.ones(px.shape, dtype=bool)
+        minStep = self.tolerance - self.slack
+        for _ in range(self.MAX_STEPS):
+            x, y = px + ux * t, py + uy * t
+            d = self.distance(x, y)
+            hit = active & self.inside(x, y) & (d <= radius)
+            touching |= hit
+            active &= ~hit
+
+            # Avanza sin llegar a tocar y comprueba el final del tramo
+            step = np.maximum(d - radius - self.slack, minStep)
+            last = active & (t >= length)
+            active &= ~last
+            if not active.any():
+                break
+            t = np.where(active, np.minimum(t + step, length), t)
+
+        return touching
+
+    def castRays(
+            self, cx: np.ndarray, cy: np.ndarray,
+            dx: np.ndarray, dy: np.ndarray) -> np.ndarray:
+        '''
+        Distancia desde (cx, cy) al primer segmento que corta el rayo
+        (cx, cy) - (dx, dy), inf si no corta ninguno. Solo es aproximada
+        (menor que la real) para los rayos sin resolver tras MAX_STEPS
+        saltos
+        '''
+        cx, cy, dx, dy = np.broadcast_arrays(*(
+            np.asarray(v, dtype=float) for v in (cx, cy, dx, dy)))
+        shape = cx.shape
+        cx, cy, dx, dy = cx.ravel(), cy.ravel(), dx.ravel(), dy.ravel()
+
+        vx, vy = dx - cx, dy - cy
+        length = np.hypot(vx, vy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ux = np.where(length > 0, vx / length, 0)
+            uy = np.where(length > 0, vy / length, 0)
+
+        dis = np.full(cx.shape, np.inf)
+        # Solo se sigue avanzando con los rayos sin resolver (idx)
+        idx = np.flatnonzero(length > 0)
+        t = np.zeros(idx.shape, dtype=float)
+        for _ in range(self.MAX_STEPS):
+            x, y = cx[idx] + ux[idx] * t, cy[idx] + uy[idx] * t
+            d = self.distance(x, y)
+
+            # Fuera de la rejilla el rayo ya no puede cortar nada
+            keep = self.inside(x, y) & (t <= length[idx])
+
+            # Cerca de algun segmento: corte exacto con los del entorno.
+            # El tramo de t a t + tolerance no sale del entorno, asi que si
+            # no corta ninguno antes de t + tolerance puede avanzar hasta ahi
+            close = keep & (d <= self.tolerance)
+            if close.any():
+                i = np.flatnonzero(close)
+                j = idx[i]
+                ax, ay, bx, by = np.moveaxis(self.grid.segments[
+                    self.grid.nearSegments(x[i], y[i], self.tolerance)],
+                    -1, 0)
+                h = raySegmentsDistance(
+                    cx[j, None], cy[j, None], dx[j, None], dy[j, None],
+                    ax, ay, bx, by).min(axis=-1)
+                hit = h <= t[i] + self.tolerance
+                dis[j[hit]] = h[hit]
+                keep[i[hit]] = False
+
+            t = t + np.where(close, self.tolerance, d - self.slack)
+            idx, t = idx[keep], t[keep]
+            if not len(idx):
+                break
+
+        # Rayos sin resolver tras MAX_STEPS saltos
+        dis[idx] = t
+        return dis.reshape(shape)
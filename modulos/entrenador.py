@@ -1,19 +1,33 @@
 
-from random import randint, random
-from time import sleep
-from typing import Any, List, Tuple
-import pygame as pg
+from random import getstate, randint, setstate
+from threading import Thread
+from time import perf_counter, sleep, time
+from typing import Any, Iterator, List, Tuple, Union
 
 from math import ceil
 import numpy as np
 
-from modulos.constants import C_BLACK, C_WHITE, TRAINING_TICK
+from modulos.constants import C_BLACK, TRAINING_TICK
 from modulos.circuit import Circuit
 from modulos.car import Car
+from modulos.neuralnetwork import GenomePool
+from modulos.simulator import PopulationSimulator, halvingHorizons
+from modulos.parallel import ParallelFitness
+from modulos.cache import FitnessCache
+from modulos import checkpoint
+from modulos.seleccion import METODOS
+from modulos.timing import PhaseTimes
+from modulos.metrics import MetricsSink, maxMemory
 
 LOG = True
 DEBUG = True
 
+AGREGACIONES = ('media', 'minimo')
+'''
+Formas de juntar el fitness de cada circuito en uno solo, ademas de una
+lista de pesos (media ponderada)
+'''
+
 
 class RandomConstructorInterface():
 
@@ -29,6 +43,28 @@ class RandomConstructorInterface():
     def mutacion(self, ind: Any, mrate: float) -> Any:
         raise NotImplementedError()
 
+    def recombinacionPoblacion(
+            self, poblacion: List[Any], pares: np.ndarray) -> List[Any]:
+        '''
+        Cruza (inplace) las parejas de individuos de pares, array (k, 2)
+        de indices de poblacion
+        '''
+        for i, j in pares.tolist():
+            poblacion[i], poblacion[j] = self.recombinacion(
+                poblacion[i], poblacion[j])
+        return poblacion
+
+    def mutacionPoblacion(
+            self, poblacion: List[Any], mrate: float) -> List[Any]:
+        return [self.mutacion(ind, mrate) for ind in poblacion]
+
+    def reproduccion(
+            self, poblacion: List[Any], pares: np.ndarray,
+            mrate: float) -> List[Any]:
+        '''Cruce de las parejas pares y mutacion de toda la poblacion'''
+        poblacion = self.recombinacionPoblacion(poblacion, pares)
+        return self.mutacionPoblacion(poblacion, mrate)
+
 
 class CarConstructor(RandomConstructorInterface):
 
@@ -58,16 +94,80 @@ class CarConstructor(RandomConstructorInterface):
         ind.mutate(mrate)
         return ind
 
+    def recombinacionPoblacion(
+            self, poblacion: List[Car], pares: np.ndarray) -> List[Car]:
+        '''Cruce de todas las parejas a la vez con un GenomePool'''
+        pares = np.asarray(pares, dtype=int).reshape((-1, 2))
+        GenomePool([poblacion[i].brain for i in pares.ravel()]).cruzar(
+            np.arange(pares.size).reshape((-1, 2)))
+        return poblacion
+
+    def mutacionPoblacion(
+            self, poblacion: List[Car], mrate: float) -> List[Car]:
+        '''Mutacion de toda la poblacion a la vez con un GenomePool'''
+        GenomePool([ind.brain for ind in poblacion]).mutate(mrate)
+        return poblacion
+
+    def reproduccion(
+            self, poblacion: List[Car], pares: np.ndarray,
+            mrate: float) -> List[Car]:
+        '''Cruce y mutacion con un solo GenomePool de toda la poblacion'''
+        pool = GenomePool([ind.brain for ind in poblacion])
+        pool.cruzar(pares)
+        pool.mutate(mrate)
+        return poblacion
+
     def fitness(
             poblacion: List[Car], circuito: Circuit,
             maxIters: int = 400, generacion: int = None,
-            show: bool = False, endIfAllStopped: bool = True) -> List[float]:
+            show: bool = False, endIfAllStopped: bool = True,
+            pool: ParallelFitness = None,
+            cache: FitnessCache = None,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, times: PhaseTimes = None,
+            halving: Tuple[int, float] = None) -> List[float]:
+        '''
+        pool: si se da, la simulacion (sin visualizacion) se reparte entre
+        sus procesos
+        cache: si se da, solo se simulan (sin visualizacion) los individuos
+        distintos que no estan en ella
+        stagnation: (frames, distancia), si se da se retiran los coches que
+        cada frames sin recompensas no se alejan al menos distancia
+        (Car.checkStagnation). Su fitness se calcula igual que el del resto
+        repeat: frames que se mantiene cada decision de la red, los
+        sensores y la red solo se calculan una vez cada repeat frames
+        (Car.updateRepeat)
+        times: si se da, se le suma el tiempo de cada fase de la simulacion
+        (PhaseTimes). Las de los procesos de pool no se miden
+        halving: (niveles, proporcion), si se da (sin visualizacion, pool ni
+        cache) la simulacion es successive halving
+        (PopulationSimulator.runHalving): todos los individuos se simulan
+        pocos frames y solo la proporcion mejor sigue hasta el siguiente
+        nivel, hasta maxIters en el ultimo
+        '''
+
+        if cache is not None and not show:
+            return CarConstructor.fitnessCached(
+                poblacion, circuito, maxIters, endIfAllStopped, pool, cache,
+                stagnation, repeat, times)
+
+        if pool is not None and not show:
+            return CarConstructor.fitnessParallel(
+                poblacion, maxIters, endIfAllStopped, pool, stagnation,
+                repeat, circuito)
+
+        if halving is not None and not show:
+            return CarConstructor.fitnessHalving(
+                poblacion, circuito, maxIters, endIfAllStopped, stagnation,
+                repeat, times, halving)
 
         for ind in poblacion:  # Resetear los individuos
             ind.resetAll()
             ind.setPosition(*circuito.startPoint.asTuple())
 
         if show:  # Objetos de visualizacion
+            import pygame as pg
+
             window_size = (circuito.width, circuito.height)
             clock = pg.time.Clock()
             window = pg.display.set_mode(window_size)
@@ -75,6 +175,14 @@ class CarConstructor(RandomConstructorInterface):
                 pg.font.init()
                 fuente = pg.font.SysFont('arial', 20)
 
+            # El circuito se dibuja una sola vez, en cada frame solo se
+            # redibujan los coches y el texto sobre lo que ocupaban en el
+            # anterior y solo se actualizan esos rectangulos de la ventana
+            fondo = circuito.staticLayer(True, True, True)
+            window.blit(fondo, (0, 0))
+            pg.display.update()
+            dirty = []
+
         # Numero de "frames" que llevan parados todos los individuos
         speedStopped = 0
         # Numero de individuos con vida
@@ -87,19 +195,23 @@ class CarConstructor(RandomConstructorInterface):
 
             if show and run and updated:
                 # Visualizacion
-                window.fill(C_WHITE)
-                circuito.draw(window, True, True, True)
-                for car in poblacion:
-                    car.draw(window)
+                if times is not None:
+                    times.lap()
+                for rect in dirty:
+                    window.blit(fondo, rect, rect)
+                drawn = [car.draw(window) for car in poblacion]
 
                 if generacion:  # Informacion
                     text = fuente.render(
                         f'Generacion {generacion} - Frame {iters}',
                         False, C_BLACK)
-                    window.blit(text, (0, 0))
+                    drawn.append(window.blit(text, (0, 0)))
 
-                pg.display.update()
+                pg.display.update(dirty + drawn)
+                dirty = drawn
                 updated = False
+                if times is not None:
+                    times.lap('render')
 
                 if iters < 2 and DEBUG:
                     sleep(4)
@@ -112,7 +224,8 @@ class CarConstructor(RandomConstructorInterface):
                         run = False
 
             for ind in poblacion:  # Actualizacion
-                updated = ind.update(circuito) or updated
+                updated = (
+                    ind.update(circuito, stagnation, repeat, times) or updated)
 
             if run:
                 aliveIndividuos = sum(  # Cuantos "vivos"
@@ -132,9 +245,11 @@ class CarConstructor(RandomConstructorInterface):
                 else:
                     speedStopped = 0
 
-            iters += 1
+            iters += repeat
 
-        print('Frames:', iters, '/', maxIters)
+        if LOG:
+            print('Frames:', iters, '/', maxIters)
+            CarConstructor.printRetired(poblacion, iters, stagnation)
         if show:
             if DEBUG:
                 sleep(3)
@@ -142,10 +257,143 @@ class CarConstructor(RandomConstructorInterface):
             if generacion:
                 pg.font.quit()
 
+        if LOG:
+            print(
+                'Max reward:',
+                max(ind.nextRewardIdx for ind in poblacion))
+        return CarConstructor.fitnessValues(poblacion, maxIters)
+
+    def fitnessParallel(
+            poblacion: List[Car], maxIters: int,
+            endIfAllStopped: bool, pool: ParallelFitness,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, circuito: Circuit = None) -> List[float]:
+
+        iters = pool.run(
+            poblacion, maxIters, endIfAllStopped, stagnation, repeat,
+            circuito)
+
+        if LOG:
+            print('Frames:', iters, '/', maxIters)
+            CarConstructor.printRetired(poblacion, iters, stagnation)
+            print(
+                f'Utilizacion: {pool.lastUtilizacion:.0%}',
+                f'({pool.workers} procesos)')
+            print(
+                'Max reward:',
+                max(ind.nextRewardIdx for ind in poblacion))
+
+        return CarConstructor.fitnessValues(poblacion, maxIters)
+
+    def fitnessCircuitos(
+            poblacion: List[Car], circuitos: List[Circuit], maxIters: int,
+            endIfAllStopped: bool, pool: ParallelFitness,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, cache: FitnessCache = None,
+            times: PhaseTimes = None) -> Iterator[List[float]]:
+        '''
+        Fitness de cada individuo en cada circuito, uno detras de otro (los
+        contadores de cada Car quedan con los del circuito recien devuelto).
+        Con pool, las simulaciones de todos los circuitos (con cache, solo
+        las de los individuos que no estan en ella) se reparten a la vez
+        entre sus procesos
+        '''
+
+        if cache is not None:
+            runs = cache.runCircuitos(
+                poblacion, circuitos, maxIters, endIfAllStopped, pool,
+                stagnation, repeat, times)
+        else:
+            runs = pool.runCircuitos(
+                poblacion, maxIters, endIfAllStopped, stagnation, repeat,
+                circuitos)
+
+        for iters in runs:
+            if LOG:
+                print('Frames:', iters, '/', maxIters)
+                CarConstructor.printRetired(poblacion, iters, stagnation)
+            yield CarConstructor.fitnessValues(poblacion, maxIters)
+
+        if LOG and cache is not None:
+            print(
+                'Cache:', cache.hits, '/', cache.lookups,
+                f'({round(100 * cache.hitRate(), 1)}%,',
+                f'{cache.duplicates} repetidos)')
+        if LOG and pool is not None:
+            print(
+                f'Utilizacion: {pool.lastUtilizacion:.0%}',
+                f'({pool.workers} procesos, {len(circuitos)} circuitos)')
+
+    def fitnessCached(
+            poblacion: List[Car], circuito: Circuit, maxIters: int,
+            endIfAllStopped: bool, pool: ParallelFitness,
+            cache: FitnessCache,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, times: PhaseTimes = None) -> List[float]:
+
+        iters = cache.run(
+            poblacion, circuito, maxIters, endIfAllStopped, pool, stagnation,
+            repeat, times)
+
+        if LOG:
+            print('Frames:', iters, '/', maxIters)
+            CarConstructor.printRetired(poblacion, iters, stagnation)
+            print(
+                'Cache:', cache.hits, '/', cache.lookups,
+                f'({round(100 * cache.hitRate(), 1)}%,',
+                f'{cache.duplicates} repetidos)')
+            print(
+                'Max reward:',
+                max(ind.nextRewardIdx for ind in poblacion))
+
+        return CarConstructor.fitnessValues(poblacion, maxIters)
+
+    def fitnessHalving(
+            poblacion: List[Car], circuito: Circuit, maxIters: int,
+            endIfAllStopped: bool, stagnation: Tuple[int, float],
+            repeat: int, times: PhaseTimes,
+            halving: Tuple[int, float]) -> List[float]:
+
+        def score(nextRewardIdx, aliveFrames):
+            return CarConstructor.fitnessArrays(
+                nextRewardIdx, aliveFrames, maxIters)
+
+        sim = PopulationSimulator(
+            poblacion, circuito, stagnation, repeat, times)
+        iters = sim.runHalving(maxIters, *halving, score, endIfAllStopped)
+
+        if LOG:
+            print('Frames:', iters, '/', maxIters)
+            CarConstructor.printRetired(poblacion, iters, stagnation)
+            print(
+                'Coches x frames:', sum(ind.aliveFrames for ind in poblacion),
+                '- Niveles:', halvingHorizons(maxIters, *halving))
+            print(
+                'Max reward:',
+                max(ind.nextRewardIdx for ind in poblacion))
+
+        return CarConstructor.fitnessValues(poblacion, maxIters)
+
+    def printRetired(
+            poblacion: List[Car], iters: int,
+            stagnation: Tuple[int, float]) -> None:
+        '''
+        Coches retirados por no avanzar y frames que se han ahorrado (los
+        que les quedaban hasta el final de la simulacion)
+        '''
+
+        if stagnation is None:
+            return
+
+        retired = [ind for ind in poblacion if ind.statusRetired]
         print(
-            'Max reward:',
-            max(ind.nextRewardIdx for ind in poblacion))
-        fits = [
+            'Retirados:', len(retired),
+            '- Frames ahorrados:',
+            sum(iters - 1 - ind.aliveFrames for ind in retired))
+
+    def fitnessValues(poblacion: List[Car], maxIters: int) -> List[float]:
+        '''Fitness de cada individuo a partir de su estado tras simular'''
+        return [
             # Lo lejos que llegan + ~proporcion de tiempo que estan vivos
             # Valoramos que usen menos frames para llegar a las
             # mismas recompensas
@@ -157,7 +405,56 @@ class CarConstructor(RandomConstructorInterface):
                 ) * 100 / maxIters
             for ind in poblacion]
 
-        return fits
+    def fitnessArrays(
+            nextRewardIdx: np.ndarray, aliveFrames: np.ndarray,
+            maxIters: int) -> np.ndarray:
+        '''fitnessValues a partir de los arrays de contadores'''
+        return np.where(
+            nextRewardIdx > 0, nextRewardIdx,
+            aliveFrames / maxIters * 0.9) * 100 / maxIters
+
+
+class VectorCarConstructor(CarConstructor):
+    '''
+    CarConstructor que calcula el fitness con PopulationSimulator, que
+    actualiza todos los coches a la vez con arrays de numpy.
+    Los valores de fitness son los mismos que los de CarConstructor
+    '''
+
+    def fitness(
+            poblacion: List[Car], circuito: Circuit,
+            maxIters: int = 400, generacion: int = None,
+            show: bool = False, endIfAllStopped: bool = True,
+            pool: ParallelFitness = None,
+            cache: FitnessCache = None,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, times: PhaseTimes = None,
+            halving: Tuple[int, float] = None) -> List[float]:
+
+        if show or pool is not None or cache is not None:
+            # La visualizacion necesita actualizar cada Car
+            return CarConstructor.fitness(
+                poblacion, circuito, maxIters, generacion,
+                show, endIfAllStopped, pool, cache, stagnation, repeat,
+                times, halving)
+
+        if halving is not None:
+            return CarConstructor.fitnessHalving(
+                poblacion, circuito, maxIters, endIfAllStopped, stagnation,
+                repeat, times, halving)
+
+        sim = PopulationSimulator(
+            poblacion, circuito, stagnation, repeat, times)
+        iters = sim.run(maxIters, endIfAllStopped)
+
+        if LOG:
+            print('Frames:', iters, '/', maxIters)
+            CarConstructor.printRetired(poblacion, iters, stagnation)
+            print(
+                'Max reward:',
+                max(ind.nextRewardIdx for ind in poblacion))
+
+        return CarConstructor.fitnessValues(poblacion, maxIters)
 
 
 class Entrenador:
@@ -176,8 +473,29 @@ class Entrenador:
     mutationRate: float
     elitismo: int
     ruleta: bool
+    seleccion: str
+    torneo: int
     renovacion: int
 
+    workers: int
+    pool: ParallelFitness
+    cache: FitnessCache
+    list_cache_hits: List[float]
+    list_timing: List[PhaseTimes]
+    stagnation: Tuple[int, float]
+    repeat: int
+    halving: Tuple[int, float]
+    agregacion: Union[str, Tuple[float, ...]]
+
+    snapshotEvery: int
+    snapshotFile: str
+    snapshotWriter: Union[None, Thread]
+    timing: bool
+    metricsFile: str
+    metricsLive: bool
+    metrics: Union[None, MetricsSink]
+    framesCircuitos: Union[None, np.ndarray]
+
     individuo: Car
 
     def __init__(
@@ -190,7 +508,20 @@ class Entrenador:
             mutationRate: float = 0.01,
             elitismo: int = 0.05,
             ruleta: bool = True,
-            renovacion: float = 0.05
+            renovacion: float = 0.05,
+            workers: int = None,
+            cacheSize: int = None,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1,
+            snapshotEvery: int = None,
+            snapshotFile: str = None,
+            seleccion: str = None,
+            torneo: int = 2,
+            timing: bool = False,
+            metricsFile: str = None,
+            metricsLive: bool = False,
+            halving: Tuple[int, float] = None,
+            agregacion: Union[str, List[float]] = 'media'
             ) -> None:
         """
         populationSize: int, Numero de individuos a entrenar
@@ -205,8 +536,45 @@ class Entrenador:
         elitismo: float en [0, 1], la proporcion de mejores individuos que se
         reservan de una generacion a la siguiente
         ruleta: bool, seleccionar individuos aleatoriamente con probabilidad
-        proporcional al fitness
+        proporcional al fitness, si no los mejores. Solo si no se da
+        seleccion
         renovacion: float, porcentaje de nuevos individuos en cada generacion
+        workers: int, numero de procesos entre los que se reparte el calculo
+        del fitness, None o 1 para calcularlo en este proceso
+        cacheSize: int, numero maximo de individuos cuya simulacion se guarda
+        para no repetirla, None o 0 para no usar la cache
+        stagnation: (frames, distancia), se retiran los coches que cada
+        <frames> frames sin nuevas recompensas no se alejan al menos
+        <distancia>, None para no retirarlos
+        repeat: int, frames que se mantiene cada decision de la red (los
+        sensores y la red se calculan una vez cada <repeat> frames)
+        snapshotEvery: int, cada cuantas generaciones se guarda el estado
+        del entrenamiento en snapshotFile para continuarlo con
+        train(resume=...), None para no guardarlo
+        seleccion: str, metodo de seleccion de progenitores de
+        modulos.seleccion: 'ruleta', 'sus' (stochastic universal sampling),
+        'torneo' o 'truncamiento' (los mejores)
+        torneo: int, individuos de cada torneo con seleccion 'torneo'
+        timing: bool, medir el tiempo de cada fase de la simulacion
+        (colisiones, recompensas, sensores, red, movimiento y dibujo) en
+        cada generacion, en list_timing
+        metricsFile: str, fichero al que se anade una linea JSON con las
+        metricas de cada generacion (modulos.metrics), None para no
+        guardarlas
+        metricsLive: bool, escribir cada linea de metricas en cuanto se
+        genera en vez de en bloques, para seguir el entrenamiento con
+        tail -f o python -m modulos.metrics
+        halving: (niveles, proporcion), evaluacion por successive halving:
+        todos los individuos se simulan maxIters * proporcion^(niveles-1)
+        frames, solo la proporcion mejor sigue hasta el siguiente nivel
+        (proporcion veces mas frames), y asi hasta el maximo de frames de
+        la generacion. Los descartados tienen el fitness de los frames que
+        han simulado, que nunca supera al de los que siguen. No se puede
+        usar con workers ni cacheSize. None para simular todos hasta el
+        final
+        agregacion: str o lista de pesos, como se junta el fitness de cada
+        circuito cuando se entrena en varios: 'media', 'minimo' (el peor
+        circuito) o la media ponderada con un peso por circuito
         """
 
         if populationSize < 1:
@@ -234,10 +602,61 @@ class Entrenador:
             raise ValueError(
                 'renovacion debe estar en el rango [0, 1-elitismo]')
 
+        if workers is not None and workers < 1:
+            raise ValueError('workers debe ser al menos 1')
+
+        if cacheSize is not None and cacheSize < 0:
+            raise ValueError('cacheSize no puede ser negativo')
+
+        if stagnation is not None and (
+                stagnation[0] < 1 or stagnation[1] < 0):
+            raise ValueError(
+                'stagnation debe ser (frames >= 1, distancia >= 0)')
+
+        if repeat < 1:
+            raise ValueError('repeat debe ser al menos 1')
+
+        if seleccion is None:
+            seleccion = 'ruleta' if ruleta else 'truncamiento'
+        if seleccion not in METODOS:
+            raise ValueError(
+                f'seleccion debe ser uno de {", ".join(METODOS)}')
+
+        if torneo < 1:
+            raise ValueError('torneo debe ser al menos 1')
+
+        if halving is not None and (
+                halving[0] < 1 or not 0 < halving[1] <= 1):
+            raise ValueError(
+                'halving debe ser (niveles >= 1, proporcion en (0, 1])')
+        if halving is not None and (
+                (workers is not None and workers > 1) or cacheSize):
+            raise ValueError(
+                'halving no se puede usar con workers ni cacheSize')
+
+        if isinstance(agregacion, str):
+            if agregacion not in AGREGACIONES:
+                raise ValueError(
+                    f'agregacion debe ser uno de {", ".join(AGREGACIONES)} '
+                    'o una lista de pesos')
+        else:
+            agregacion = tuple(float(w) for w in agregacion)
+            if min(agregacion, default=-1) < 0 or not sum(agregacion):
+                raise ValueError(
+                    'Los pesos de agregacion no pueden ser negativos y '
+                    'alguno debe ser mayor que 0')
+
+        if snapshotEvery is not None and (
+                snapshotEvery < 1 or snapshotFile is None):
+            raise ValueError(
+                'snapshotEvery debe ser al menos 1 y necesita snapshotFile')
+
         # Listas de control de mejora intergeneracional
         self.list_best_fit_indiv = []
         self.list_fit_med = []
         self.list_fit_best = []
+        self.list_cache_hits = []
+        self.list_timing = []
 
         # Hiperparametros
         self.populationSize = populationSize
@@ -246,8 +665,26 @@ class Entrenador:
         self.probabCruce = probabCruce
         self.mutationRate = mutationRate
         self.elitismo = ceil(elitismo * populationSize)
-        self.ruleta = ruleta
+        self.ruleta = seleccion == 'ruleta'
+        self.seleccion = seleccion
+        self.torneo = torneo
         self.renovacion = ceil(renovacion * populationSize)
+        self.workers = workers
+        self.pool = None
+        self.cache = FitnessCache(cacheSize) if cacheSize else None
+        self.stagnation = (
+            tuple(stagnation) if stagnation is not None else None)
+        self.repeat = repeat
+        self.halving = tuple(halving) if halving is not None else None
+        self.agregacion = agregacion
+        self.snapshotEvery = snapshotEvery
+        self.snapshotFile = snapshotFile
+        self.snapshotWriter = None
+        self.timing = timing
+        self.metricsFile = metricsFile
+        self.metricsLive = metricsLive
+        self.metrics = None
+        self.framesCircuitos = None
 
         if self.elitismo + self.renovacion > populationSize:
             raise ValueError(
@@ -259,84 +696,167 @@ class Entrenador:
         self.individuo = None
         self.mejores = None
 
+    def evolucionar(
+            self, poblacion: List[Car],
+            circuito: Union[Circuit, List[Circuit]], generacion: int,
+            show: int = None
+            ) -> Tuple[List[Car], List[float], List[Car], bool]:
+        '''
+        Una generacion del entrenamiento: fitness, nueva poblacion,
+        metricas, mejores y listas de control.
+        Devuelve la poblacion ordenada por fitness, sus valores de fitness,
+        la nueva poblacion y si se cumple el criterio de parada
+        (nIterNoChange generaciones sin cambios)
+        '''
+        # Calculo de fitness
+        start = perf_counter()
+        poblacionSorted, fits = self.get_fitness_population(
+            poblacion, circuito, generacion, show)
+        evaluacion = perf_counter() - start
+
+        start = perf_counter()
+        poblacion = self.siguienteGeneracion(poblacionSorted, fits)
+        reproduccion = perf_counter() - start
+
+        if self.metrics is not None:
+            self.metrics.write(self.metricsRecord(
+                generacion, poblacionSorted, fits, evaluacion,
+                reproduccion))
+
+        self.mejores.append((poblacionSorted[0], fits[0]))
+        if len(self.mejores) > self.nIterNoChange:
+            self.mejores.pop(0)
+
+        self.list_best_fit_indiv.append(self.mejores[-1][1])
+        self.list_fit_med.append(np.mean(fits))
+        self.list_fit_best.append(fits[0])
+        if self.cache is not None:
+            self.list_cache_hits.append(self.cache.hitRate())
+
+        if LOG:
+            print(
+                f'Generacion {generacion}',
+                f'Mejor: {self.mejores[-1][0]}',
+                f'Con fitness {self.mejores[-1][1]}',
+                f'Fitness medio: {np.mean(fits)} ',
+                *(
+                    [f'Tiempos: {self.list_timing[-1]}']
+                    if self.timing else []),
+                '', sep='\n')
+
+        parar = False
+        if len(self.mejores) >= self.nIterNoChange:
+            if self.mejores[-1] == self.mejores[0]:
+                if LOG:
+                    print(
+                        self.nIterNoChange - 1,
+                        'generaciones sin cambios.',
+                        'Deteniendo el entrenamiento.')
+                parar = True
+
+        return poblacionSorted, fits, poblacion, parar
+
+    def siguienteGeneracion(
+            self, poblacionSorted: List[Car], fits: List[float]
+            ) -> List[Car]:
+        '''
+        Nueva poblacion a partir de la poblacion ordenada por fitness:
+        progenitores cruzados y mutados, elite y renovacion.
+        Los hijos y la elite comparten los pesos de los progenitores
+        (Car.copy con shareBrain) y solo se reservan arrays nuevos para las
+        capas que cambian en la reproduccion
+        '''
+        pobBase = self.populationSize - self.elitismo - self.renovacion
+
+        # Seleccion de progenitores
+        progenitores = self.seleccionar(poblacionSorted, fits, pobBase)
+
+        progenitores = self.reproduccion([
+            p.copy(shareBrain=True) for p in progenitores])
+
+        if self.elitismo:
+            elite, i = [], 0
+            while len(elite) < self.elitismo and i < len(poblacionSorted):
+                if poblacionSorted[i] not in elite:
+                    elite.append(poblacionSorted[i].copy(shareBrain=True))
+                i += 1
+            progenitores.extend(elite)
+        if self.renovacion:
+            progenitores.extend(self.createGeneration(self.renovacion))
+
+        return progenitores
+
+    def inmigrar(
+            self, poblacion: List[Car], migrantes: List[Car]) -> List[Car]:
+        '''
+        Sustituye (inplace) por los migrantes a los ultimos hijos de una
+        poblacion de siguienteGeneracion, sin tocar la elite ni la
+        renovacion
+        '''
+        pobBase = self.populationSize - self.elitismo - self.renovacion
+        k = min(len(migrantes), pobBase)
+        poblacion[pobBase - k:pobBase] = migrantes[:k]
+        return poblacion
+
     def train(
-            self, circuito: Circuit, starting_individuals: List[Any] = None,
-            show: int = None):
+            self, circuito: Union[Circuit, List[Circuit]],
+            starting_individuals: List[Any] = None,
+            show: int = None, resume: str = None):
         '''
+        circuito: circuito o lista de circuitos. Con varios el fitness de
+        cada individuo junta el de todos segun agregacion
         show: int, si None o 0 no se muestra, si > 0 se muestra una
         de cada <show> generaciones
+        resume: fichero de snapshot desde el que continuar el entrenamiento,
+        con el mismo resultado que si no se hubiera interrumpido
         '''
 
-        if not len(circuito.limits) or not len(circuito.reward_lines):
-            raise ValueError('Circuito sin limites o recompensas')
-
-        poblacion = self.createGeneration()  # Primera generacion
-        if starting_individuals:
-            newps = self.populationSize - len(starting_individuals)
-            poblacion = poblacion[:newps]
-            poblacion.extend(starting_individuals)
+        circuitos = self.circuitos(circuito)
+        for c in circuitos:
+            if not len(c.limits) or not len(c.reward_lines):
+                raise ValueError('Circuito sin limites o recompensas')
+        if len(circuitos) == 1:
+            circuito = circuitos[0]
+
+        if resume is not None:
+            inicio, poblacion = self.resume(resume, circuitos[0])
+        else:
+            inicio = 0
+            self.mejores = []
+            poblacion = self.createGeneration()  # Primera generacion
+            if starting_individuals:
+                newps = self.populationSize - len(starting_individuals)
+                poblacion = poblacion[:newps]
+                poblacion.extend(starting_individuals)
 
         if DEBUG:
             print(poblacion[0])
 
-        self.mejores = []
-        pobBase = self.populationSize - self.elitismo - self.renovacion
-        for generacion in range(self.maxGeneraciones):
-            # Calculo de fitness
-            poblacionSorted, fits = self.get_fitness_population(
-                poblacion, circuito, generacion, show)
+        if self.workers and self.workers > 1:
+            self.pool = ParallelFitness(circuitos, self.workers)
+        if self.metricsFile is not None:
+            self.metrics = MetricsSink(self.metricsFile, self.metricsLive)
 
-            # Seleccion de progenitores
-            if self.ruleta:
-                progenitores = self.seleccionRuleta(
-                    poblacionSorted, fits, pobBase)
-            else:
-                progenitores = poblacionSorted[:pobBase]
-
-            progenitores = self.recombinacion([
-                p.copy() for p in progenitores])
-            progenitores = self.mutacion([
-                p.copy() for p in progenitores])
-
-            if self.elitismo:
-                elite, i = [], 0
-                while len(elite) < self.elitismo and i < len(poblacionSorted):
-                    if poblacionSorted[i] not in elite:
-                        elite.append(poblacionSorted[i].copy())
-                    i += 1
-                progenitores.extend(elite)
-            if self.renovacion:
-                progenitores.extend(self.createGeneration(self.renovacion))
-
-            poblacion = progenitores
-
-            self.mejores.append((poblacionSorted[0], fits[0]))
-            if len(self.mejores) > self.nIterNoChange:
-                self.mejores.pop(0)
-
-            self.list_best_fit_indiv.append(self.mejores[-1][1])
-            self.list_fit_med.append(np.mean(fits))
-            self.list_fit_best.append(fits[0])
+        for generacion in range(inicio, self.maxGeneraciones):
+            poblacionSorted, fits, poblacion, parar = self.evolucionar(
+                poblacion, circuito, generacion, show)
+            if parar:
+                break
 
-            if LOG:
-                print(
-                    f'Generacion {generacion}',
-                    f'Mejor: {self.mejores[-1][0]}',
-                    f'Con fitness {self.mejores[-1][1]}',
-                    f'Fitness medio: {np.mean(fits)} ',
-                    '', sep='\n')
-
-            if len(self.mejores) >= self.nIterNoChange:
-                if self.mejores[-1] == self.mejores[0]:
-                    if LOG:
-                        print(
-                            self.nIterNoChange - 1,
-                            'generaciones sin cambios.',
-                            'Deteniendo el entrenamiento.')
-                    break
+            every = self.snapshotEvery
+            if every and not (generacion + 1) % every:
+                self.snapshot(generacion + 1, poblacion)
 
+        self.waitSnapshot()
         self.individuo = self.mejores[-1][0]
 
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.metrics is not None:
+            self.metrics.close()
+            self.metrics = None
+
         if DEBUG:
 
             print(
@@ -349,11 +869,149 @@ class Entrenador:
         input(
             '###  ENTRENAMIENTO TERMINADO ###\n      '
             'Enter para mostrar los resultados')
-        self.constructor.__class__.fitness([
-            m[0] for m in self.mejores], circuito, show=True)
+        for c in circuitos:
+            self.constructor.__class__.fitness([
+                m[0] for m in self.mejores], c, show=True,
+                stagnation=self.stagnation, repeat=self.repeat)
 
         return self
 
+    def circuitos(
+            self, circuito: Union[Circuit, List[Circuit]]) -> List[Circuit]:
+        '''Lista de circuitos de train, comprobando los pesos de agregacion'''
+        circuitos = (
+            list(circuito) if isinstance(circuito, (list, tuple))
+            else [circuito])
+        if not circuitos:
+            raise ValueError('Se necesita al menos un circuito')
+        if not isinstance(self.agregacion, str) and (
+                len(self.agregacion) != len(circuitos)):
+            raise ValueError('agregacion debe tener un peso por circuito')
+        return circuitos
+
+    def metricsRecord(
+            self, generacion: int, poblacionSorted: List[Car],
+            fits: List[float], evaluacion: float,
+            reproduccion: float) -> dict:
+        '''
+        Metricas de una generacion para MetricsSink. frames son los del
+        individuo que mas ha durado y cars_frames la suma de los de todos
+        (incluidos los que vienen de la cache). Con varios circuitos son la
+        suma de todos ellos, y en circuitos estan los de cada uno
+        '''
+        if self.framesCircuitos is not None:
+            frames = self.framesCircuitos.sum(axis=0).tolist()
+        else:
+            frames = [ind.aliveFrames for ind in poblacionSorted]
+        carsFrames = int(sum(frames))
+        record = {
+            'generacion': generacion,
+            'time': time(),
+            'fitness': {
+                'best': float(fits[0]),
+                'mean': float(np.mean(fits)),
+                'median': float(np.median(fits)),
+                'min': float(fits[-1]),
+                'std': float(np.std(fits)),
+            },
+            'frames': int(max(frames, default=0)),
+            'cars_frames': carsFrames,
+            'cars_frames_s': carsFrames / evaluacion if evaluacion else 0,
+            'eval_s': evaluacion,
+            'reproduccion_s': reproduccion,
+            'cache': None,
+            'max_memory_kb': maxMemory(),
+        }
+        if self.framesCircuitos is not None:
+            record['circuitos'] = [
+                {'frames': int(f.max(initial=0)), 'cars_frames': int(f.sum())}
+                for f in self.framesCircuitos]
+        if self.cache is not None:
+            record['cache'] = {
+                'hits': self.cache.hits, 'lookups': self.cache.lookups,
+                'size': len(self.cache)}
+        if self.timing and self.list_timing:
+            record['timing'] = self.list_timing[-1].asDict()
+        return record
+
+    def snapshot(self, generacion: int, poblacion: List[Car]) -> None:
+        '''
+        Guarda en snapshotFile todo lo necesario para continuar el
+        entrenamiento en la generacion <generacion> con la poblacion dada:
+        pesos, estado de los generadores aleatorios, mejores y listas de
+        fitness. Los datos se copian aqui y el fichero se escribe en otro
+        hilo, de forma atomica (checkpoint.write)
+        '''
+
+        version, state, gauss = getstate()
+        _, keys, pos, hasGauss, cachedGauss = np.random.get_state()
+        data = checkpoint.arrays(self.mejores, {
+            'generacion': generacion,
+            'random': [version, gauss],
+            'numpy': [int(pos), int(hasGauss), float(cachedGauss)],
+            'list_best_fit_indiv': self.list_best_fit_indiv,
+            'list_fit_med': self.list_fit_med,
+            'list_fit_best': self.list_fit_best,
+            'list_cache_hits': self.list_cache_hits,
+            'list_timing': [t.asDict() for t in self.list_timing],
+        }, poblacion)
+        data['random_state'] = np.array(state, dtype=np.uint32)
+        data['numpy_state'] = np.array(keys, dtype=np.uint32)
+        data['mejores_counters'] = np.array([
+            (m.nextRewardIdx, m.aliveFrames, m.lastRewardFrames)
+            for m, _ in self.mejores], dtype=np.int64).reshape((-1, 3))
+
+        # Solo una escritura a la vez, y en orden
+        self.waitSnapshot()
+        self.snapshotWriter = Thread(
+            target=checkpoint.write, args=(self.snapshotFile, data))
+        self.snapshotWriter.start()
+
+    def waitSnapshot(self) -> None:
+        '''Espera a que termine de escribirse el ultimo snapshot'''
+        if self.snapshotWriter is not None:
+            self.snapshotWriter.join()
+            self.snapshotWriter = None
+
+    def resume(
+            self, filename: str, circuito: Circuit
+            ) -> Tuple[int, List[Car]]:
+        '''
+        Recupera el estado de un fichero de snapshot.
+        Devuelve la generacion por la que continuar y su poblacion
+        '''
+
+        pos = circuito.startPoint.asTuple()
+        with checkpoint.Checkpoint(filename) as c:
+            poblacion = c.poblacion(pos)
+            if poblacion is None:
+                raise ValueError(f'{filename} no es un snapshot')
+            meta = c.metadata
+
+            self.mejores = []
+            counters = c.array('mejores_counters')
+            for i, (fit, cnt) in enumerate(zip(c.fitness.tolist(), counters)):
+                car = c.car(i, pos)
+                car.nextRewardIdx, car.aliveFrames, car.lastRewardFrames = (
+                    int(v) for v in cnt)
+                self.mejores.append((car, fit))
+
+            version, gauss = meta['random']
+            setstate((version, tuple(c.array('random_state').tolist()), gauss))
+            npos, hasGauss, cachedGauss = meta['numpy']
+            np.random.set_state((
+                'MT19937', c.array('numpy_state'),
+                npos, hasGauss, cachedGauss))
+
+        self.list_best_fit_indiv = meta['list_best_fit_indiv']
+        self.list_fit_med = meta['list_fit_med']
+        self.list_fit_best = meta['list_fit_best']
+        self.list_cache_hits = meta['list_cache_hits']
+        self.list_timing = [
+            PhaseTimes.fromDict(t) for t in meta.get('list_timing', [])]
+
+        return meta['generacion'], poblacion
+
     def createGeneration(self, n: int = None):
         '''Crea una generacion aleatoria'''
         if n is None:
@@ -366,7 +1024,8 @@ class Entrenador:
         return poblacion
 
     def get_fitness_population(
-            self, poblacion: List[Car], circuito: Circuit,
+            self, poblacion: List[Car],
+            circuito: Union[Circuit, List[Circuit]],
             generacion: int, show: int = None
             ) -> Tuple[List[Car], List[float]]:
         """
@@ -376,13 +1035,29 @@ class Entrenador:
         # Aumentamos el maximo de frames cada 5 generaciones
         maxIt = max(50 * (1 + generacion // 5), 100)
         show = show and not (generacion % show)
+        times = PhaseTimes() if self.timing else None
+        start = perf_counter()
         # Calcular lista de fitness
-        fits = self.constructor.__class__.fitness(
-            poblacion, circuito,
-            # Parametros de ajuste
-            maxIters=maxIt,
-            generacion=generacion,
-            show=show)
+        if isinstance(circuito, (list, tuple)):
+            fits = self.fitnessCircuitos(
+                poblacion, circuito, maxIt, generacion, show, times)
+        else:
+            self.framesCircuitos = None
+            fits = self.constructor.__class__.fitness(
+                poblacion, circuito,
+                # Parametros de ajuste
+                maxIters=maxIt,
+                generacion=generacion,
+                show=show,
+                pool=self.pool,
+                cache=self.cache,
+                stagnation=self.stagnation,
+                repeat=self.repeat,
+                times=times,
+                halving=self.halving)
+        if times is not None:
+            times.wall = perf_counter() - start
+            self.list_timing.append(times)
 
         # Ordenar individuos y fit por fit
         poblacion = [
@@ -395,63 +1070,104 @@ class Entrenador:
 
         return poblacion, fits
 
-    def recombinacion(
-            self, progenitores: List[Car]) -> List[Car]:
+    def fitnessCircuitos(
+            self, poblacion: List[Car], circuitos: List[Circuit],
+            maxIters: int, generacion: int, show: bool,
+            times: PhaseTimes) -> List[float]:
+        '''
+        Fitness de cada individuo en cada circuito, juntado segun
+        agregacion. Con pool (con o sin cache) todas las simulaciones de
+        todos los circuitos se reparten a la vez entre los procesos. Los
+        contadores de cada Car quedan con los del ultimo circuito, los
+        frames de cada individuo en cada circuito se guardan en
+        framesCircuitos
+        '''
+        if (self.pool is not None or self.cache is not None) and not show:
+            runs = CarConstructor.fitnessCircuitos(
+                poblacion, circuitos, maxIters, True, self.pool,
+                self.stagnation, self.repeat, self.cache, times)
+        else:
+            runs = (
+                self.constructor.__class__.fitness(
+                    poblacion, c, maxIters=maxIters, generacion=generacion,
+                    show=show, pool=self.pool, cache=self.cache,
+                    stagnation=self.stagnation, repeat=self.repeat,
+                    times=times, halving=self.halving)
+                for c in circuitos)
+
+        fits = []
+        frames = []
+        for fit in runs:
+            fits.append(fit)
+            frames.append([ind.aliveFrames for ind in poblacion])
+        self.framesCircuitos = np.array(frames, dtype=int)
+
+        fits = np.array(fits)
+        if LOG:
+            print('Mejor por circuito:', fits.max(axis=1).tolist())
+
+        if self.agregacion == 'media':
+            return fits.mean(axis=0).tolist()
+        if self.agregacion == 'minimo':
+            return fits.min(axis=0).tolist()
+        return np.average(fits, axis=0, weights=self.agregacion).tolist()
+
+    def parejas(self, n: int) -> np.ndarray:
         """
-        Con probabilidad probabCruce, cruza 2 individuos en un punto (inplace).
+        Array (k, 2) con las parejas de individuos que se cruzan: cada uno
+        con probabilidad probabCruce, emparejados en orden
         """
-        prg = progenitores
         if self.probabCruce == 0:
-            return prg
+            return np.zeros((0, 2), dtype=int)
 
-        cruz = []
-        for i in range(len(prg)):
-            r = random()
-            if r < self.probabCruce:
-                cruz.append(i)
+        cruz = np.flatnonzero(np.random.random(n) < self.probabCruce)
 
         # Numero par de individuos
         if len(cruz) % 2:
-            cruz.pop()
+            cruz = cruz[:-1]
+
+        return cruz.reshape((-1, 2))
 
-        for i in range(0, len(cruz), 2):
-            a, b = prg[cruz[i]], prg[cruz[i + 1]]
-            # Se reemplazan los progenitores por los descendientes
-            prg[cruz[i]], prg[cruz[i + 1]] = self.constructor.recombinacion(
-                a, b)
+    def reproduccion(self, progenitores: List[Car]) -> List[Car]:
+        """
+        recombinacion y mutacion (inplace) de una vez, en un solo paso del
+        constructor
+        """
+        return self.constructor.reproduccion(
+            progenitores, self.parejas(len(progenitores)), self.mutationRate)
 
-        return prg
+    def recombinacion(
+            self, progenitores: List[Car]) -> List[Car]:
+        """
+        Con probabilidad probabCruce, cruza 2 individuos en un punto (inplace).
+        """
+        # Se reemplazan los progenitores por los descendientes
+        return self.constructor.recombinacionPoblacion(
+            progenitores, self.parejas(len(progenitores)))
 
     def mutacion(self, poblacion) -> List:
-        for i in range(len(poblacion)):
-            poblacion[i] = self.constructor.mutacion(
-                poblacion[i], self.mutationRate)
+        return self.constructor.mutacionPoblacion(
+            poblacion, self.mutationRate)
 
-        return poblacion
+    def seleccionar(
+            self, poblacion: List[Any],
+            fits: List[float], n: int) -> List[Any]:
+        """
+        Devuelve una lista con los n progenitores escogidos con el metodo
+        de seleccion (la poblacion esta ordenada por fitness)
+        """
+        if self.seleccion == 'torneo':
+            idx = METODOS['torneo'](fits, n, self.torneo)
+        else:
+            idx = METODOS[self.seleccion](fits, n)
+
+        return [poblacion[i] for i in idx.tolist()]
 
     def seleccionRuleta(
-            self, poblacion: List[int],
+            self, poblacion: List[Any],
             fits: List[float], n: int) -> List[Any]:
         """
         Devuelve una lista con los progenitores escogidos
         proporcionalmente a sus valores de fitness.
         """
-
-        # Calcular fit acumulado y pasarlo a rango [0, 1]
-        fits = [fits[i] + fits[i - 1] for i in range(1, len(fits))]
-        if fits[-1] == 0:
-            return poblacion[:n]
-        for i in range(len(fits)):
-            fits[i] /= fits[-1]
-
-        progenitores = []  # Escoger n progenitores
-        while len(progenitores) < n:
-            r = random()
-            new = poblacion[0]
-            for ind, f in zip(poblacion, fits):
-                if r > f:
-                    break
-                new = ind
-            progenitores.append(new)
-
-        return progenitores
+        return [poblacion[i] for i in METODOS['ruleta'](fits, n).tolist()]
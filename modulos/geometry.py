@@ -1,10 +1,13 @@
 
-from typing import Tuple, Union
+from typing import TYPE_CHECKING, Tuple, Union
 from math import cos, pi, sin
-import pygame as pg
+import numpy as np
 
 from modulos.constants import error
 
+if TYPE_CHECKING:
+    import pygame as pg
+
 
 class Point():
 
@@ -126,8 +129,12 @@ class Line():
             f'{self.__class__.__name__}'
             f'{(self.a.x, self.a.y, self.b.x, self.b.y)}')
 
-    def draw(self, surface: pg.Surface, color: Tuple[int, int, int]):
-        pg.draw.line(
+    def draw(
+            self, surface: 'pg.Surface',
+            color: Tuple[int, int, int]) -> 'pg.Rect':
+        import pygame as pg
+
+        return pg.draw.line(
             surface, color,
             self.a.asTuple(), self.b.asTuple(), width=2)
 
@@ -191,6 +198,168 @@ class Line():
         return p
 
 
+class PointView(Point):
+    '''
+    Punto cuyas coordenadas se leen y se escriben en una fila de
+    SegmentArray (columnas col y col + 1)
+    '''
+
+    def __init__(self, owner: 'SegmentArray', row: int, col: int) -> None:
+        self.owner = owner
+        self.row = row
+        self.col = col
+
+    @property
+    def x(self) -> float:
+        return float(self.owner.buffer[self.row, self.col])
+
+    @x.setter
+    def x(self, value: float) -> None:
+        self.owner.buffer[self.row, self.col] = value
+        self.owner.changed()
+
+    @property
+    def y(self) -> float:
+        return float(self.owner.buffer[self.row, self.col + 1])
+
+    @y.setter
+    def y(self, value: float) -> None:
+        self.owner.buffer[self.row, self.col + 1] = value
+        self.owner.changed()
+
+
+class LineView(Line):
+    '''Line sobre una fila de SegmentArray, sin copiar sus coordenadas'''
+
+    def __init__(self, owner: 'SegmentArray', row: int) -> None:
+        self.a = PointView(owner, row, 0)
+        self.b = PointView(owner, row, 2)
+
+
+class SegmentArray():
+    '''
+    Conjunto de segmentos guardado como un array (N, 4) de
+    (ax, ay, bx, by), con sus vectores de direccion, longitudes y
+    rectangulos envolventes calculados una vez por cada cambio.
+    Se comporta como una lista de Line: len, indices, iteracion, append y
+    pop devuelven o reciben objetos Line (LineView) que leen y escriben
+    directamente en el array
+    '''
+
+    buffer: np.ndarray
+    size: int
+    version: int
+
+    def __init__(self, segments: Union[None, np.ndarray] = None) -> None:
+        '''segments: array (N, 4) que pasa a ser el almacenamiento'''
+
+        if segments is None:
+            segments = np.zeros((0, 4), dtype=float)
+        self.buffer = np.asarray(segments, dtype=float).reshape((-1, 4))
+        self.size = len(self.buffer)
+        self.version = 0
+        self.derived = {}
+
+    @property
+    def data(self) -> np.ndarray:
+        '''Array (N, 4) con los segmentos, sin copia'''
+        return self.buffer[:self.size]
+
+    def changed(self) -> None:
+        '''Descarta los datos derivados tras modificar los segmentos'''
+        self.version += 1
+        self.derived = {}
+
+    def derive(self, key: str, function) -> np.ndarray:
+        if key not in self.derived:
+            self.derived[key] = function(self.data)
+        return self.derived[key]
+
+    def direction(self) -> np.ndarray:
+        '''Array (N, 2) con b - a de cada segmento'''
+        return self.derive('direction', lambda d: d[:, 2:] - d[:, :2])
+
+    def length(self) -> np.ndarray:
+        '''Array (N, ) con la longitud de cada segmento'''
+        return self.derive('length', lambda d: np.hypot(
+            *self.direction().T))
+
+    def bbox(self) -> np.ndarray:
+        '''Array (N, 4) con (minx, miny, maxx, maxy) de cada segmento'''
+        return self.derive('bbox', lambda d: np.hstack((
+            np.minimum(d[:, :2], d[:, 2:]), np.maximum(d[:, :2], d[:, 2:]))))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> LineView:
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError('SegmentArray index out of range')
+        return LineView(self, i)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield LineView(self, i)
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}({self.size} segmentos)'
+
+    def append(self, line: Line) -> None:
+        if self.size == len(self.buffer):
+            # Se duplica la capacidad para que anadir sea O(1) amortizado
+            new = np.zeros((max(2 * self.size, 16), 4), dtype=float)
+            new[:self.size] = self.data
+            self.buffer = new
+        self.buffer[self.size] = (line.a.x, line.a.y, line.b.x, line.b.y)
+        self.size += 1
+        self.changed()
+
+    def pop(self, i: int = -1) -> Line:
+        line = self[i]
+        line = Line(line.a.copy(), line.b.copy())
+        self.removeMask(np.arange(self.size) == (i % self.size))
+        return line
+
+    def removeMask(self, mask: np.ndarray) -> int:
+        '''Elimina los segmentos marcados, devuelve cuantos'''
+        rem = int(np.count_nonzero(mask))
+        if rem:
+            self.buffer = self.data[~mask].copy()
+            self.size = len(self.buffer)
+            self.changed()
+        return rem
+
+    def addOffset(self, x: float = 0, y: float = 0) -> None:
+        self.data[:, 0::2] += x
+        self.data[:, 1::2] += y
+        self.changed()
+
+    def scale(self, factor: Union[float, Tuple[float, float]]) -> None:
+        if type(factor) is tuple:
+            xf, yf = factor
+        else:
+            xf, yf = factor, factor
+
+        self.data[:, 0::2] *= xf
+        self.data[:, 1::2] *= yf
+        self.changed()
+
+    def inRadius(self, point: Point, radius: float) -> np.ndarray:
+        '''
+        Mascara de los segmentos con algun extremo dentro del radio,
+        como Point.inRadius
+        '''
+        d = self.data
+        r2 = radius * radius
+        inside = np.zeros((self.size, ), dtype=bool)
+        for col in (0, 2):
+            a, b = d[:, col] - point.x, d[:, col + 1] - point.y
+            inside |= (a * a + b * b) < r2
+        return inside
+
+
 '''Formas con area'''
 
 
@@ -213,7 +382,8 @@ class Shape():
     def addOffset(self, x: float, y: float) -> None:
         raise NotImplementedError()
 
-    def draw(self, surface: pg.Surface, color: Tuple[int, int, int]) -> None:
+    def draw(
+            self, surface: 'pg.Surface', color: Tuple[int, int, int]) -> None:
         raise NotImplementedError()
 
     def rotateDegree(self, angle: float) -> None:
@@ -298,7 +468,220 @@ class Circle(Shape):
         c.direction = self.direction.copy()
         return c
 
-    def draw(self, surface: pg.Surface, color: Tuple[int, int, int]):
-        pg.draw.circle(
+    def draw(
+            self, surface: 'pg.Surface',
+            color: Tuple[int, int, int]) -> 'pg.Rect':
+        import pygame as pg
+
+        return pg.draw.circle(
             surface, color,
             self.center.asTuple(), self.radius, width=0)
+
+
+'''Operaciones vectorizadas'''
+
+# Las funciones siguientes reproducen con arrays de numpy las operaciones de
+# Point, Line y Circle, con el mismo orden de operaciones para obtener los
+# mismos resultados. Los argumentos se combinan con broadcasting, de modo que
+# sirven tanto para un coche contra todos los segmentos como para toda la
+# poblacion a la vez.
+
+
+def rotationConstants(
+        angles: Union[float, Tuple[float, ...]]
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    (cos, sin) de los angulos en grados, calculados igual que en
+    Point.rotateDegree
+    '''
+    rads = [an * (pi / 180) for an in np.atleast_1d(angles).tolist()]
+    c = np.array([cos(an) for an in rads], dtype=float)
+    s = np.array([sin(an) for an in rads], dtype=float)
+    if np.ndim(angles):
+        return c, s
+    return c[0], s[0]
+
+
+def power(x: np.ndarray, exponent: float) -> np.ndarray:
+    '''
+    Equivalente a "x ** exponent" de python. np.float_power usa la pow de la
+    libm igual que python (np.power y ** de numpy usan aproximaciones propias)
+    '''
+    return np.float_power(x, exponent)
+
+
+def rotateArrays(
+        x: np.ndarray, y: np.ndarray,
+        c: Union[float, np.ndarray], s: Union[float, np.ndarray]
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Point.rotateRadians sobre arrays, con c = cos(angulo) y s = sin(angulo)
+    '''
+    rx = c * x - s * y
+    ry = s * x + c * y
+
+    m = power(power(x, 2) + power(y, 2), 0.5) / power(
+        power(rx, 2) + power(ry, 2), 0.5)
+    return rx * m, ry * m
+
+
+def circleTouchingSegments(
+        cx: np.ndarray, cy: np.ndarray, radius: float,
+        ax: np.ndarray, ay: np.ndarray, bx: np.ndarray, by: np.ndarray
+        ) -> np.ndarray:
+    '''
+    Circle.touchingLine para cada combinacion de circulo (cx, cy) y
+    segmento (ax, ay) - (bx, by)
+    '''
+    r = radius
+    r2 = r * r
+
+    fast = ~(
+        ((ax > cx + r) & (bx > cx + r)) | ((ax < cx - r) & (bx < cx - r)) |
+        ((ay > cy + r) & (by > cy + r)) | ((ay < cy - r) & (by < cy - r)))
+
+    dax, day = ax - cx, ay - cy
+    dbx, dby = bx - cx, by - cy
+    ends = ((dax * dax + day * day) <= r2) | ((dbx * dbx + dby * dby) <= r2)
+
+    vx, vy = bx - ax, by - ay
+    vy2, vx2 = vy * vy, vx * vx
+    vxy = vx * vy
+
+    up = vxy * (cy - ay) + (vy2 * ax + vx2 * cx)
+    do = vy2 + vx2
+
+    # Proyeccion del punto sobre la linea
+    do = np.where(do == 0, 0.000001, do)
+    x = up / do
+    vy = np.where(vy == 0, 0.000001, vy)
+    y = cy - ((vx / vy) * (x - cx))
+
+    px, py = x - cx, y - cy
+    proj = (px * px + py * py) <= r2
+
+    return fast & (ends | proj)
+
+
+def pointSegmentsDistance2(
+        x: np.ndarray, y: np.ndarray,
+        ax: np.ndarray, ay: np.ndarray, bx: np.ndarray, by: np.ndarray
+        ) -> np.ndarray:
+    '''
+    Distancia al cuadrado de cada punto (x, y) al punto mas cercano de cada
+    segmento (ax, ay) - (bx, by)
+    '''
+    vx, vy = bx - ax, by - ay
+    wx, wy = x - ax, y - ay
+    do = np.asarray(vx * vx + vy * vy, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(np.where(do == 0, 0, (wx * vx + wy * vy) / do), 0, 1)
+    dx, dy = wx - t * vx, wy - t * vy
+    return dx * dx + dy * dy
+
+
+def capsuleTouchingSegments(
+        px: np.ndarray, py: np.ndarray, qx: np.ndarray, qy: np.ndarray,
+        radius: float,
+        ax: np.ndarray, ay: np.ndarray, bx: np.ndarray, by: np.ndarray
+        ) -> np.ndarray:
+    '''
+    Para cada combinacion de desplazamiento (px, py) - (qx, qy) de un
+    circulo de radio radius y segmento (ax, ay) - (bx, by), True si el
+    circulo toca el segmento en algun punto del desplazamiento (la capsula
+    que barre el circulo corta el segmento)
+    '''
+    r2 = radius * radius
+
+    # Los dos segmentos se cortan
+    ux, uy = qx - px, qy - py
+    vx, vy = bx - ax, by - ay
+    d1 = vx * (py - ay) - vy * (px - ax)
+    d2 = vx * (qy - ay) - vy * (qx - ax)
+    d3 = ux * (ay - py) - uy * (ax - px)
+    d4 = ux * (by - py) - uy * (bx - px)
+    cross = (d1 * d2 < 0) & (d3 * d4 < 0)
+
+    # Si no se cortan la distancia minima es la de algun extremo
+    near = (
+        (pointSegmentsDistance2(px, py, ax, ay, bx, by) <= r2) |
+        (pointSegmentsDistance2(qx, qy, ax, ay, bx, by) <= r2) |
+        (pointSegmentsDistance2(ax, ay, px, py, qx, qy) <= r2) |
+        (pointSegmentsDistance2(bx, by, px, py, qx, qy) <= r2))
+
+    return cross | near
+
+
+def raySegmentsDistance(
+        cx: np.ndarray, cy: np.ndarray, dx: np.ndarray, dy: np.ndarray,
+        ax: np.ndarray, ay: np.ndarray, bx: np.ndarray, by: np.ndarray
+        ) -> np.ndarray:
+    '''
+    Distancia desde (cx, cy) al punto de Line.intersection entre cada
+    segmento (ax, ay) - (bx, by) y el rayo (cx, cy) - (dx, dy).
+    Devuelve inf donde no hay interseccion
+    '''
+    cd_x, cd_y = dx - cx, dy - cy
+    ab_x, ab_y = bx - ax, by - ay
+
+    ab_cross_cd = ab_x * cd_y - ab_y * cd_x
+
+    ac_x, ac_y = cx - ax, cy - ay
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (ac_x * cd_y - ac_y * cd_x) / ab_cross_cd
+        t2 = (ab_y * ac_x - ab_x * ac_y) / ab_cross_cd
+        px, py = ax + ab_x * t1, ay + ab_y * t1
+
+    hit = (ab_cross_cd != 0) & (t1 <= 1) & (t1 >= 0) & (t2 <= 1) & (t2 >= 0)
+
+    a, b = cx - px, cy - py
+    dis = power(a * a + b * b, 0.5)
+
+    return np.where(hit, dis, np.inf)
+
+
+def sensorRays(
+        dx: np.ndarray, dy: np.ndarray,
+        rotations: Tuple[np.ndarray, np.ndarray]
+        ) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Extremo del rayo de Car.getDistanceOnAngle para la direccion (dx, dy)
+    y cada rotacion (cos, sin). Forma (*forma de dx, numero de rotaciones)
+    '''
+    dx, dy = (np.asarray(v, dtype=float)[..., None] for v in (dx, dy))
+    c, s = rotations
+
+    rx, ry = rotateArrays(dx, dy, c, s)
+    rx, ry = rx * 10000, ry * 10000
+    return rx + rx, ry + ry
+
+
+def sensorDistances(
+        cx: np.ndarray, cy: np.ndarray, dx: np.ndarray, dy: np.ndarray,
+        rotations: Tuple[np.ndarray, np.ndarray], segments: np.ndarray,
+        grid=None) -> np.ndarray:
+    '''
+    Distancias de los sensores de uno o varios coches en una sola operacion.
+    Para cada coche en (cx, cy) con direccion (dx, dy) y cada rotacion
+    (cos, sin) lanza el rayo de Car.getDistanceOnAngle contra todos los
+    segmentos (array (N, 4)) y devuelve la distancia al corte mas cercano,
+    o 999999 si no corta ninguno.
+    Si se da grid (SegmentGrid de los segmentos) los rayos solo comprueban
+    los segmentos de las celdas que cruzan (o un DistanceField, que avanza
+    a saltos y solo corta los segmentos cercanos).
+    Devuelve un array con forma (*forma de cx, numero de rotaciones)
+    '''
+    rx, ry = sensorRays(dx, dy, rotations)
+    if not len(segments):
+        return np.full(rx.shape, 999999, dtype=float)
+
+    cx, cy = (np.asarray(v, dtype=float)[..., None] for v in (cx, cy))
+    if grid is not None:
+        dis = grid.castRays(cx, cy, rx, ry)
+    else:
+        ax, ay, bx, by = segments.T
+        dis = raySegmentsDistance(
+            cx[..., None], cy[..., None], rx[..., None], ry[..., None],
+            ax, ay, bx, by).min(axis=-1)
+
+    return np.where(np.isinf(dis), 999999, dis)
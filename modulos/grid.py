@@ -0,0 +1,349 @@
+from typing import List, Union
+from math import floor, inf
+import numpy as np
+
+from modulos.geometry import (
+    SegmentArray, capsuleTouchingSegments, circleTouchingSegments,
+    raySegmentsDistance)
+
+
+class SegmentGrid():
+    '''
+    Rejilla uniforme sobre un conjunto de segmentos para acelerar las
+    consultas de colision y de rayos.
+    Cada celda guarda los indices de los segmentos cuyo rectangulo
+    envolvente la toca. Los resultados son los mismos que comprobando
+    todos los segmentos, porque solo se descartan segmentos que no pueden
+    cortar o tocar
+    '''
+
+    segments: np.ndarray
+    cellSize: float
+    minx: float
+    miny: float
+    nx: int
+    ny: int
+    cells: np.ndarray
+    cellLists: List[List[int]]
+    segmentList: List[List[float]]
+
+    MARGIN = 0.001
+    '''Margen con el que se registran los segmentos en las celdas'''
+
+    FAR = 1e18
+    '''Coordenada del segmento de relleno, que nunca toca ni corta nada'''
+
+    def __init__(
+            self, segments: Union[SegmentArray, np.ndarray],
+            cellSize: Union[float, None] = None,
+            cells: Union[np.ndarray, None] = None) -> None:
+        '''
+        - segments: SegmentArray o array (N, 4) con los segmentos
+            (ax, ay, bx, by)
+        - cellSize: lado de cada celda, por defecto el doble de la
+            longitud mediana de los segmentos
+        - cells: tabla de celdas ya calculada (de una rejilla con los
+            mismos segmentos y cellSize), por ejemplo de un circuito
+            compilado. Si no encaja con la rejilla se calcula de nuevo
+        '''
+
+        if not isinstance(segments, SegmentArray):
+            segments = SegmentArray(segments)
+        bbox = segments.bbox()
+        n = len(segments)
+
+        if cellSize is None:
+            cellSize = 2 * float(np.median(segments.length())) if n else 1
+        self.cellSize = cellSize = max(float(cellSize), 1)
+        segments = segments.data
+
+        # Segmento de relleno al final para las celdas con menos segmentos
+        self.segments = np.vstack((segments, np.full((1, 4), self.FAR)))
+
+        if n:
+            minx, miny = bbox[:, :2].min(axis=0)
+            maxx, maxy = bbox[:, 2:].max(axis=0)
+        else:
+            minx = miny = maxx = maxy = 0
+        self.minx, self.miny = minx - cellSize, miny - cellSize
+        self.nx = int((maxx - self.minx) // cellSize) + 2
+        self.ny = int((maxy - self.miny) // cellSize) + 2
+
+        ncells = self.nx * self.ny
+        if cells is not None and len(cells) == ncells:
+            self.cells = cells
+            counts = (cells != n).sum(axis=1)
+        else:
+            counts = self.buildCells(bbox, n)
+
+        # Version en listas para las consultas de un solo coche
+        self.cellLists = [
+            row[:cnt] for row, cnt in zip(
+                self.cells.tolist(), counts.tolist())]
+        self.segmentList = segments.tolist()
+
+    def buildCells(self, bbox: np.ndarray, n: int) -> np.ndarray:
+        '''
+        Calcula la tabla de celdas, devuelve el numero de segmentos de cada
+        celda
+        '''
+
+        # Celdas que toca el rectangulo envolvente de cada segmento
+        x0, x1 = self.cellRange(bbox[:, 0], bbox[:, 2], self.minx, self.nx)
+        y0, y1 = self.cellRange(bbox[:, 1], bbox[:, 3], self.miny, self.ny)
+
+        segIdx, cellIdx = [], []
+        for dx in range(int((x1 - x0).max(initial=0)) + 1):
+            for dy in range(int((y1 - y0).max(initial=0)) + 1):
+                ok = (x0 + dx <= x1) & (y0 + dy <= y1)
+                segIdx.append(np.flatnonzero(ok))
+                cellIdx.append((x0 + dx)[ok] * self.ny + (y0 + dy)[ok])
+        segIdx = np.concatenate(segIdx) if n else np.zeros(0, dtype=int)
+        cellIdx = np.concatenate(cellIdx) if n else np.zeros(0, dtype=int)
+
+        # Tabla (celdas, K) con los segmentos de cada celda, rellena con n
+        ncells = self.nx * self.ny
+        counts = np.bincount(cellIdx, minlength=ncells)
+        order = np.argsort(cellIdx, kind='stable')
+        cellIdx, segIdx = cellIdx[order], segIdx[order]
+        starts = np.cumsum(counts) - counts
+        col = np.arange(len(cellIdx)) - starts[cellIdx]
+
+        self.cells = np.full((ncells, max(int(counts.max()), 1)), n)
+        self.cells[cellIdx, col] = segIdx
+
+        return counts
+
+    def cellRange(
+            self, low: np.ndarray, high: np.ndarray,
+            origin: float, ncells: int):
+        '''Indices de la primera y la ultima celda entre low y high'''
+        first = np.floor((low - self.MARGIN - origin) / self.cellSize)
+        last = np.floor((high + self.MARGIN - origin) / self.cellSize)
+        return (
+            np.clip(first, 0, ncells - 1).astype(int),
+            np.clip(last, 0, ncells - 1).astype(int))
+
+    def nearSegments(
+            self, x: np.ndarray, y: np.ndarray, radius: float) -> np.ndarray:
+        '''
+        Array (*forma de x, K) con los indices de los segmentos candidatos a
+        tocar el circulo de centro (x, y). Los huecos se rellenan con el
+        indice del segmento de relleno
+        '''
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        x0, x1 = self.cellRange(x - radius, x + radius, self.minx, self.nx)
+        y0, y1 = self.cellRange(y - radius, y + radius, self.miny, self.ny)
+
+        span = int(np.ceil(2 * (radius + self.MARGIN) / self.cellSize)) + 1
+        near = []
+        for dx in range(span):
+            for dy in range(span):
+                cell = np.minimum(x0 + dx, x1) * self.ny + np.minimum(
+                    y0 + dy, y1)
+                near.append(self.cells[cell])
+
+        return np.concatenate(near, axis=-1)
+
+    def nearIndices(self, x: float, y: float, radius: float) -> List[int]:
+        '''Indices (sin repetir) de los segmentos cercanos a un circulo'''
+        cs, m = self.cellSize, self.MARGIN
+        x0 = min(max(floor((x - radius - m - self.minx) / cs), 0), self.nx - 1)
+        x1 = min(max(floor((x + radius + m - self.minx) / cs), 0), self.nx - 1)
+        y0 = min(max(floor((y - radius - m - self.miny) / cs), 0), self.ny - 1)
+        y1 = min(max(floor((y + radius + m - self.miny) / cs), 0), self.ny - 1)
+
+        if x0 == x1 and y0 == y1:
+            return self.cellLists[x0 * self.ny + y0]
+
+        near = set()
+        for ix in range(x0, x1 + 1):
+            for iy in range(y0, y1 + 1):
+                near.update(self.cellLists[ix * self.ny + iy])
+        return sorted(near)
+
+    def castRay(self, cx: float, cy: float, dx: float, dy: float) -> float:
+        '''
+        castRays para un solo rayo, sin numpy. Las intersecciones se
+        calculan igual que Line.intersection
+        '''
+        vx, vy = dx - cx, dy - cy
+        length = (vx * vx + vy * vy) ** 0.5
+        cs = self.cellSize
+
+        # Tramo [t0, t1] del rayo dentro de la rejilla
+        t0, t1 = 0, 1
+        for c, v, low, n in (
+                (cx, vx, self.minx, self.nx), (cy, vy, self.miny, self.ny)):
+            high = low + n * cs
+            if not v:
+                if c < low or c > high:
+                    return inf
+                continue
+            ta, tb = (low - c) / v, (high - c) / v
+            t0, t1 = max(t0, min(ta, tb)), min(t1, max(ta, tb))
+        if t0 > t1:
+            return inf
+
+        ix = min(max(floor((cx + vx * t0 - self.minx) / cs), 0), self.nx - 1)
+        iy = min(max(floor((cy + vy * t0 - self.miny) / cs), 0), self.ny - 1)
+        stepx, stepy = (1 if vx > 0 else -1), (1 if vy > 0 else -1)
+        tmaxx = (
+            (self.minx + (ix + (vx > 0)) * cs - cx) / vx if vx else inf)
+        tmaxy = (
+            (self.miny + (iy + (vy > 0)) * cs - cy) / vy if vy else inf)
+        tdx = cs / abs(vx) if vx else inf
+        tdy = cs / abs(vy) if vy else inf
+
+        # Holgura para los errores de redondeo de la distancia
+        slack = length * 1e-9 + self.MARGIN
+        cd_x, cd_y = dx - cx, dy - cy
+        best = inf
+        while True:
+            for i in self.cellLists[ix * self.ny + iy]:
+                # Line.intersection y Point.distance
+                a_x, a_y, b_x, b_y = self.segmentList[i]
+                ab_x, ab_y = b_x - a_x, b_y - a_y
+                ab_cross_cd = ab_x * cd_y - ab_y * cd_x
+                if not ab_cross_cd:
+                    continue
+                ac_x, ac_y = cx - a_x, cy - a_y
+                t1_ = (ac_x * cd_y - ac_y * cd_x) / ab_cross_cd
+                t2_ = (ab_y * ac_x - ab_x * ac_y) / ab_cross_cd
+                if t1_ > 1 or t1_ < 0 or t2_ > 1 or t2_ < 0:
+                    continue
+                a, b = cx - (a_x + ab_x * t1_), cy - (a_y + ab_y * t1_)
+                dis = (a * a + b * b) ** 0.5
+                if dis < best:
+                    best = dis
+
+            texit = min(tmaxx, tmaxy, t1)
+            if texit >= t1 or best < texit * length - slack:
+                return best
+
+            if tmaxx < tmaxy:
+                ix += stepx
+                tmaxx += tdx
+            else:
+                iy += stepy
+                tmaxy += tdy
+            if ix < 0 or ix >= self.nx or iy < 0 or iy >= self.ny:
+                return best
+
+    def touchingCircle(
+            self, x: np.ndarray, y: np.ndarray, radius: float) -> np.ndarray:
+        '''
+        Circle.touchingLine del circulo de centro (x, y) contra todos los
+        segmentos, comprobando solo los cercanos
+        '''
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        ax, ay, bx, by = np.moveaxis(
+            self.segments[self.nearSegments(x, y, radius)], -1, 0)
+
+        return circleTouchingSegments(
+            x[..., None], y[..., None], radius, ax, ay, bx, by).any(axis=-1)
+
+    def touchingCapsule(
+            self, px: np.ndarray, py: np.ndarray,
+            qx: np.ndarray, qy: np.ndarray, radius: float) -> np.ndarray:
+        '''
+        capsuleTouchingSegments del desplazamiento (px, py) - (qx, qy)
+        contra todos los segmentos, comprobando solo los cercanos
+        '''
+        px, py = np.asarray(px, dtype=float), np.asarray(py, dtype=float)
+        qx, qy = np.asarray(qx, dtype=float), np.asarray(qy, dtype=float)
+        if not px.size:
+            return np.zeros(px.shape, dtype=bool)
+
+        # Circulo que contiene la capsula
+        mx, my = (px + qx) / 2, (py + qy) / 2
+        half = float(np.max(np.hypot(qx - px, qy - py))) / 2
+        ax, ay, bx, by = np.moveaxis(
+            self.segments[self.nearSegments(mx, my, radius + half)], -1, 0)
+
+        return capsuleTouchingSegments(
+            px[..., None], py[..., None], qx[..., None], qy[..., None],
+            radius, ax, ay, bx, by).any(axis=-1)
+
+    def castRays(
+            self, cx: np.ndarray, cy: np.ndarray,
+            dx: np.ndarray, dy: np.ndarray) -> np.ndarray:
+        '''
+        Distancia desde (cx, cy) al corte mas cercano del rayo
+        (cx, cy) - (dx, dy) con los segmentos, inf si no corta ninguno.
+        Todos los rayos recorren a la vez las celdas que cruzan (DDA) y cada
+        rayo se detiene en cuanto el corte encontrado esta antes del final
+        de la celda actual
+        '''
+        shape = np.broadcast(cx, cy, dx, dy).shape
+        cx, cy, dx, dy = (
+            np.broadcast_to(np.asarray(v, dtype=float), shape).ravel()
+            for v in (cx, cy, dx, dy))
+
+        best = np.full(cx.shape, np.inf)
+        vx, vy = dx - cx, dy - cy
+        length = np.hypot(vx, vy)
+        cs = self.cellSize
+
+        # Tramo [t0, t1] del rayo dentro de la rejilla
+        t0, t1 = np.zeros(cx.shape), np.ones(cx.shape)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for c, v, low, n in (
+                    (cx, vx, self.minx, self.nx),
+                    (cy, vy, self.miny, self.ny)):
+                ta = (low - c) / v
+                tb = (low + n * cs - c) / v
+                inside = (c >= low) & (c <= low + n * cs)
+                t0 = np.where(v == 0, t0, np.maximum(t0, np.minimum(ta, tb)))
+                t1 = np.where(v == 0, np.where(inside, t1, -1), np.minimum(
+                    t1, np.maximum(ta, tb)))
+
+            active = np.flatnonzero(t0 <= t1)
+            cx, cy, dx, dy = cx[active], cy[active], dx[active], dy[active]
+            vx, vy, t1 = vx[active], vy[active], t1[active]
+            length = length[active]
+            # Holgura para los errores de redondeo de la distancia
+            slack = length * 1e-9 + self.MARGIN
+
+            # Celda inicial y parametros del DDA
+            t = t0[active]
+            ix = np.clip(np.floor(
+                (cx + vx * t - self.minx) / cs), 0, self.nx - 1).astype(int)
+            iy = np.clip(np.floor(
+                (cy + vy * t - self.miny) / cs), 0, self.ny - 1).astype(int)
+            stepx, stepy = np.where(vx > 0, 1, -1), np.where(vy > 0, 1, -1)
+            nextx = self.minx + (ix + (vx > 0)) * cs
+            nexty = self.miny + (iy + (vy > 0)) * cs
+            tmaxx = np.where(vx == 0, np.inf, (nextx - cx) / vx)
+            tmaxy = np.where(vy == 0, np.inf, (nexty - cy) / vy)
+            tdx = np.where(vx == 0, np.inf, cs / np.abs(vx))
+            tdy = np.where(vy == 0, np.inf, cs / np.abs(vy))
+
+        found = np.full(len(active), np.inf)
+        while len(active):
+            ax, ay, bx, by = np.moveaxis(
+                self.segments[self.cells[ix * self.ny + iy]], -1, 0)
+            dis = raySegmentsDistance(
+                cx[:, None], cy[:, None], dx[:, None], dy[:, None],
+                ax, ay, bx, by).min(axis=1)
+            found = np.minimum(found, dis)
+
+            texit = np.minimum(np.minimum(tmaxx, tmaxy), t1)
+            goon = (texit < t1) & ~(found < texit * length - slack)
+
+            movex = tmaxx < tmaxy
+            ix = np.where(movex, ix + stepx, ix)
+            iy = np.where(movex, iy, iy + stepy)
+            tmaxx = np.where(movex, tmaxx + tdx, tmaxx)
+            tmaxy = np.where(movex, tmaxy, tmaxy + tdy)
+            goon &= (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+            best[active[~goon]] = found[~goon]
+
+            (
+                active, cx, cy, dx, dy, t1, length, slack, ix, iy,
+                stepx, stepy, tmaxx, tmaxy, tdx, tdy, found) = (
+                v[goon] for v in (
+                    active, cx, cy, dx, dy, t1, length, slack, ix, iy,
+                    stepx, stepy, tmaxx, tmaxy, tdx, tdy, found))
+
+        return best.reshape(shape)
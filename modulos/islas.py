@@ -0,0 +1,240 @@
+'''
+Modelo de islas: varias poblaciones que evolucionan por separado, cada una
+en su propio proceso con su Entrenador (y sus propios hiperparametros), y
+que cada cierto numero de generaciones envian copias de sus mejores
+individuos a la siguiente isla del anillo. Un coordinador en el proceso
+principal recoge el progreso de cada isla y los mejores individuos de
+todas.
+'''
+from typing import Any, Dict, List, Tuple, Union
+from multiprocessing import Process, Queue
+from queue import Empty
+from random import seed as randomSeed
+from time import perf_counter
+import signal
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos import entrenador
+from modulos.entrenador import CarConstructor, Entrenador
+from modulos.parallel import buildCircuit, circuitArgs
+
+MIGRATION_TIMEOUT = 600
+'''Segundos maximos de espera a los migrantes de la isla anterior'''
+
+
+def carFromPesos(pesos: List[np.ndarray], pos: Tuple[float, float]) -> Car:
+    car = Car(pos, None, None, True)
+    car.brain.pesos = pesos
+    return car
+
+
+def runIsland(
+        indice: int, circuitArgs: tuple, constructor: CarConstructor,
+        params: Dict[str, Any], generaciones: int, every: int,
+        migrantes: int, seed: Union[None, int],
+        inbox: Queue, outbox: Queue, results: Queue) -> None:
+    '''
+    Proceso de una isla: Entrenador.evolucionar en cada generacion y,
+    cada <every> generaciones, envia a outbox los pesos de sus <migrantes>
+    mejores individuos y los sustituye en su poblacion por los que llegan
+    a inbox. Informa de cada generacion y de sus mejores al final por
+    results
+    '''
+
+    # Ctrl-C solo lo gestiona el proceso principal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    entrenador.LOG = entrenador.DEBUG = False
+    if seed is not None:
+        randomSeed(seed + indice)
+        np.random.seed(seed + indice)
+
+    try:
+        circuito = buildCircuit(*circuitArgs)
+        pos = circuito.startPoint.asTuple()
+        e = Entrenador(constructor, maxGeneraciones=generaciones, **params)
+        e.mejores = []
+        poblacion = e.createGeneration()
+
+        for generacion in range(generaciones):
+            start = perf_counter()
+            poblacionSorted, fits, poblacion, _ = e.evolucionar(
+                poblacion, circuito, generacion)
+            results.put(('generacion', indice, generacion, {
+                'best': fits[0], 'mean': float(np.mean(fits)),
+                'evaluaciones': len(fits),
+                'seconds': perf_counter() - start}))
+
+            if every and not (generacion + 1) % every and (
+                    generacion + 1 < generaciones):
+                outbox.put([
+                    ind.brain.pesos for ind in poblacionSorted[:migrantes]])
+                llegan = inbox.get(timeout=MIGRATION_TIMEOUT)
+                e.inmigrar(poblacion, [carFromPesos(p, pos) for p in llegan])
+
+        results.put(('fin', indice, [
+            (car.brain.pesos, fit) for car, fit in e.mejores]))
+
+    except Exception as exc:
+        results.put(('error', indice, repr(exc)))
+        raise
+
+
+class Islas():
+    '''
+    Coordinador del modelo de islas. Cada isla es un Entrenador con los
+    parametros comunes y los de parametros[i], en su propio proceso
+    '''
+
+    constructor: CarConstructor
+    islas: int
+    maxGeneraciones: int
+    migracionEvery: int
+    migrantes: int
+    seed: Union[None, int]
+    params: List[Dict[str, Any]]
+
+    mejores: List[Tuple[Car, float]]
+    individuo: Car
+    list_fit_best: List[float]
+    list_fit_med: List[float]
+    historial: List[List[dict]]
+    evaluacionesPorSegundo: float
+
+    def __init__(
+            self, constructor: CarConstructor, islas: int = 4,
+            maxGeneraciones: int = 50, migracionEvery: int = 5,
+            migrantes: int = 2, parametros: List[Dict[str, Any]] = None,
+            seed: int = None, **comunes) -> None:
+        '''
+        - islas: numero de islas (procesos)
+        - maxGeneraciones: generaciones de cada isla
+        - migracionEvery: cada cuantas generaciones migran los mejores,
+            None o 0 para no migrar
+        - migrantes: individuos que envia cada isla en cada migracion
+        - parametros: lista con un diccionario de parametros de
+            Entrenador por isla (p.ej. probabCruce, mutationRate,
+            renovacion), que se anaden a los comunes
+        - seed: semilla de los generadores aleatorios de la isla 0, la de
+            la isla i es seed + i. None para no fijarla
+        - comunes: parametros de Entrenador de todas las islas. workers,
+            snapshotEvery y metricsFile no se usan en las islas
+        '''
+
+        if islas < 1:
+            raise ValueError('islas debe ser al menos 1')
+        if parametros is None:
+            parametros = [{}] * islas
+        if len(parametros) != islas:
+            raise ValueError('parametros debe tener un diccionario por isla')
+        if migracionEvery is not None and migracionEvery < 0:
+            raise ValueError('migracionEvery no puede ser negativo')
+        for key in ('workers', 'snapshotEvery', 'metricsFile',
+                    'maxGeneraciones', 'nIterNoChange'):
+            comunes.pop(key, None)
+
+        self.params = [dict(comunes, **p) for p in parametros]
+        for p in self.params:
+            # Comprueba los parametros antes de arrancar los procesos
+            e = Entrenador(constructor, maxGeneraciones=maxGeneraciones, **p)
+            if migrantes > e.populationSize - e.elitismo - e.renovacion:
+                raise ValueError(
+                    'migrantes debe ser como mucho el numero de hijos de '
+                    'cada isla')
+
+        self.constructor = constructor
+        self.islas = islas
+        self.maxGeneraciones = maxGeneraciones
+        self.migracionEvery = migracionEvery
+        self.migrantes = migrantes
+        self.seed = seed
+
+        self.mejores = []
+        self.individuo = None
+        self.list_fit_best = []
+        self.list_fit_med = []
+        self.historial = [[] for _ in range(islas)]
+        self.evaluacionesPorSegundo = 0
+
+    def train(self, circuito: Circuit) -> 'Islas':
+        '''
+        Arranca las islas y espera a que terminen. Guarda en mejores los
+        mejores individuos de todas las islas (de mejor a peor fitness),
+        en list_fit_best el mejor fitness de todas en cada generacion y en
+        list_fit_med la media del fitness medio de cada isla
+        '''
+
+        if not len(circuito.limits) or not len(circuito.reward_lines):
+            raise ValueError('Circuito sin limites o recompensas')
+
+        # Anillo: la isla i envia a la i + 1
+        queues = [Queue() for _ in range(self.islas)]
+        results = Queue()
+        procesos = [
+            Process(target=runIsland, args=(
+                i, circuitArgs(circuito), self.constructor, self.params[i],
+                self.maxGeneraciones, self.migracionEvery, self.migrantes,
+                self.seed, queues[i], queues[(i + 1) % self.islas],
+                results), daemon=True)
+            for i in range(self.islas)]
+
+        start = perf_counter()
+        for p in procesos:
+            p.start()
+
+        pos = circuito.startPoint.asTuple()
+        best = [[] for _ in range(self.maxGeneraciones)]
+        med = [[] for _ in range(self.maxGeneraciones)]
+        mejores = []
+        evaluaciones = 0
+        pendientes = set(range(self.islas))
+        try:
+            while pendientes:
+                try:
+                    msg = results.get(timeout=1)
+                except Empty:
+                    muertos = [
+                        i for i in pendientes if not procesos[i].is_alive()]
+                    if muertos:
+                        raise RuntimeError(f'Islas terminadas: {muertos}')
+                    continue
+
+                if msg[0] == 'generacion':
+                    _, i, generacion, info = msg
+                    self.historial[i].append(info)
+                    best[generacion].append(info['best'])
+                    med[generacion].append(info['mean'])
+                    evaluaciones += info['evaluaciones']
+                    if entrenador.LOG:
+                        print(
+                            f'Isla {i} - Generacion {generacion} - '
+                            f'Mejor: {info["best"]} - '
+                            f'Medio: {info["mean"]:.4f}')
+                elif msg[0] == 'fin':
+                    _, i, individuos = msg
+                    mejores.extend(
+                        (carFromPesos(p, pos), fit) for p, fit in individuos)
+                    pendientes.discard(i)
+                else:
+                    raise RuntimeError(f'Error en la isla {msg[1]}: {msg[2]}')
+        finally:
+            for p in procesos:
+                if p.is_alive() and pendientes:
+                    p.terminate()
+                p.join()
+
+        elapsed = perf_counter() - start
+        self.evaluacionesPorSegundo = evaluaciones / elapsed
+        self.list_fit_best = [max(b) for b in best if b]
+        self.list_fit_med = [float(np.mean(m)) for m in med if m]
+        self.mejores = sorted(mejores, key=lambda m: m[1], reverse=True)
+        self.individuo = self.mejores[0][0]
+
+        if entrenador.LOG:
+            print(
+                f'Mejor global: {self.mejores[0][1]} - '
+                f'{evaluaciones} evaluaciones en {elapsed:.1f} s '
+                f'({self.evaluacionesPorSegundo:.0f}/s)')
+
+        return self
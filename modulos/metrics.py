@@ -0,0 +1,130 @@
+'''
+Metricas del entrenamiento en formato JSON lines: una linea (un objeto
+JSON) por generacion, que se anade al final del fichero. Las lineas se
+guardan en memoria y se escriben de varias en varias, o en cuanto se
+generan en modo live, para poder seguir el entrenamiento con tail -f o
+con este modulo.
+
+Uso (muestra las generaciones del fichero y espera a las nuevas):
+python -m modulos.metrics best/metrics.jsonl
+'''
+from typing import Iterator, List, Union
+from time import monotonic, sleep
+import atexit
+import json
+import sys
+
+
+def maxMemory() -> Union[None, int]:
+    '''Memoria maxima usada por el proceso en KB, None si no se sabe'''
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+class MetricsSink():
+    '''
+    Fichero de metricas abierto para anadir lineas. Las lineas se escriben
+    al juntarse flushLines o al pasar flushSeconds desde la ultima
+    escritura, y al cerrarlo (tambien al salir del programa)
+    '''
+
+    filename: str
+    live: bool
+    flushLines: int
+    flushSeconds: float
+    pending: List[str]
+    lastFlush: float
+
+    def __init__(
+            self, filename: str, live: bool = False,
+            flushLines: int = 50, flushSeconds: float = 10) -> None:
+        '''
+        live: escribir cada linea en cuanto se genera
+        '''
+        if flushLines < 1:
+            raise ValueError('flushLines debe ser al menos 1')
+
+        self.filename = filename
+        self.live = live
+        self.flushLines = 1 if live else flushLines
+        self.flushSeconds = flushSeconds
+        self.pending = []
+        self.lastFlush = monotonic()
+        atexit.register(self.flush)
+
+    def write(self, record: dict) -> None:
+        self.pending.append(json.dumps(record) + '\n')
+        if (
+                len(self.pending) >= self.flushLines or
+                monotonic() - self.lastFlush >= self.flushSeconds):
+            self.flush()
+
+    def flush(self) -> None:
+        '''Escribe las lineas pendientes'''
+        if self.pending:
+            with open(self.filename, 'a') as f:
+                f.writelines(self.pending)
+            self.pending = []
+        self.lastFlush = monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def __enter__(self) -> 'MetricsSink':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def read(filename: str, follow: bool = False,
+         interval: float = 1) -> Iterator[dict]:
+    '''
+    Lineas de un fichero de metricas. Con follow espera indefinidamente a
+    las que se vayan anadiendo
+    '''
+    with open(filename) as f:
+        partial = ''
+        while True:
+            line = f.readline()
+            if not line:
+                if not follow:
+                    return
+                sleep(interval)
+                continue
+            partial += line
+            if partial.endswith('\n'):
+                yield json.loads(partial)
+                partial = ''
+
+
+def summary(record: dict) -> str:
+    '''Una linea de texto con lo principal de una generacion'''
+    fit = record['fitness']
+    cache = record.get('cache')
+    return ' '.join((
+        f'gen {record["generacion"]:>4}',
+        f'mejor {fit["best"]:8.4f}',
+        f'media {fit["mean"]:8.4f}',
+        f'frames {record["frames"]:>5}',
+        f'{record["cars_frames_s"]:>9.0f} coches x frames/s',
+        f'eval {record["eval_s"]:6.2f} s',
+        f'reprod {record["reproduccion_s"] * 1e3:7.1f} ms',
+        f'cache {cache["hits"]}/{cache["lookups"]}' if cache else '',
+    )).rstrip()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit()
+    try:
+        for record in read(sys.argv[1], follow=True):
+            print(summary(record), flush=True)
+    except KeyboardInterrupt:
+        pass
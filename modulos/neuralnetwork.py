@@ -1,6 +1,7 @@
 
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 from random import randint
+from hashlib import blake2b
 import numpy as np
 
 
@@ -96,7 +97,9 @@ class NeuralNetwork():
             variacion = NeuralNetwork.randomToEspacioPesos(
                 np.random.random(layer.shape))
 
-            self.pesos[i] = np.where(choice < mrate, variacion, layer)
+            # Las capas sin cambios se mantienen (pueden estar compartidas)
+            if (choice < mrate).any():
+                self.pesos[i] = np.where(choice < mrate, variacion, layer)
 
             i += 1
 
@@ -127,6 +130,34 @@ class NeuralNetwork():
 
         return nn
 
+    def share(self) -> 'NeuralNetwork':
+        '''
+        Copia que comparte los arrays de pesos con esta red (copia al
+        escribir). Los arrays pasan a ser de solo lectura: mutate y cruzar
+        ya no los modifican sino que los sustituyen
+        '''
+
+        for lay in self.pesos:
+            lay.flags.writeable = False
+
+        nn = NeuralNetwork(None, None, None, None, True)
+        nn.pesos = list(self.pesos)
+
+        return nn
+
+    def topology(self) -> Tuple[Tuple[int, int], ...]:
+        '''Forma de cada capa de pesos'''
+        return tuple(lay.shape for lay in self.pesos)
+
+    def digest(self) -> bytes:
+        '''Hash de la forma y el contenido de los pesos'''
+        h = blake2b(digest_size=16)
+        for lay in self.pesos:
+            lay = np.ascontiguousarray(lay, dtype=float)
+            h.update(np.array(lay.shape, dtype=np.int64).tobytes())
+            h.update(lay.tobytes())
+        return h.digest()
+
     def randomToEspacioPesos(
             input: Union[np.ndarray, int, float]
             ) -> Union[np.ndarray, int, float]:
@@ -139,6 +170,168 @@ class NeuralNetwork():
         return input
 
 
+class GenomePool():
+    '''
+    Mutacion y cruce de toda una poblacion de redes a la vez.
+    Las redes se agrupan por topologia y cada capa de un grupo se trata
+    como un tensor (redes, entradas, salidas). Los pesos pueden estar
+    compartidos entre redes (NeuralNetwork.share), asi que nunca se
+    escriben: el cruce intercambia referencias a las capas, sin copiarlas,
+    y la mutacion solo crea arrays nuevos para las capas que cambian
+    '''
+
+    networks: List[NeuralNetwork]
+
+    def __init__(self, networks: List[NeuralNetwork]) -> None:
+        '''networks: redes distintas (no el mismo objeto dos veces)'''
+        self.networks = networks
+
+    def buckets(self) -> Dict[Tuple[Tuple[int, int], ...], np.ndarray]:
+        '''
+        Indices de las redes de cada topologia. Se calculan en cada mutacion
+        porque el cruce de redes distintas cambia sus topologias
+        '''
+        groups = {}
+        for i, nn in enumerate(self.networks):
+            groups.setdefault(nn.topology(), []).append(i)
+
+        return {
+            topo: np.array(members, dtype=int)
+            for topo, members in groups.items()}
+
+    def mutate(self, mrate: float) -> None:
+        '''
+        NeuralNetwork.mutate de todas las redes a la vez: cada peso se
+        sustituye por uno aleatorio con probabilidad mrate. Un solo sorteo
+        para todos los pesos, y solo se generan los pesos nuevos de los que
+        mutan. Las capas con algun peso mutado de cada tensor se copian
+        juntas en un array nuevo y las demas se siguen compartiendo
+        '''
+
+        buckets = self.buckets()
+        sizes = [
+            len(members) * i * o
+            for topo, members in buckets.items() for i, o in topo]
+        mask = np.random.random((sum(sizes), )) < mrate
+        values = NeuralNetwork.randomToEspacioPesos(
+            np.random.random((np.count_nonzero(mask), )))
+
+        offset = used = 0
+        for topo, members in buckets.items():
+            for lay, shape in enumerate(topo):
+                size = len(members) * shape[0] * shape[1]
+                m = mask[offset:offset + size].reshape(
+                    (len(members), *shape))
+                offset += size
+
+                rows = np.flatnonzero(m.any(axis=(1, 2)))
+                if not len(rows):
+                    continue
+                nets = [self.networks[i] for i in members[rows].tolist()]
+                tensor = np.stack([nn.pesos[lay] for nn in nets])
+                m = m[rows]
+                k = np.count_nonzero(m)
+                tensor[m] = values[used:used + k]
+                used += k
+
+                for nn, layer in zip(nets, tensor):
+                    nn.pesos[lay] = layer
+
+    def cruzar(self, pares: np.ndarray) -> None:
+        '''
+        NeuralNetwork.cruzar inplace de cada pareja de indices de redes
+        (array (k, 2), cada red en una pareja como mucho): intercambian sus
+        capas a partir de una capa aleatoria, sin copiarlas
+        '''
+        pares = np.asarray(pares, dtype=int).reshape((-1, 2))
+        a, b = pares.T
+        layers = np.array([len(nn.pesos) for nn in self.networks])
+        shortest = np.minimum(layers[a], layers[b])
+
+        # Solo se cruzan redes de mas de una capa, en una capa aleatoria
+        ok = shortest > 1
+        pos = np.random.randint(1, shortest[ok])
+
+        for i, j, p in zip(a[ok].tolist(), b[ok].tolist(), pos.tolist()):
+            x, y = self.networks[i], self.networks[j]
+            x.pesos, y.pesos = (
+                x.pesos[:p] + y.pesos[p:], y.pesos[:p] + x.pesos[p:])
+
+
+class PopulationNetwork():
+    '''
+    Inferencia de toda una poblacion de redes a la vez.
+    Las redes con la misma topologia se agrupan y sus pesos se apilan en
+    tensores (redes, entradas, salidas), de modo que cada capa se calcula
+    para todas las redes del grupo con un unico producto matricial.
+    Equivale a llamar a NeuralNetwork.process para cada red
+    '''
+
+    buckets: Dict[
+        Tuple[Tuple[int, int], ...], Tuple[np.ndarray, List[np.ndarray]]]
+    bucketOf: np.ndarray
+    positionOf: np.ndarray
+    noutputs: int
+
+    def __init__(self, networks: List[NeuralNetwork]) -> None:
+
+        groups = {}
+        for i, nn in enumerate(networks):
+            groups.setdefault(nn.topology(), []).append(i)
+
+        self.buckets = {}
+        self.bucketOf = np.zeros((len(networks), ), dtype=int)
+        self.positionOf = np.zeros((len(networks), ), dtype=int)
+        self.noutputs = 0
+        for b, (topo, members) in enumerate(groups.items()):
+            members = np.array(members, dtype=int)
+            self.bucketOf[members] = b
+            self.positionOf[members] = np.arange(len(members))
+            self.buckets[topo] = (members, [
+                np.stack([networks[i].pesos[lay] for i in members])
+                for lay in range(len(topo))])
+            self.noutputs = topo[-1][1]
+
+    def process(
+            self, inputs: np.ndarray, idx: np.ndarray = None) -> np.ndarray:
+        '''
+        - inputs: array (n, entradas), una fila por red
+        - idx: indice de la red de cada fila, por defecto todas en orden
+        Return: array (n, salidas) de bool como NeuralNetwork.process
+        '''
+
+        if idx is None:
+            idx = np.arange(len(self.bucketOf))
+
+        if NeuralNetwork.normalizarInputs:
+            inputs = inputs / np.linalg.norm(inputs, axis=1, keepdims=True)
+
+        output = np.zeros((len(idx), self.noutputs), dtype=bool)
+        buckets = self.bucketOf[idx]
+        for b, (topo, (_, pesos)) in enumerate(self.buckets.items()):
+            rows = np.flatnonzero(buckets == b)
+            if not len(rows):
+                continue
+
+            ish, psh = inputs.shape[1], topo[0][0]
+            if ish != psh:
+                raise Exception(
+                    f'Input size != first layer size ({ish} != {psh})')
+
+            pos = self.positionOf[idx[rows]]
+            values = inputs[rows, None, :]
+            for layer in pesos:
+                values = np.matmul(values, layer[pos])
+                values = np.where(
+                    values > 0, 1,
+                    # Funcion de activacion
+                    -1 if NeuralNetwork.activacionBipolar else 0)
+
+            output[rows] = values[:, 0, :] > 0
+
+        return output
+
+
 if __name__ == '__main__':
     nn = NeuralNetwork(6, 3, 2, 6)
 
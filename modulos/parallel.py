@@ -0,0 +1,402 @@
+from typing import Callable, Iterator, List, Tuple, Union
+from multiprocessing import Pool
+import signal
+from time import perf_counter
+import numpy as np
+
+from modulos.geometry import SegmentArray
+from modulos.circuit import Circuit
+from modulos.distancefield import DistanceField
+from modulos.car import Car
+from modulos.simulator import (
+    PopulationSimulator, applyRecords, padRecords, recordSteps, splitRecords,
+    stopFrame)
+
+# Circuitos de cada proceso, se cargan una sola vez al arrancar el proceso
+workerCircuits: List[Circuit] = []
+
+
+def buildCircuit(
+        limits: np.ndarray, rewards: np.ndarray,
+        start: Tuple[float, float], use_grid: bool,
+        field: DistanceField = None, compiled_file: str = None) -> Circuit:
+    '''
+    Circuito a partir de los arrays de segmentos, o de su fichero compilado
+    si se da (los procesos comparten sus paginas en vez de recibir una
+    copia de los arrays)
+    '''
+
+    if compiled_file is not None:
+        c = Circuit(compiled_file, use_grid=use_grid)
+    else:
+        c = Circuit(use_grid=use_grid)
+        c.limits = SegmentArray(limits)
+        c.reward_lines = SegmentArray(rewards)
+    c.startPoint.set(*start)
+    if field is not None:
+        c.setDistanceField(field)
+
+    return c
+
+
+def circuitArgs(circuito: Circuit) -> tuple:
+    '''
+    Argumentos de buildCircuit para reconstruir el circuito en otro
+    proceso: su fichero compilado si lo tiene, si no sus arrays
+    '''
+    source = circuito.compiledSource()
+    return (
+        None if source else circuito.getLimitsArray(),
+        None if source else circuito.getRewardsArray(),
+        circuito.startPoint.asTuple(), circuito.use_grid,
+        circuito.getDistanceField(), source)
+
+
+def initWorker(*circuitos: tuple) -> None:
+    '''circuitos: argumentos de buildCircuit de cada circuito'''
+    global workerCircuits
+    # Ctrl-C solo lo gestiona el proceso principal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    workerCircuits = [buildCircuit(*args) for args in circuitos]
+
+
+def simulateChunk(
+        args: Tuple[
+            List[List[np.ndarray]], int, Tuple[int, float], int, int, int,
+            Union[None, Tuple[np.ndarray, np.ndarray]]]
+        ) -> dict:
+    '''
+    Simula un bloque de steps de un trozo de la poblacion en uno de los
+    circuitos del proceso (por su indice) a partir de los pesos de sus
+    redes, desde el step start (y el estado (frame, getState) en el que se
+    quedo el bloque anterior) hasta el frame maxIters.
+    Como el fin de la simulacion depende de toda la poblacion, devuelve el
+    registro de los frames del bloque (PopulationSimulator.record) para que
+    ParallelFitness decida en que frame se habria parado la simulacion en
+    serie. Tambien devuelve el estado final de cada coche
+    (PopulationSimulator.getState)
+    '''
+    pesos, maxIters, stagnation, repeat, circuito, start, state = args
+    t = perf_counter()
+
+    cars = []
+    for p in pesos:
+        car = Car((0, 0), None, None, True)
+        car.brain.pesos = p
+        cars.append(car)
+
+    sim = PopulationSimulator(
+        cars, workerCircuits[circuito], stagnation, repeat)
+    if state is not None:
+        sim.restore(np.arange(len(cars)), *state)
+    records = sim.record(maxIters, 1 + start * repeat)
+
+    return {
+        'records': records,
+        'states': sim.getState(),
+        'time': perf_counter() - t,
+    }
+
+
+def simulateEpisode(
+        args: Tuple[List[np.ndarray], int, Tuple[int, float], int]
+        ) -> Tuple[int, int, int, float]:
+    '''
+    Simula un solo individuo (su episodio) a partir de los pesos de su red
+    en el primer circuito del proceso.
+    Devuelve sus contadores nextRewardIdx, aliveFrames y lastRewardFrames
+    tras la simulacion y el tiempo que ha tardado
+    '''
+    pesos, maxIters, stagnation, repeat = args
+    t = perf_counter()
+
+    car = Car((0, 0), None, None, True)
+    car.brain.pesos = pesos
+    PopulationSimulator(
+        [car], workerCircuits[0], stagnation, repeat).run(maxIters)
+
+    return (
+        car.nextRewardIdx, car.aliveFrames, car.lastRewardFrames,
+        perf_counter() - t)
+
+
+class ParallelFitness():
+    '''
+    Simulacion de la poblacion repartida entre varios procesos.
+    Cada proceso carga la geometria de los circuitos una sola vez y solo
+    recibe los pesos de las redes. El resultado es el mismo que el de la
+    simulacion en serie
+    '''
+
+    workers: int
+    pool: Pool
+    circuitos: List[Circuit]
+    maxRewards: List[int]
+    lastUtilizacion: float
+
+    CHUNKS_PER_WORKER = 2
+    '''Trozos de poblacion por proceso, para repartir mejor la carga'''
+    BLOCK_STEPS = 32
+    '''
+    Steps del primer bloque de simulacion, cada bloque siguiente es el doble
+    de largo. Entre bloques se comprueba si la simulacion en serie ya se
+    habria parado
+    '''
+
+    def __init__(
+            self, circuito: Union[Circuit, List[Circuit]],
+            workers: int) -> None:
+        '''
+        circuito: circuito o lista de circuitos en los que se puede simular
+        (por defecto en el primero)
+        '''
+
+        if workers < 1:
+            raise ValueError('workers debe ser al menos 1')
+
+        circuitos = (
+            list(circuito) if isinstance(circuito, (list, tuple))
+            else [circuito])
+        if not circuitos:
+            raise ValueError('Se necesita al menos un circuito')
+
+        self.workers = workers
+        self.lastUtilizacion = 0
+        self.circuitos = circuitos
+        self.maxRewards = [len(c.reward_lines) * 3 for c in circuitos]
+        self.pool = Pool(
+            workers, initializer=initWorker,
+            initargs=tuple(circuitArgs(c) for c in circuitos))
+
+    def indice(self, circuito: Circuit = None) -> int:
+        '''Indice de circuito en los procesos, 0 si es None'''
+        if circuito is None:
+            return 0
+        for i, c in enumerate(self.circuitos):
+            if c is circuito:
+                return i
+        digest = circuito.digest()
+        for i, c in enumerate(self.circuitos):
+            if c.digest() == digest:
+                return i
+        raise ValueError('El circuito no esta en los procesos del pool')
+
+    def run(
+            self, poblacion: List[Car], maxIters: int,
+            endIfAllStopped: bool = True,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            circuito: Circuit = None) -> int:
+        '''
+        Equivalente a PopulationSimulator.run, pero solo copia a cada Car
+        los contadores de recompensas y frames y si esta vivo.
+        Devuelve el numero de frames
+        '''
+
+        i = self.indice(circuito)
+        records = padRecords([
+            r['records'] for r in self.simulateCircuitos(
+                [poblacion], maxIters, stagnation, repeat, [i],
+                endIfAllStopped)[0]])
+        iters = stopFrame(
+            records, self.maxRewards[i], maxIters, endIfAllStopped, repeat)
+        applyRecords(poblacion, records, iters, repeat)
+
+        return iters
+
+    def runCircuitos(
+            self, poblacion: List[Car], maxIters: int,
+            endIfAllStopped: bool = True,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            circuitos: List[Circuit] = None) -> Iterator[int]:
+        '''
+        run en varios circuitos (por defecto todos los del pool): las
+        simulaciones de todos los trozos de la poblacion en todos los
+        circuitos se reparten a la vez entre los procesos. Devuelve el
+        numero de frames de cada circuito y, antes de devolverlo, copia a
+        cada Car los contadores de ese circuito
+        '''
+
+        if circuitos is None:
+            circuitos = self.circuitos
+        indices = [self.indice(c) for c in circuitos]
+        results = self.simulateCircuitos(
+            [poblacion] * len(indices), maxIters, stagnation, repeat, indices,
+            endIfAllStopped)
+
+        for i, chunks in zip(indices, results):
+            records = padRecords([r['records'] for r in chunks])
+            iters = stopFrame(
+                records, self.maxRewards[i], maxIters, endIfAllStopped,
+                repeat)
+            applyRecords(poblacion, records, iters, repeat)
+            yield iters
+
+    def record(
+            self, poblacion: List[Car], maxIters: int,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, circuito: Circuit = None,
+            endIfAllStopped: bool = True) -> np.ndarray:
+        '''
+        Equivalente a PopulationSimulator.record, pero termina en el bloque
+        en el que se habria parado la simulacion en serie
+        '''
+        return padRecords([
+            r['records'] for r in self.simulate(
+                poblacion, maxIters, stagnation, repeat, circuito,
+                endIfAllStopped)])
+
+    def recordCars(
+            self, poblacion: List[Car], maxIters: int,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            circuito: Circuit = None, endIfAllStopped: bool = True,
+            known: np.ndarray = None
+            ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        '''
+        Registro de cada coche (splitRecords) y su estado tras el ultimo
+        frame del registro (PopulationSimulator.getState).
+        known: registros (frames, campos, coches) ya conocidos del resto de
+        la poblacion, para decidir cuando se para (simulateCircuitos)
+        '''
+        return self.recordCircuitos(
+            [poblacion], maxIters, stagnation, repeat, [circuito],
+            endIfAllStopped, None if known is None else [known])[0]
+
+    def recordCircuitos(
+            self, poblaciones: List[List[Car]], maxIters: int,
+            stagnation: Tuple[int, float], repeat: int,
+            circuitos: List[Circuit], endIfAllStopped: bool = True,
+            known: List[np.ndarray] = None
+            ) -> List[List[Tuple[np.ndarray, np.ndarray]]]:
+        '''
+        recordCars de una poblacion distinta en cada circuito, todas en el
+        mismo reparto entre los procesos (simulateCircuitos)
+        '''
+        indices = [self.indice(c) for c in circuitos]
+        results = []
+        for i, chunks in zip(indices, self.simulateCircuitos(
+                poblaciones, maxIters, stagnation, repeat, indices,
+                endIfAllStopped, known)):
+            cars = []
+            for r in chunks:
+                cars.extend(zip(
+                    splitRecords(r['records'], self.maxRewards[i]),
+                    r['states'].T))
+            results.append(cars)
+        return results
+
+    def simulate(
+            self, poblacion: List[Car], maxIters: int,
+            stagnation: Tuple[int, float] = None,
+            repeat: int = 1, circuito: Circuit = None,
+            endIfAllStopped: bool = True,
+            known: np.ndarray = None) -> List[dict]:
+        '''Resultados de simulateChunk de cada trozo de la poblacion'''
+        return self.simulateCircuitos(
+            [poblacion], maxIters, stagnation, repeat,
+            [self.indice(circuito)], endIfAllStopped,
+            None if known is None else [known])[0]
+
+    def simulateCircuitos(
+            self, poblaciones: List[List[Car]], maxIters: int,
+            stagnation: Tuple[int, float], repeat: int,
+            indices: List[int], endIfAllStopped: bool = True,
+            known: List[np.ndarray] = None) -> List[List[dict]]:
+        '''
+        Resultados de simulateChunk de cada trozo de poblaciones[k] en el
+        circuito indices[k] (registros de todos los bloques, estado final y
+        tiempo). Los trozos de todos los circuitos se reparten a la vez entre
+        los procesos por bloques de steps (BLOCK_STEPS, cada vez mas
+        largos) y un circuito deja de simularse en cuanto sus registros
+        llegan al frame en el que se pararia la simulacion en serie
+        (stopFrame), asi que los procesos no simulan frames de mas.
+        known: por cada circuito, registros (frames, campos, coches) del
+        resto de la poblacion que no se simula (FitnessCache), que tambien
+        cuentan para decidir cuando se para
+        '''
+
+        wall = perf_counter()
+        if known is None:
+            known = [None] * len(indices)
+
+        pesos = []
+        for poblacion in poblaciones:
+            bounds = np.array_split(np.arange(len(poblacion)), max(min(
+                len(poblacion), self.workers * self.CHUNKS_PER_WORKER), 1))
+            pesos.append([
+                [poblacion[j].brain.pesos for j in chunk] for chunk in bounds])
+        results = [
+            [{'records': [], 'states': None, 'time': 0.0} for _ in chunks]
+            for chunks in pesos]
+        pending = [list(range(len(chunks))) for chunks in pesos]
+        steps = recordSteps(maxIters, repeat)
+
+        start = 0
+        block = self.BLOCK_STEPS
+        while any(pending):
+            end = min(start + block, steps)
+            tasks = [
+                (k, c) for k, chunks in enumerate(pending) for c in chunks]
+            blocks = self.pool.map(simulateChunk, [
+                (
+                    pesos[k][c], min(maxIters, 1 + end * repeat), stagnation,
+                    repeat, indices[k], start,
+                    None if start == 0 else (
+                        results[k][c]['records'][-1][-1],
+                        results[k][c]['states']))
+                for k, c in tasks])
+
+            for (k, c), r in zip(tasks, blocks):
+                chunk = results[k][c]
+                chunk['records'].append(r['records'])
+                chunk['states'] = r['states']
+                chunk['time'] += r['time']
+                if len(r['records']) < end - start:
+                    # Todos muertos o alguno con mas de 3 vueltas
+                    pending[k].remove(c)
+
+            for k, i in enumerate(indices):
+                if not pending[k] or end >= steps:
+                    pending[k] = []
+                    continue
+                records = padRecords([
+                    np.concatenate(chunk['records']) for chunk in results[k]])
+                if known[k] is not None:
+                    records = np.concatenate(
+                        (records, known[k][:len(records)]), axis=2)
+                frames = 1 + len(records) * repeat
+                if stopFrame(
+                        records, self.maxRewards[i], frames,
+                        endIfAllStopped, repeat) < frames:
+                    pending[k] = []
+
+            start = end
+            block *= 2
+
+        for chunks in results:
+            for chunk in chunks:
+                chunk['records'] = np.concatenate(chunk['records'])
+
+        wall = perf_counter() - wall
+        self.lastUtilizacion = sum(
+            chunk['time'] for chunks in results for chunk in chunks) / (
+            self.workers * wall)
+
+        return results
+
+    def simulateAsync(
+            self, car: Car, maxIters: int, callback: Callable,
+            errorCallback: Callable = None,
+            stagnation: Tuple[int, float] = None, repeat: int = 1) -> None:
+        '''
+        Simula el episodio de un individuo en algun proceso libre sin
+        esperar al resultado: callback recibe el de simulateEpisode (en otro
+        hilo de este proceso)
+        '''
+        args = (car.brain.pesos, maxIters, stagnation, repeat)
+        self.pool.apply_async(
+            simulateEpisode, (args, ),
+            callback=callback, error_callback=errorCallback)
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,78 @@
+'''
+Metodos de seleccion de progenitores.
+Cada metodo recibe los valores de fitness de la poblacion y el numero de
+progenitores, y devuelve un array con los indices de los escogidos (con
+repeticion), calculados con operaciones vectorizadas de numpy en vez de
+recorrer la poblacion por cada progenitor
+'''
+from typing import Callable, Dict, List, Union
+import numpy as np
+
+
+def acumulado(fits: np.ndarray) -> np.ndarray:
+    '''Fitness acumulado, comprobando que no haya valores negativos'''
+    if len(fits) and fits.min() < 0:
+        raise ValueError('fits debe ser no negativo para esta seleccion')
+    return np.cumsum(fits)
+
+
+def ruleta(fits: Union[List[float], np.ndarray], n: int) -> np.ndarray:
+    '''
+    Cada progenitor se escoge con probabilidad proporcional a su fitness,
+    con n numeros aleatorios independientes sobre el fitness acumulado.
+    Si todo el fitness es 0 se escogen los n primeros
+    '''
+    fits = np.asarray(fits, dtype=float)
+    cum = acumulado(fits)
+    if not len(fits) or cum[-1] <= 0:
+        return np.arange(n) % max(len(fits), 1)
+
+    r = np.random.random(n) * cum[-1]
+    return np.minimum(np.searchsorted(cum, r, side='right'), len(fits) - 1)
+
+
+def sus(fits: Union[List[float], np.ndarray], n: int) -> np.ndarray:
+    '''
+    Stochastic universal sampling: como ruleta pero con n punteros
+    equiespaciados a partir de un solo numero aleatorio, de modo que cada
+    individuo se escoge un numero de veces lo mas cercano posible al
+    esperado
+    '''
+    if n < 1:
+        return np.empty(0, dtype=int)
+    fits = np.asarray(fits, dtype=float)
+    cum = acumulado(fits)
+    if not len(fits) or cum[-1] <= 0:
+        return np.arange(n) % max(len(fits), 1)
+
+    step = cum[-1] / n
+    r = (np.random.random() + np.arange(n)) * step
+    return np.minimum(np.searchsorted(cum, r, side='right'), len(fits) - 1)
+
+
+def torneo(
+        fits: Union[List[float], np.ndarray], n: int,
+        k: int = 2) -> np.ndarray:
+    '''
+    Cada progenitor es el mejor de k individuos escogidos al azar (con
+    repeticion). En los empates gana el primero
+    '''
+    fits = np.asarray(fits, dtype=float)
+    if k < 1:
+        raise ValueError('k debe ser al menos 1')
+
+    cand = np.random.randint(0, len(fits), (n, k))
+    return cand[np.arange(n), np.argmax(fits[cand], axis=1)]
+
+
+def truncamiento(fits: Union[List[float], np.ndarray], n: int) -> np.ndarray:
+    '''Los n primeros (la poblacion esta ordenada por fitness)'''
+    return np.arange(n) % max(len(fits), 1)
+
+
+METODOS: Dict[str, Callable[..., np.ndarray]] = {
+    'ruleta': ruleta,
+    'sus': sus,
+    'torneo': torneo,
+    'truncamiento': truncamiento,
+}
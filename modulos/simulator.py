@@ -0,0 +1,556 @@
+from typing import Callable, List, Tuple
+from math import ceil
+import numpy as np
+
+from modulos.geometry import (
+    capsuleTouchingSegments, circleTouchingSegments, rotateArrays,
+    rotationConstants, sensorDistances)
+from modulos.circuit import Circuit
+from modulos.neuralnetwork import PopulationNetwork
+from modulos.car import Car
+from modulos.timing import PhaseTimes, noLap
+
+
+RECORD_FIELDS = (
+    'nextRewardIdx', 'aliveFrames', 'lastRewardFrames', 'alive', 'stopped',
+    'retired')
+'''
+Campos de cada frame en los registros de PopulationSimulator.record.
+stopped indica si el coche esta (casi) parado y retired si se ha retirado
+por no avanzar (Car.checkStagnation)
+'''
+
+
+class PopulationSimulator():
+    '''
+    Simulacion de toda una poblacion de coches a la vez.
+    El estado de cada coche se guarda en arrays de numpy (struct of arrays)
+    y cada frame se calcula para todos los coches con operaciones
+    vectorizadas. Reproduce exactamente Car.update
+    '''
+
+    poblacion: List[Car]
+    circuito: Circuit
+    brains: PopulationNetwork
+
+    x: np.ndarray
+    y: np.ndarray
+    dirx: np.ndarray
+    diry: np.ndarray
+    speed: np.ndarray
+    nextRewardIdx: np.ndarray
+    alive: np.ndarray
+    retired: np.ndarray
+    aliveFrames: np.ndarray
+    lastRewardFrames: np.ndarray
+    anchorx: np.ndarray
+    anchory: np.ndarray
+
+    stagnation: Tuple[int, float]
+    repeat: int
+    times: PhaseTimes
+
+    LEFT = rotationConstants(Car.ROTATION_RATE)
+    RIGHT = rotationConstants(-Car.ROTATION_RATE)
+
+    def __init__(
+            self, poblacion: List[Car], circuito: Circuit,
+            stagnation: Tuple[int, float] = None, repeat: int = 1,
+            times: PhaseTimes = None) -> None:
+        '''
+        stagnation: (frames, distancia), retira los coches que no avanzan
+        como Car.checkStagnation
+        repeat: frames que avanza cada step manteniendo la misma accion,
+        como Car.updateRepeat
+        times: si se da, se le suma el tiempo de cada fase de los steps
+        '''
+
+        if repeat < 1:
+            raise ValueError('repeat debe ser al menos 1')
+
+        self.poblacion = poblacion
+        self.circuito = circuito
+        self.stagnation = stagnation
+        self.repeat = repeat
+        self.times = times
+
+        self.limits = circuito.getLimitsArray()
+        self.rewards = circuito.getRewardsArray()
+        self.grid = circuito.getGrid()
+        self.collider = circuito.getSpatialIndex()
+        self.brains = PopulationNetwork([car.brain for car in poblacion])
+
+        self.reset()
+
+    def reset(self) -> None:
+        '''Equivalente a Car.resetAll y Car.setPosition en el inicio'''
+
+        n = len(self.poblacion)
+        sx, sy = self.circuito.startPoint.asTuple()
+
+        self.x = np.full((n, ), sx, dtype=float)
+        self.y = np.full((n, ), sy, dtype=float)
+        self.dirx = np.full((n, ), -1, dtype=float)
+        self.diry = np.zeros((n, ), dtype=float)
+        self.speed = np.zeros((n, ), dtype=float)
+        self.nextRewardIdx = np.zeros((n, ), dtype=int)
+        self.alive = np.ones((n, ), dtype=bool)
+        self.retired = np.zeros((n, ), dtype=bool)
+        self.aliveFrames = np.zeros((n, ), dtype=int)
+        self.lastRewardFrames = np.zeros((n, ), dtype=int)
+        self.anchorx = self.x.copy()
+        self.anchory = self.y.copy()
+
+    def step(self, active: np.ndarray = None) -> bool:
+        '''
+        Avanza repeat frames todos los coches vivos, o solo los vivos de la
+        mascara active.
+        Devuelve False solo si no se ha procesado ningun coche
+        '''
+
+        idx = np.flatnonzero(
+            self.alive if active is None else self.alive & active)
+        if not len(idx):
+            return False
+
+        lap = noLap if self.times is None else self.times.lap
+        lap()
+
+        if self.repeat > 1:
+            self.stepRepeat(idx, lap)
+            return True
+
+        # Colisiones con los limites
+        if len(self.limits):
+            if self.collider is not None:
+                crash = self.collider.touchingCircle(
+                    self.x[idx], self.y[idx], Car.RADIUS)
+            else:
+                ax, ay, bx, by = self.limits.T
+                crash = circleTouchingSegments(
+                    self.x[idx, None], self.y[idx, None], Car.RADIUS,
+                    ax, ay, bx, by).any(axis=1)
+            dead = idx[crash]
+            self.alive[dead] = False
+            self.speed[dead] = 0
+            idx = idx[~crash]
+            if not len(idx):
+                lap('collision')
+                return True
+        lap('collision')
+
+        # Recompensas
+        rll = len(self.rewards)
+        if rll:
+            ax, ay, bx, by = self.rewards[self.nextRewardIdx[idx] % rll].T
+            rewarded = idx[circleTouchingSegments(
+                self.x[idx], self.y[idx], Car.RADIUS, ax, ay, bx, by)]
+            self.nextRewardIdx[rewarded] += 1
+            self.lastRewardFrames[rewarded] = self.aliveFrames[rewarded]
+            self.anchorx[rewarded] = self.x[rewarded]
+            self.anchory[rewarded] = self.y[rewarded]
+        lap('reward')
+
+        data = self.getEnvironment(idx)
+        lap('sense')
+        actions = self.think(idx, data)
+        lap('think')
+        self.move(idx, actions)
+
+        self.aliveFrames[idx] += 1
+
+        if self.stagnation is not None:
+            self.checkStagnation(idx, *self.stagnation)
+        lap('move')
+
+        return True
+
+    def stepRepeat(
+            self, idx: np.ndarray,
+            lap: Callable[[str], None] = noLap) -> None:
+        '''Car.updateRepeat de los coches indicados'''
+
+        data = self.getEnvironment(idx)
+        lap('sense')
+        actions = self.think(idx, data)
+        lap('think')
+
+        rll = len(self.rewards)
+        for _ in range(self.repeat):
+            px, py = self.x[idx], self.y[idx]
+            self.move(idx, actions)
+            self.aliveFrames[idx] += 1
+            qx, qy = self.x[idx], self.y[idx]
+            lap('move')
+
+            # Colisiones en todo el desplazamiento
+            if len(self.limits):
+                if self.collider is not None:
+                    crash = self.collider.touchingCapsule(
+                        px, py, qx, qy, Car.RADIUS)
+                else:
+                    ax, ay, bx, by = self.limits.T
+                    crash = capsuleTouchingSegments(
+                        px[:, None], py[:, None], qx[:, None], qy[:, None],
+                        Car.RADIUS, ax, ay, bx, by).any(axis=1)
+                dead = idx[crash]
+                self.alive[dead] = False
+                self.speed[dead] = 0
+                keep = ~crash
+                idx, actions = idx[keep], actions[keep]
+                px, py, qx, qy = px[keep], py[keep], qx[keep], qy[keep]
+            lap('collision')
+
+            if rll:
+                ax, ay, bx, by = self.rewards[self.nextRewardIdx[idx] % rll].T
+                rewarded = idx[capsuleTouchingSegments(
+                    px, py, qx, qy, Car.RADIUS, ax, ay, bx, by)]
+                self.nextRewardIdx[rewarded] += 1
+                self.lastRewardFrames[rewarded] = self.aliveFrames[rewarded]
+                self.anchorx[rewarded] = self.x[rewarded]
+                self.anchory[rewarded] = self.y[rewarded]
+            lap('reward')
+
+            if self.stagnation is not None:
+                self.checkStagnation(idx, *self.stagnation)
+                keep = self.alive[idx]
+                idx, actions = idx[keep], actions[keep]
+
+            if not len(idx):
+                break
+
+    def checkStagnation(
+            self, idx: np.ndarray, frames: int, distance: float) -> None:
+        '''Car.checkStagnation de los coches indicados'''
+
+        waiting = self.aliveFrames[idx] - self.lastRewardFrames[idx]
+        idx = idx[(waiting > 0) & (waiting % frames == 0)]
+        if not len(idx):
+            return
+
+        dx = self.x[idx] - self.anchorx[idx]
+        dy = self.y[idx] - self.anchory[idx]
+        still = dx * dx + dy * dy < distance * distance
+
+        retired = idx[still]
+        self.alive[retired] = False
+        self.retired[retired] = True
+        self.speed[retired] = 0
+
+        moved = idx[~still]
+        self.anchorx[moved] = self.x[moved]
+        self.anchory[moved] = self.y[moved]
+
+    def getEnvironment(self, idx: np.ndarray) -> np.ndarray:
+        '''Car.getEnvironment de los coches indicados, una fila por coche'''
+
+        data = np.zeros((len(idx), Car.NINPUTS), dtype=float)
+        data[:, :-1] = sensorDistances(
+            self.x[idx], self.y[idx], self.dirx[idx], self.diry[idx],
+            Car.SENSORES, self.limits, self.grid)
+        data[:, -1] = self.speed[idx]
+
+        return data
+
+    def think(self, idx: np.ndarray, data: np.ndarray) -> np.ndarray:
+        '''Array (n, 3) con las acciones de cada coche'''
+
+        return self.brains.process(data, idx)
+
+    def move(self, idx: np.ndarray, actions: np.ndarray) -> None:
+        '''Car.move de los coches indicados'''
+
+        turnleft, accelerate, turnright = actions.T
+
+        speed = self.speed[idx] * Car.FRICTION
+
+        dx, dy = self.dirx[idx], self.diry[idx]
+        for turn, (c, s) in (
+                (turnleft & ~turnright, PopulationSimulator.LEFT),
+                (turnright & ~turnleft, PopulationSimulator.RIGHT)):
+            if turn.any():
+                rx, ry = rotateArrays(dx[turn], dy[turn], c, s)
+                dx[turn], dy[turn] = rx, ry
+
+        speed = np.where(
+            accelerate,
+            np.minimum(speed + Car.ACCELERATION, Car.MAX_SPEED), speed)
+
+        self.x[idx] += speed * dx
+        self.y[idx] += speed * dy
+        self.dirx[idx], self.diry[idx] = dx, dy
+        self.speed[idx] = speed
+
+    def allStopped(self) -> bool:
+        '''True si todos los coches estan (casi) parados'''
+        return bool((self.speed < 0.01).all())
+
+    def run(self, maxIters: int, endIfAllStopped: bool = True) -> int:
+        '''
+        Bucle de CarConstructor.fitness sin visualizacion.
+        Devuelve el numero de frames (con repeat > 1 puede pasar de maxIters
+        en el ultimo step)
+        '''
+
+        # Numero de "frames" que llevan parados todos los individuos
+        speedStopped = 0
+        maxRewards = len(self.rewards) * 3
+
+        run = True
+        iters = 1
+        while run and speedStopped < 3 and iters < maxIters:
+
+            self.step()
+
+            if not self.alive.any():
+                run = False
+
+            if run and (self.nextRewardIdx > maxRewards).any():
+                # Mas de 3 vueltas completas al circuito
+                run = False
+
+            if endIfAllStopped and run:
+                if self.allStopped():
+                    speedStopped += 1  # Todos quietos
+                else:
+                    speedStopped = 0
+
+            iters += self.repeat
+
+        self.writeBack()
+
+        return iters
+
+    def runHalving(
+            self, maxIters: int, rungs: int, keep: float,
+            score: Callable[[np.ndarray, np.ndarray], np.ndarray],
+            endIfAllStopped: bool = True) -> int:
+        '''
+        run con successive halving: todos los coches se simulan hasta el
+        primer horizonte de halvingHorizons y solo la proporcion keep con
+        mejor score sigue hasta el siguiente, y asi hasta maxIters. Los
+        descartados se quedan con el estado del horizonte en el que salen.
+        score(nextRewardIdx, aliveFrames) debe ser el fitness (con el mismo
+        maxIters para todos los horizontes) o cualquier valor que no baje al
+        simular mas frames: asi los que siguen nunca quedan por debajo de
+        los descartados y el orden final es comparable entre horizontes.
+        Las condiciones de parada de run se aplican a los que siguen.
+        Devuelve el numero de frames
+        '''
+
+        maxRewards = len(self.rewards) * 3
+        active = np.ones((len(self.poblacion), ), dtype=bool)
+
+        speedStopped = 0
+        run = True
+        iters = 1
+        horizons = halvingHorizons(maxIters, rungs, keep)
+        for k, horizon in enumerate(horizons):
+            while run and speedStopped < 3 and iters < horizon:
+
+                self.step(active)
+
+                if not (self.alive & active).any():
+                    run = False
+
+                if run and (self.nextRewardIdx > maxRewards).any():
+                    # Mas de 3 vueltas completas al circuito
+                    run = False
+
+                if endIfAllStopped and run:
+                    if (self.speed[active] < 0.01).all():
+                        speedStopped += 1  # Todos quietos
+                    else:
+                        speedStopped = 0
+
+                iters += self.repeat
+
+            if not run or speedStopped >= 3 or k == len(horizons) - 1:
+                break
+
+            # Siguen los mejores keep de los que quedan, en caso de empate
+            # los primeros de la poblacion
+            idx = np.flatnonzero(active)
+            values = score(self.nextRewardIdx[idx], self.aliveFrames[idx])
+            order = idx[np.argsort(-values, kind='stable')]
+            active[order[ceil(len(idx) * keep):]] = False
+
+        self.writeBack()
+
+        return iters
+
+    def record(self, maxIters: int, iters: int = 1) -> np.ndarray:
+        '''
+        Simula y guarda el estado de cada coche tras cada step
+        (RECORD_FIELDS), para poder decidir despues en que frame se para la
+        simulacion (stopFrame) combinando registros de varias simulaciones.
+        Se detiene al llegar a maxIters, cuando no hay vivos o en cuanto
+        algun coche pasa de 3 vueltas, porque la simulacion de la poblacion
+        completa se para como muy tarde ahi.
+        iters: frame por el que se empieza, para continuar una simulacion
+        (restore) hasta maxIters
+        Return: array (frames, len(RECORD_FIELDS), coches)
+        '''
+
+        maxRewards = len(self.rewards) * 3
+
+        frames = []
+        while iters < maxIters:
+            self.step()
+            frames.append(self.frame())
+
+            iters += self.repeat
+            if not self.alive.any():
+                break
+            if (self.nextRewardIdx > maxRewards).any():
+                break
+
+        return np.array(frames, dtype=int).reshape(
+            (-1, len(RECORD_FIELDS), len(self.poblacion)))
+
+    def frame(self) -> np.ndarray:
+        '''Array (len(RECORD_FIELDS), coches) con el estado actual'''
+        return np.stack((
+            self.nextRewardIdx, self.aliveFrames,
+            self.lastRewardFrames, self.alive, self.speed < 0.01,
+            self.retired))
+
+    def getState(self) -> np.ndarray:
+        '''
+        Array (7, coches) con la posicion, direccion, velocidad y posicion
+        de referencia de checkStagnation, que junto con frame() permite
+        continuar la simulacion (restore)
+        '''
+        return np.stack((
+            self.x, self.y, self.dirx, self.diry, self.speed,
+            self.anchorx, self.anchory))
+
+    def restore(
+            self, idx: np.ndarray,
+            frames: np.ndarray, states: np.ndarray) -> None:
+        '''
+        Continua la simulacion de los coches indicados desde un estado
+        guardado: frames (len(RECORD_FIELDS), n) y states (7, n)
+        '''
+        (
+            self.nextRewardIdx[idx], self.aliveFrames[idx],
+            self.lastRewardFrames[idx], self.alive[idx], _,
+            self.retired[idx]) = frames
+        (
+            self.x[idx], self.y[idx], self.dirx[idx], self.diry[idx],
+            self.speed[idx], self.anchorx[idx], self.anchory[idx]) = states
+
+    def writeBack(self) -> None:
+        '''Copia el estado de los arrays a los objetos Car'''
+
+        for i, car in enumerate(self.poblacion):
+            car.body.center.set(float(self.x[i]), float(self.y[i]))
+            car.body.direction.set(float(self.dirx[i]), float(self.diry[i]))
+            car.speed = float(self.speed[i])
+            car.statusDead = not self.alive[i]
+            car.statusRetired = bool(self.retired[i])
+            car.anchor = (float(self.anchorx[i]), float(self.anchory[i]))
+            car.nextRewardIdx = int(self.nextRewardIdx[i])
+            car.aliveFrames = int(self.aliveFrames[i])
+            car.lastRewardFrames = int(self.lastRewardFrames[i])
+
+
+def padRecords(records: List[np.ndarray]) -> np.ndarray:
+    '''
+    Junta registros (frames, campos, coches) de distinta duracion en uno
+    solo, alargando cada uno con su ultimo frame. Tras el ultimo frame de
+    un registro todos sus coches estan muertos o alguno ha pasado de 3
+    vueltas (y entonces la simulacion ya se habria parado)
+    '''
+    nframes = max(len(r) for r in records)
+    return np.concatenate([
+        np.concatenate((r, np.repeat(r[-1:], nframes - len(r), axis=0)))
+        for r in records], axis=2)
+
+
+def splitRecords(
+        records: np.ndarray, maxRewards: int) -> List[np.ndarray]:
+    '''
+    Registro (frames, campos) de cada coche por separado, cortado en el
+    primer frame en el que esta muerto o ha pasado de 3 vueltas
+    '''
+    done = (records[:, 3] == 0) | (records[:, 0] > maxRewards)
+    ends = np.where(done.any(axis=0), done.argmax(axis=0) + 1, len(records))
+    return [records[:end, :, j] for j, end in enumerate(ends.tolist())]
+
+
+def stopFrame(
+        records: np.ndarray, maxRewards: int, maxIters: int,
+        endIfAllStopped: bool = True, repeat: int = 1) -> int:
+    '''
+    Numero de frames con el que terminaria PopulationSimulator.run para la
+    poblacion de los registros (array de padRecords), con repeat frames por
+    step
+    '''
+    dead = ~records[:, 3].astype(bool).any(axis=1)
+    laps = (records[:, 0] > maxRewards).any(axis=1)
+    stopped = records[:, 4].astype(bool).all(axis=1)
+
+    # Mismo bucle que PopulationSimulator.run, el step que se calcula en
+    # cada vuelta es (iters - 1) / repeat
+    speedStopped = 0
+    run = True
+    iters = 1
+    while run and speedStopped < 3 and iters < maxIters:
+        k = min((iters - 1) // repeat, len(records) - 1)
+
+        if dead[k]:
+            run = False
+
+        if run and laps[k]:
+            # Mas de 3 vueltas completas al circuito
+            run = False
+
+        if endIfAllStopped and run:
+            if stopped[k]:
+                speedStopped += 1  # Todos quietos
+            else:
+                speedStopped = 0
+
+        iters += repeat
+
+    return iters
+
+
+def halvingHorizons(maxIters: int, rungs: int, keep: float) -> List[int]:
+    '''
+    Frames de cada nivel de PopulationSimulator.runHalving: el ultimo es
+    maxIters y cada uno es keep veces el siguiente, de forma que cada nivel
+    simula mas o menos los mismos coches x frames (con keep veces menos
+    coches que el anterior)
+    '''
+    return [
+        max(ceil(maxIters * keep ** (rungs - 1 - k)), 2)
+        for k in range(rungs)]
+
+
+def recordSteps(maxIters: int, repeat: int = 1) -> int:
+    '''Numero maximo de steps de PopulationSimulator.run'''
+    return len(range(1, maxIters, repeat))
+
+
+def applyRecords(
+        poblacion: List[Car], records: np.ndarray, iters: int,
+        repeat: int = 1) -> None:
+    '''
+    Copia a cada Car los contadores de recompensas y frames y si esta vivo
+    en el ultimo step simulado (iters de stopFrame)
+    '''
+    state = None
+    steps = (iters - 1) // repeat
+    if steps and len(records):
+        state = records[min(steps - 1, len(records) - 1)].tolist()
+
+    for j, car in enumerate(poblacion):
+        car.resetAll()
+        if state is not None:
+            car.nextRewardIdx = state[0][j]
+            car.aliveFrames = state[1][j]
+            car.lastRewardFrames = state[2][j]
+            car.statusDead = not state[3][j]
+            car.statusRetired = bool(state[5][j])
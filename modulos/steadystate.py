@@ -0,0 +1,214 @@
+'''
+Evolucion estacionaria (steady-state) asincrona: sin generaciones. Los
+procesos simulan individuos sueltos y, en cuanto uno termina, el individuo
+entra en la poblacion (sustituyendo al peor si es al menos igual de bueno)
+y se cria un hijo nuevo con los operadores del Entrenador (seleccion,
+cruce y mutacion) para el proceso que ha quedado libre. Los procesos no
+esperan al coche que mas dura de cada generacion.
+'''
+from typing import List, Tuple
+from bisect import bisect_right
+from os import cpu_count
+from queue import Queue
+from random import random
+from time import perf_counter
+import numpy as np
+
+from modulos.circuit import Circuit
+from modulos.car import Car
+from modulos import entrenador
+from modulos.entrenador import Entrenador
+from modulos.parallel import ParallelFitness
+
+
+class SteadyState():
+    '''
+    Entrenamiento estacionario con los hiperparametros y operadores de un
+    Entrenador (populationSize, probabCruce, mutationRate, renovacion,
+    seleccion, stagnation y repeat)
+    '''
+
+    entrenador: Entrenador
+    workers: int
+    maxIters: int
+    enVuelo: int
+
+    poblacion: List[Car]
+    fits: List[float]
+    mejores: List[Tuple[Car, float]]
+    individuo: Car
+    list_fit_best: List[float]
+    list_fit_med: List[float]
+
+    evaluaciones: int
+    framesSimulados: int
+    evaluacionesPorSegundo: float
+    utilizacion: float
+
+    EN_VUELO_POR_WORKER = 2
+    '''
+    Individuos pendientes de simular por proceso, para que ninguno espere
+    mientras se cria el siguiente
+    '''
+
+    def __init__(
+            self, e: Entrenador, workers: int = None,
+            maxIters: int = 400) -> None:
+        '''
+        - e: Entrenador del que se usan los hiperparametros y operadores
+        - workers: procesos que simulan, por defecto uno por CPU
+        - maxIters: frames maximos de cada episodio (el mismo para todos,
+            para que los fitness sean comparables)
+        '''
+
+        if workers is None:
+            workers = cpu_count() or 1
+        if workers < 1:
+            raise ValueError('workers debe ser al menos 1')
+        if maxIters < 1:
+            raise ValueError('maxIters debe ser al menos 1')
+
+        self.entrenador = e
+        self.workers = workers
+        self.maxIters = maxIters
+        self.enVuelo = workers * self.EN_VUELO_POR_WORKER
+
+        self.poblacion = []
+        self.fits = []
+        self.mejores = []
+        self.individuo = None
+        self.list_fit_best = []
+        self.list_fit_med = []
+        self.evaluaciones = 0
+        self.framesSimulados = 0
+        self.evaluacionesPorSegundo = 0
+        self.utilizacion = 0
+
+    def insertar(self, car: Car, fit: float) -> bool:
+        '''
+        Anade el individuo a la poblacion (ordenada de mejor a peor) si no
+        esta llena, o sustituye al peor si es al menos igual de bueno.
+        Devuelve si ha entrado
+        '''
+        e = self.entrenador
+        if len(self.poblacion) >= e.populationSize:
+            if fit < self.fits[-1]:
+                return False
+            self.poblacion.pop()
+            self.fits.pop()
+
+        # fits esta ordenado de mayor a menor
+        i = bisect_right([-f for f in self.fits], -fit)
+        self.poblacion.insert(i, car)
+        self.fits.insert(i, fit)
+        return True
+
+    def hijo(self) -> Car:
+        '''
+        Nuevo individuo: aleatorio con probabilidad renovacion, y si no
+        el primero de dos hijos de progenitores seleccionados de la
+        poblacion, cruzados con probabilidad probabCruce y mutados
+        '''
+        e = self.entrenador
+        if len(self.poblacion) < 2 or (
+                random() < e.renovacion / e.populationSize):
+            return e.createGeneration(1)[0]
+
+        hijos = [
+            p.copy(shareBrain=True)
+            for p in e.seleccionar(self.poblacion, self.fits, 2)]
+        if np.random.random() < e.probabCruce:
+            hijos = e.constructor.recombinacionPoblacion(
+                hijos, np.array([[0, 1]]))
+        hijos = e.constructor.mutacionPoblacion(hijos, e.mutationRate)
+        return hijos[0]
+
+    def train(self, circuito: Circuit, evaluaciones: int) -> 'SteadyState':
+        '''
+        Simula <evaluaciones> individuos: primero los de una poblacion
+        aleatoria y despues hijos de la poblacion.
+        Cada populationSize evaluaciones se guardan el mejor y el fitness
+        medio de la poblacion en list_fit_best y list_fit_med
+        '''
+
+        if not len(circuito.limits) or not len(circuito.reward_lines):
+            raise ValueError('Circuito sin limites o recompensas')
+        if evaluaciones < 1:
+            raise ValueError('evaluaciones debe ser al menos 1')
+
+        e = self.entrenador
+        fitnessValues = e.constructor.__class__.fitnessValues
+        pool = ParallelFitness(circuito, self.workers)
+        results = Queue()
+        busy = 0.0
+        enviados = 0
+        pendientes = 0
+
+        def enviar(car: Car) -> None:
+            nonlocal enviados, pendientes
+            pool.simulateAsync(
+                car, self.maxIters,
+                lambda r: results.put((car, r)),
+                lambda exc: results.put((car, exc)),
+                e.stagnation, e.repeat)
+            enviados += 1
+            pendientes += 1
+
+        start = perf_counter()
+        try:
+            for car in e.createGeneration(
+                    min(e.populationSize, self.enVuelo, evaluaciones)):
+                enviar(car)
+
+            while pendientes:
+                car, r = results.get()
+                pendientes -= 1
+                if isinstance(r, BaseException):
+                    raise r
+
+                (car.nextRewardIdx, car.aliveFrames,
+                 car.lastRewardFrames, t) = r
+                busy += t
+                fit = fitnessValues([car], self.maxIters)[0]
+                self.insertar(car, fit)
+                self.evaluaciones += 1
+                self.framesSimulados += car.aliveFrames
+
+                if not self.evaluaciones % e.populationSize:
+                    self.registrar()
+
+                if enviados < evaluaciones:
+                    # Poblacion inicial aleatoria, despues hijos
+                    enviar(
+                        e.createGeneration(1)[0]
+                        if enviados < e.populationSize else self.hijo())
+        finally:
+            pool.close()
+
+        wall = perf_counter() - start
+        self.evaluacionesPorSegundo = self.evaluaciones / wall
+        self.utilizacion = busy / (self.workers * wall)
+        if self.evaluaciones % e.populationSize:
+            self.registrar()
+        self.individuo = self.poblacion[0]
+
+        if entrenador.LOG:
+            print(
+                f'{self.evaluaciones} evaluaciones en {wall:.1f} s '
+                f'({self.evaluacionesPorSegundo:.0f}/s), '
+                f'utilizacion de los procesos: {self.utilizacion:.0%}')
+
+        return self
+
+    def registrar(self) -> None:
+        '''Guarda el mejor y el fitness medio de la poblacion actual'''
+        self.mejores.append((self.poblacion[0], self.fits[0]))
+        self.list_fit_best.append(self.fits[0])
+        self.list_fit_med.append(float(np.mean(self.fits)))
+
+        if entrenador.LOG:
+            print(
+                f'Evaluaciones {self.evaluaciones}',
+                f'Mejor: {self.fits[0]}',
+                f'Fitness medio: {self.list_fit_med[-1]}',
+                '', sep='\n')
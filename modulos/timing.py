@@ -0,0 +1,75 @@
+'''
+Tiempo por fase de la simulacion (colisiones, recompensas, sensores, red,
+movimiento y dibujo) para saber en que se va el tiempo de una generacion.
+Las fases se miden por vueltas: cada llamada a lap suma el tiempo desde la
+anterior a la fase que termina. Sin medicion se usa noLap, que no hace
+nada, asi que el coste es el de una llamada vacia por fase
+'''
+from time import perf_counter
+from typing import Dict
+
+PHASES = ('collision', 'reward', 'sense', 'think', 'move', 'render')
+
+
+def noLap(phase: str = None) -> None:
+    '''PhaseTimes.lap cuando no se mide el tiempo'''
+
+
+class PhaseTimes():
+    '''Tiempo y numero de llamadas acumulados de cada fase'''
+
+    seconds: Dict[str, float]
+    calls: Dict[str, int]
+    wall: float
+    last: float
+
+    def __init__(self) -> None:
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.wall = 0.0
+        self.last = perf_counter()
+
+    def lap(self, phase: str = None) -> None:
+        '''
+        Suma a phase el tiempo desde la vuelta anterior. Sin phase solo
+        empieza una vuelta nueva
+        '''
+        now = perf_counter()
+        if phase is not None:
+            self.seconds[phase] += now - self.last
+            self.calls[phase] += 1
+        self.last = now
+
+    def merge(self, other: 'PhaseTimes') -> None:
+        for phase in PHASES:
+            self.seconds[phase] += other.seconds[phase]
+            self.calls[phase] += other.calls[phase]
+        self.wall += other.wall
+
+    def total(self) -> float:
+        '''Tiempo de todas las fases'''
+        return sum(self.seconds.values())
+
+    def asDict(self) -> dict:
+        '''Diccionario serializable en JSON'''
+        return {
+            'wall': self.wall,
+            'seconds': dict(self.seconds),
+            'calls': dict(self.calls)}
+
+    def fromDict(data: dict) -> 'PhaseTimes':
+        times = PhaseTimes()
+        times.wall = data['wall']
+        times.seconds.update(data['seconds'])
+        times.calls.update(data['calls'])
+        return times
+
+    def __str__(self) -> str:
+        fases = ', '.join(
+            f'{phase} {self.seconds[phase] * 1e3:.1f} ms '
+            f'({self.calls[phase]})'
+            for phase in PHASES if self.calls[phase])
+        otros = max(self.wall - self.total(), 0)
+        return (
+            f'{fases or "sin fases medidas"}, '
+            f'otros {otros * 1e3:.1f} ms, total {self.wall * 1e3:.1f} ms')
@@ -1,23 +1,31 @@
 
 
-import matplotlib.pyplot as plt
-import pickle as pkl
 from time import time
 from sys import argv
 
-from modulos.circuit import Circuit
-from modulos.entrenador import Entrenador, CarConstructor
+from modulos.circuit import loadCircuit
+from modulos.entrenador import Entrenador, VectorCarConstructor
+from modulos.islas import Islas
+from modulos.steadystate import SteadyState
+from modulos import checkpoint
 
 
 mejores = None
-if len(argv) > 1:
-    with open(argv[-1], 'rb') as f:
-        data = f.read()
-
-    mejores = [m[0] for m in pkl.loads(data)]
-
-
-circuit = Circuit('./circuito/train1.ct')
+resume = None
+if len(argv) > 2 and argv[1] == '--resume':
+    # Continuar un entrenamiento interrumpido desde su snapshot
+    resume = argv[2]
+elif len(argv) > 1:
+    mejores = checkpoint.loadCars(argv[-1])
+
+
+# Circuitos de entrenamiento, con varios el fitness de cada individuo junta
+# el de todos segun agregacion: 'media', 'minimo' o una lista de pesos (uno
+# por circuito). Las islas y el modo estacionario solo usan el primero
+circuitFiles = ['./circuito/train1.ct']
+agregacion = 'media'
+circuitos = [loadCircuit(f) for f in circuitFiles]
+circuit = circuitos[0]
 
 minL = 1
 maxL = 2
@@ -28,13 +36,72 @@ maxGens = 60
 nIterNoChng = 10
 probCruce = 0.2
 probMutac = 0.09
-
-cc = CarConstructor(circuit.startPoint.asTuple(), minL, maxL, layersSize)
-p = Entrenador(
-    cc, popSize, maxGens, nIterNoChng, probCruce, probMutac, renovacion=0.2)
+# Seleccion de progenitores: 'ruleta', 'sus', 'torneo' o 'truncamiento'
+seleccion = 'ruleta'
+# Procesos para calcular el fitness, None para no paralelizar
+# (con el metodo spawn de Windows/macOS el script necesita un
+# if __name__ == '__main__')
+workers = None
+# Individuos cuya simulacion se guarda para no repetirla (elite, repetidos)
+cacheSize = 1000
+# Retirar los coches que cada N frames sin recompensas no se alejan al menos
+# D pixeles: (N, D), p.ej. (30, 20). None para no retirarlos
+stagnation = None
+# Frames que se mantiene cada decision de la red (sensores y red una vez
+# cada <repeat> frames, colisiones sobre todo el desplazamiento)
+repeat = 1
+# Successive halving: (niveles, proporcion), todos los individuos se simulan
+# unos pocos frames y solo la proporcion mejor sigue al siguiente nivel, hasta
+# el maximo de la generacion, p.ej. (3, 1 / 3). Necesita cacheSize = None y
+# workers = None. None para simular todos hasta el final
+halving = None
+# Cada cuantas generaciones se guarda el estado del entrenamiento para
+# continuarlo con --resume, None para no guardarlo
+snapshotEvery = 5
+snapshotFile = './best/snapshot.npz'
+# Metricas de cada generacion, una linea JSON por generacion (para seguirlas:
+# python -m modulos.metrics best/metrics.jsonl), None para no guardarlas
+metricsFile = './best/metrics.jsonl'
+metricsLive = True
+# Modelo de islas: numero de poblaciones de popSize individuos que evolucionan
+# en procesos separados (como workers), enviando sus 2 mejores a la siguiente
+# cada migracionEvery generaciones. None para una sola poblacion
+islas = None
+migracionEvery = 5
+# Evolucion estacionaria asincrona: numero de evaluaciones (individuos
+# simulados con hasta steadyIters frames) en procesos que crian un hijo en
+# cuanto terminan uno, sin esperar a la generacion. None para generaciones
+steadyState = None
+steadyIters = 400
+
+cc = VectorCarConstructor(circuit.startPoint.asTuple(), minL, maxL, layersSize)
+if islas:
+    p = Islas(
+        cc, islas, maxGens, migracionEvery, 2, populationSize=popSize,
+        probabCruce=probCruce, mutationRate=probMutac, renovacion=0.2,
+        seleccion=seleccion, cacheSize=cacheSize, stagnation=stagnation,
+        repeat=repeat)
+elif steadyState:
+    p = SteadyState(Entrenador(
+        cc, popSize, probabCruce=probCruce, mutationRate=probMutac,
+        renovacion=0.2, seleccion=seleccion, stagnation=stagnation,
+        repeat=repeat), workers, steadyIters)
+else:
+    p = Entrenador(
+        cc, popSize, maxGens, nIterNoChng, probCruce, probMutac,
+        renovacion=0.2, seleccion=seleccion,
+        workers=workers, cacheSize=cacheSize, stagnation=stagnation,
+        repeat=repeat, snapshotEvery=snapshotEvery, snapshotFile=snapshotFile,
+        metricsFile=metricsFile, metricsLive=metricsLive, halving=halving,
+        agregacion=agregacion)
 
 try:
-    p.train(circuit, mejores)
+    if islas:
+        p.train(circuit)
+    elif steadyState:
+        p.train(circuit, steadyState)
+    else:
+        p.train(circuitos, mejores, resume=resume)
 except KeyboardInterrupt:
     pass
 
@@ -43,13 +110,21 @@ filename = ''.join((
     f'-{round(time())}',
     f'-{len(p.individuo.brain.pesos)}layers' if p.individuo else '',
     f'-{round(p.list_fit_best[-1], 2)}' if len(p.list_fit_best) else '',
-    '.pkl'))
+    '.npz'))
 
-data = pkl.dumps(p.mejores)
+checkpoint.save(filename, p.mejores, {
+    'circuito': circuitFiles[0],
+    'circuitos': circuitFiles, 'agregacion': agregacion,
+    'generaciones': len(p.list_fit_best),
+    'minL': minL, 'maxL': maxL, 'layersSize': layersSize,
+    'popSize': popSize, 'probCruce': probCruce, 'probMutac': probMutac,
+    'seleccion': seleccion,
+    'stagnation': stagnation, 'repeat': repeat,
+})
 
-with open(filename, 'wb') as f:
-    f.write(data)
 
+# matplotlib solo se importa al terminar el entrenamiento
+import matplotlib.pyplot as plt  # noqa: E402
 
 generaciones = [i for i in range(len(p.list_fit_best))]
 
@@ -73,4 +148,4 @@ plt.show()
     nIterNoChng,
     int(probCruce*100),
     int(probMutac*100),
-    ]]) + f'-{round(time())}' + '.pkl'"""
+    ]]) + f'-{round(time())}' + '.npz'"""